@@ -0,0 +1,2813 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2001, 2002, 2003, 2012 Progiciels Bourbeau-Pinard inc.
+# François Pinard <pinard@iro.umontreal.ca>, 2001.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.  */
+
+"""\
+Interface between Emacs Lisp and Python - Python part.
+
+Emacs may launch this module as a stand-alone program, in which case it
+acts as a server of Python facilities for that Emacs session, reading
+requests from standard input and writing replies on standard output.
+When used in this way, the program is called "the Pymacs helper".
+
+This module may also be usefully imported by other Python modules.
+See the Pymacs documentation (check `README') for more information.
+"""
+
+# Identification of version.
+
+package = 'Pymacs'
+version = '0.25'
+
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+
+import collections
+
+def callable(value):
+    return isinstance(value, collections.Callable)
+
+basestring = str
+from imp import reload
+import builtins
+import queue
+
+
+
+
+
+
+def fixup_icanon():
+    # Otherwise sys.stdin.read hangs for large inputs in emacs 24.
+    # See comment in emacs source code sysdep.c.
+    import termios
+    a = termios.tcgetattr(1)
+    a[3] &= ~termios.ICANON
+    termios.tcsetattr(1, termios.TCSANOW, a)
+
+try:
+    import signal
+except ImportError:
+    # Jython does not have signal.
+    signal = None
+
+## Python services for Emacs applications.
+
+
+class Main:
+    debug_file = None
+    signal_file = None
+    socket_file = None
+    zygote = False
+
+    def main(self, *arguments):
+        """\
+Execute Python services for Emacs, and Emacs services for Python.
+This program is meant to be called from Emacs, using `pymacs.el'.
+
+Server options:
+    -u FILE    Serve each Emacs connecting to Unix socket FILE.
+    -i MODULE  Import MODULE before serving, this option may be repeated.
+    -z         Also import modules named on standard input, one per line.
+
+Debugging options:
+    -d FILE  Debug the protocol to FILE.
+    -s FILE  Trace received signals to FILE.
+
+Arguments are added to the search path for Python modules.
+"""
+
+        # Decode options.
+        arguments = (os.environ.get('PYMACS_OPTIONS', '').split()
+                     + list(arguments))
+        import getopt
+        options, arguments = getopt.getopt(arguments, 'fd:i:s:u:z')
+        preloads = []
+        for option, value in options:
+            if option == '-d':
+                self.debug_file = value
+            elif option == '-i':
+                preloads.append(value)
+            elif option == '-s':
+                self.signal_file = value
+            elif option == '-u':
+                self.socket_file = value
+            elif option == '-z':
+                self.zygote = True
+            elif option == '-f':
+                try:
+                    fixup_icanon()
+                except:
+                    pass
+
+        arguments.reverse()
+        for argument in arguments:
+            if os.path.isdir(argument):
+                sys.path.insert(0, argument)
+
+        # As a server, only return within a child connected to some Emacs.
+        if self.socket_file is not None:
+            self.serve_sessions(preloads)
+
+        # Inhibit signals.  The Interrupt signal is temporary enabled, however,
+        # while executing any Python code received from the Lisp side.
+        if signal is not None:
+
+            # See the comment for IO_ERRORS_WITH_SIGNALS in ppppconfig.py.
+            self.original_handler = signal.signal(
+                signal.SIGINT, self.interrupt_handler)
+
+
+
+
+
+
+
+
+
+
+        self.inhibit_quit = True
+
+
+
+
+
+
+        # Start protocol and services.  A child of a server also tells its
+        # process ID, as Emacs may not otherwise interrupt it.
+        if self.socket_file is None:
+            lisp._protocol.send('version', '"%s"' % version)
+        else:
+            lisp._protocol.send('version', '"%s" %d' % (version, os.getpid()))
+        lisp._protocol.loop(True)
+
+    def serve_sessions(self, preloads):
+        # Import all PRELOADS modules, then accept connections on the Unix
+        # socket named by "socket_file".  Each connection is served by a
+        # forked child, which inherits the modules already imported, and
+        # returns from here with the connection as its standard input and
+        # output.  The server itself only returns through an exception.
+        # As a zygote, the server is launched by Emacs, tells when it is
+        # ready, and imports more modules as Emacs names them on standard
+        # input, acknowledging each on standard output, see "preload_line".
+        # It then exits once Emacs closes its standard input,
+        # removing its socket, and the directory holding it if empty.
+        # Any connection gets a helper able to run arbitrary Python code, so
+        # only the user running the server may connect, see "accept".
+        import select, socket
+        for module_name in preloads:
+            self.preload(module_name)
+        self.remove_stale_socket()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        mask = os.umask(0o077)
+        try:
+            server.bind(self.socket_file)
+        finally:
+            os.umask(mask)
+        os.chmod(self.socket_file, 0o600)
+        server.listen(5)
+        if signal is not None:
+            # Let the system reap terminated children.
+            signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        inputs = [server]
+        if self.zygote:
+            inputs.append(0)
+            os.write(1, 'ready\n'.encode('ASCII'))
+        pending = ''
+        while True:
+            ready = select.select(inputs, [], [])[0]
+            if 0 in ready:
+                data = os.read(0, 4096)
+                if not data:
+                    os.remove(self.socket_file)
+                    try:
+                        os.rmdir(os.path.dirname(self.socket_file))
+                    except OSError:
+                        pass
+                    sys.exit()
+                lines = (pending + data.decode('UTF-8')).split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    self.preload_line(line)
+            if server not in ready:
+                continue
+            connection = self.accept(server)
+            if connection is None:
+                continue
+            if os.fork() == 0:
+                server.close()
+                if signal is not None:
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.dup2(connection.fileno(), 0)
+                os.dup2(connection.fileno(), 1)
+                connection.close()
+                return
+            connection.close()
+
+    def remove_stale_socket(self):
+        # Remove a socket left by a previous server, refusing to remove
+        # anything else, or anything belonging to another user.
+        import stat
+        try:
+            status = os.lstat(self.socket_file)
+        except OSError:
+            return
+        if (not stat.S_ISSOCK(status.st_mode)
+                or status.st_uid != os.getuid()):
+            sys.exit("%s exists, and is not a socket of ours"
+                     % self.socket_file)
+        os.remove(self.socket_file)
+
+    def accept(self, server):
+        # Accept a connection on socket SERVER, and return it.  Whenever
+        # the system tells who connected, refuse other users and return None.
+        import socket, struct
+        connection = server.accept()[0]
+        option = getattr(socket, 'SO_PEERCRED', None)
+        if option is not None:
+            size = struct.calcsize('3i')
+            pid, uid, gid = struct.unpack('3i', connection.getsockopt(
+                socket.SOL_SOCKET, option, size))
+            if uid != os.getuid():
+                connection.close()
+                return None
+        return connection
+
+    def preload_line(self, line):
+        # Import the module named by LINE for a zygote, then acknowledge it
+        # to Emacs.  Meanwhile, standard input and output are diverted from
+        # Emacs, as the module may print, or even try using "lisp".  If the
+        # import fails, Emacs later reports the problem, if it loads it.
+        null = os.open(os.devnull, os.O_RDWR)
+        saved = os.dup(0), os.dup(1)
+        os.dup2(null, 0)
+        os.dup2(null, 1)
+        os.close(null)
+        try:
+            try:
+                self.preload(line)
+                status = 'imported'
+            except:
+                status = 'failed'
+            try:
+                sys.stdout.flush()
+            except:
+                pass
+        finally:
+            os.dup2(saved[0], 0)
+            os.dup2(saved[1], 1)
+            os.close(saved[0])
+            os.close(saved[1])
+        os.write(1, ('%s %s\n' % (status, line)).encode('UTF-8'))
+
+    def preload(self, file_without_extension):
+        # Import a module given as for "pymacs_load_helper", and remember it,
+        # so a forked Pymacs helper does not reload it on its first load.
+        directory, module_name = os.path.split(file_without_extension)
+        try:
+            if directory:
+                sys.path.insert(0, directory)
+            __import__(module_name)
+        finally:
+            if directory:
+                del sys.path[0]
+        preloaded.setdefault(module_name, time.time())
+
+    def generic_handler(self, number, frame):
+        if self.signal_file:
+            handle = open(self.signal_file, 'a')
+            handle.write('%d\n' % number)
+            handle.close()
+
+    def interrupt_handler(self, number, frame):
+        if self.signal_file:
+            star = (' *', '')[self.inhibit_quit]
+            handle = open(self.signal_file, 'a')
+            handle.write('%d%s\n' % (number, star))
+            handle.close()
+        if not self.inhibit_quit:
+            self.original_handler(number, frame)
+
+run = Main()
+main = run.main
+
+# Names of modules imported by a server before forking, yet not loaded
+# through "pymacs_load_helper", see "Main.serve_sessions".  Each is
+# associated with the time of its import.
+preloaded = {}
+
+
+
+
+
+
+class error(Exception):
+    pass
+
+class BatchError(error):
+    pass
+
+class ProtocolError(error):
+    pass
+
+class ZombieError(error):
+    pass
+
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6 does not have OrderedDict.
+    OrderedDict = None
+
+
+class Code_Cache:
+
+    # Python code received from Emacs is often the same over and over, like
+    # when Emacs repeatedly calls the same Python function with the same
+    # arguments.  This bounded cache retains compiled code, keyed by source
+    # text, so it does not get compiled again.  When the cache is full, the
+    # least recently used code is forgotten.  Texts longer than TEXT_LIMIT
+    # characters are compiled without being retained, as they would keep
+    # much memory, and compiling them is small next to transmitting them.
+    # Counters of "hits" and "misses" tell how useful the cache has been.
+
+    def __init__(self, limit=1000, text_limit=4096):
+        self.limit = limit
+        self.text_limit = text_limit
+        self.clear()
+
+    def clear(self):
+        if OrderedDict is None:
+            self.codes = {}
+        else:
+            self.codes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, text, mode):
+        # Return code compiled from TEXT, MODE is either 'eval' or 'exec'.
+        if len(text) > self.text_limit:
+            self.misses += 1
+            return compile(text, '<string>', mode)
+        key = mode, text
+        codes = self.codes
+        try:
+            code = codes.pop(key)
+        except KeyError:
+            self.misses += 1
+            code = compile(text, '<string>', mode)
+            if len(codes) >= self.limit:
+                if OrderedDict is None:
+                    codes.clear()
+                else:
+                    codes.popitem(False)
+        else:
+            self.hits += 1
+        codes[key] = code
+        return code
+
+code_cache = Code_Cache()
+
+
+class Protocol:
+
+    # All exec's and eval's triggered from the Emacs side are all executed
+    # within the "loop" method below, so all user context is kept as
+    # local variables within this single routine.  Different instances
+    # of this Protocol class would yield independant evaluation contexts.
+    # But in the usual case, there is only one such instance kept within a
+    # Lisp_Interface instance, and the "lisp" global variable within this
+    # module holds such a Lisp_Interface instance.
+
+    # Input from Emacs is read in chunks of this many bytes, at most.
+    read_size = 65536
+
+    # Lisp handles lost by Python are normally freed along with the next
+    # message to Emacs.  When that many are waiting while Python is about
+    # to wait on Emacs, or any while the outer loop gets idle, they are
+    # rather sent on their own, see "send".
+    free_threshold = 1000
+
+    def __init__(self, input_fd=0):
+        self.freed = []
+        self.input_fd = input_fd
+        # The active Batch instance, if any, see "Symbol.__call__".
+        self.batch = None
+        # Asynchronous requests from Emacs, not yet run.  Each entry is an
+        # (IDENTIFIER, FUNCTION, ARGUMENTS) triplet.
+        self.async_jobs = deque()
+        # Synchronous requests received while an asynchronous request was
+        # running, as (ACTION, TEXT) pairs, see "loop".
+        self.sync_requests = deque()
+        self.code_cache = code_cache
+        # Set once Emacs selected the binary protocol, see "encode_lisp".
+        self.binary = False
+        # Bytes received from Emacs, yet not consumed by "receive".  A single
+        # read may hold many messages, or only part of a bigger message.
+
+        self.pending = bytearray()
+
+
+
+
+
+    def loop(self, serve_async=False):
+        # The server loop repeatedly receives a request from Emacs and
+        # returns a response, which is either the value of the received
+        # Python expression, or the Python traceback if an error occurs
+        # while evaluating the expression.  Asynchronous requests are
+        # only run by the outer loop, which has SERVE_ASYNC set.
+
+        # The server loop may also be executed, as a recursive invocation,
+        # in the context of Emacs serving a Python request.  In which
+        # case, we might also receive a notification from Emacs telling
+        # that the reply has been transmitted, or that an error occurred.
+        # A reply notification from Emacs interrupts the loop: the result
+        # of this function is then the value returned from Emacs.
+        done = False
+        while not done:
+            if (serve_async and self.async_jobs and not self.sync_requests
+                    and not self.input_waiting()):
+                # Requests already sent by Emacs get served first.
+                self.run_async_job()
+                continue
+            freed = len(self.freed)
+            if freed and (serve_async or freed >= self.free_threshold):
+                self.send(None, None)
+            binary = self.binary
+            try:
+                if serve_async and self.sync_requests:
+                    action, text = self.sync_requests.popleft()
+                else:
+                    action, text = self.receive(serve_async)
+                if action == 'sync':
+                    # Emacs made this request while asynchronous ones
+                    # were pending.  It is only served by the outer loop,
+                    # in between asynchronous requests.
+                    if not serve_async:
+                        self.sync_requests.append(text)
+                        continue
+                    action, text = text
+                if action == 'eval':
+                    action = 'return'
+                    code = self.code_cache.compile(text, 'eval')
+                    try:
+                        run.inhibit_quit = False
+                        value = eval(code)
+                    finally:
+                        run.inhibit_quit = True
+                elif action == 'exec':
+                    action = 'return'
+                    value = None
+                    code = self.code_cache.compile(text, 'exec')
+                    try:
+                        run.inhibit_quit = False
+                        exec(code)
+                    finally:
+                        run.inhibit_quit = True
+                elif action == 'call':
+                    # TEXT holds the function, then its arguments.
+                    action = 'return'
+                    function = text[0]
+                    if isinstance(function, basestring):
+                        function = eval(
+                            self.code_cache.compile(function, 'eval'))
+                    try:
+                        run.inhibit_quit = False
+                        value = function(*text[1:])
+                    finally:
+                        run.inhibit_quit = True
+                elif action == 'async':
+                    # No reply is due before the function gets run.
+                    self.async_jobs.append((text[0], text[1], text[2:]))
+                    continue
+                elif action == 'free':
+                    # Emacs does not expect any reply.
+                    free_python([int(index) for index in text.split()])
+                    continue
+                elif action == 'return':
+                    done = True
+                    if self.binary:
+                        value = text
+                    else:
+                        try:
+                            run.inhibit_quit = False
+                            value = eval(text)
+                        finally:
+                            run.inhibit_quit = True
+                elif action == 'raise':
+                    action = 'raise'
+                    value = 'Emacs: ' + text
+                elif action == 'protocol':
+                    # The reply still uses the previous protocol.
+                    action = 'return'
+                    value = text.strip() in ('text', 'binary')
+                    if value:
+                        binary = text.strip() == 'binary'
+                else:
+                    raise ProtocolError("Unknown action %r" % action)
+            except KeyboardInterrupt:
+                if done:
+                    raise
+                action = 'raise'
+                value = '*Interrupted*'
+            except ProtocolError as exception:
+                sys.exit("Protocol error: %s\n" % exception)
+            except:
+                import traceback
+                action = 'raise'
+                if lisp.debug_on_error.value() is None:
+                    value = traceback.format_exception_only(
+                        sys.exc_info[0], sys.exc_info[1])
+                    value = ''.join(value).rstrip()
+                else:
+                    value = traceback.format_exc()
+            if not done:
+                try:
+                    text = self.encode_reply(value)
+                except ProtocolError:
+                    raise
+                except:
+                    # The value may not go to Lisp, circular for one.
+                    action = 'raise'
+                    text = self.encode_reply(describe_error())
+                self.send(action, text)
+                self.binary = binary
+        return value
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+    def receive(self, idle=False):
+        # Receive a Python expression from Emacs, return (ACTION, TEXT).
+        # When IDLE, worker threads may be served while waiting.
+        pending = self.pending
+        while True:
+            if pending and pending[0] != ord(b'>'):
+                raise ProtocolError("`>' expected.")
+            tab = pending.find(b'\t')
+            if tab > 0:
+                break
+            if len(pending) > 24:
+                raise ProtocolError("Invalid message prefix.")
+            if idle and not pending and thread_pool.busy:
+                # Serving workers may have consumed input meanwhile.
+                thread_pool.wait_input(self)
+                if pending:
+                    continue
+            pending += self.read_input(self.read_size)
+        end = tab + 1 + int(pending[1:tab])
+        while len(pending) < end:
+            pending += self.read_input(
+                max(self.read_size, end - len(pending)))
+        prefix = bytes(pending[:tab + 1])
+        data = bytes(pending[tab + 1:end])
+        del pending[:end]
+        if run.debug_file is not None:
+            handle = open(run.debug_file, 'a')
+            handle.write(prefix.decode('ASCII')
+                         + data.decode('UTF-8', 'replace'))
+            handle.close()
+        action, data = data.split(None, 1)
+        # A "sync" request wraps another one, see "loop".
+        sync = action == b'sync'
+        if sync:
+            action, data = data.split(None, 1)
+        action = action.decode('ASCII')
+        # Arguments to "call" and "async", and values returned by Emacs
+        # under the binary protocol, are binary encoded.  Python code
+        # and diagnostics are always sent as UTF-8 text.
+        if action in ('call', 'async') or (self.binary
+                                and action in ('return', 'raise')):
+            message = action, decode_lisp(data)
+        else:
+            try:
+                message = action, data.decode('UTF-8')
+            except UnicodeDecodeError:
+                message = action, data.decode('ISO-8859-1')
+        if sync:
+            return 'sync', message
+        return message
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+    def encode_reply(self, value):
+        # Return VALUE printed for Lisp, as an argument for "send".
+        fragments = []
+        if self.binary:
+            encode_lisp(value, fragments.append, True)
+
+            return b''.join(fragments)
+        else:
+            print_lisp(value, fragments.append, True)
+        return ''.join(fragments)
+
+    def run_async_job(self):
+        # Run the oldest queued asynchronous request.  Its result is sent
+        # to Emacs as an "async" message, tagged with the request identifier,
+        # Emacs does not reply to such messages.  Requests for a
+        # Thread_Function or Process_Function are only started here, and
+        # may complete in any order.
+        identifier, function, arguments = self.async_jobs.popleft()
+        try:
+            action = 'return'
+            if isinstance(function, basestring):
+                function = eval(self.code_cache.compile(function, 'eval'))
+            if isinstance(function, Thread_Function):
+                # The worker thread later replies, see "Thread_Pool".
+                thread_pool.submit(function.function, arguments, identifier)
+                return
+            if isinstance(function, Process_Function):
+                process_pool.submit(function.function, arguments, identifier)
+                return
+            try:
+                run.inhibit_quit = False
+                value = function(*arguments)
+            finally:
+                run.inhibit_quit = True
+        except KeyboardInterrupt:
+            action = 'raise'
+            value = '*Interrupted*'
+        except ProtocolError:
+            raise
+        except:
+            action = 'raise'
+            value = describe_error()
+        self.send_async(identifier, action, value)
+
+    def send_async(self, identifier, action, value):
+        # Send to Emacs the outcome of the asynchronous request IDENTIFIER.
+        if self.binary:
+
+            fragments = [('l3:i%d;y%d:%s' % (
+                identifier, len(action), action)).encode('ASCII')]
+            encode_lisp(value, fragments.append, True)
+            self.send('async', b''.join(fragments))
+
+
+
+
+
+        else:
+            fragments = ['(%d %s ' % (identifier, action)]
+            print_lisp(value, fragments.append, True)
+            fragments.append(')')
+            self.send('async', ''.join(fragments))
+
+    def source(self, text):
+        # Return TEXT, some Lisp source, as an argument for "send".
+        if not self.binary:
+            return text
+
+        data = text.encode('UTF-8')
+        return ('r%d:' % len(data)).encode('ASCII') + data
+
+
+
+
+
+    def input_waiting(self):
+        # Tell if Emacs sent something not yet received, without waiting.
+        if self.pending:
+            return True
+        import select
+        return bool(select.select([self.input_fd], [], [], 0)[0])
+
+    def read_input(self, size):
+        # Read at most SIZE bytes from Emacs, waiting for at least one.
+        data = os.read(self.input_fd, size)
+        if not data:
+
+
+
+            raise ProtocolError("Empty stdin read.")
+        return data
+
+
+
+    def send(self, action, text):
+        # Send ACTION and its TEXT argument to Emacs.  Once the binary
+        # protocol is selected, TEXT rather holds encoded bytes.  If
+        # ACTION is None, only the delayed Lisp cleanup gets sent.
+        if self.binary:
+            fragments = []
+            write = fragments.append
+            if action is None:
+                write(b'l2:y4:free')
+                encode_lisp(self.freed, write, False)
+                self.freed = []
+            elif self.freed:
+                # Delayed Lisp cleanup is piggied back on the transmission.
+                write(b'l4:y4:free')
+                encode_lisp(self.freed, write, False)
+                self.freed = []
+            else:
+                write(b'l2:')
+            if action is not None:
+                encode_lisp(lisp[action], write, False)
+                write(text)
+            write(b'\n')
+            data = b''.join(fragments)
+        else:
+            if action is None:
+                text = '(free (%s))\n' % ' '.join(map(str, self.freed))
+                self.freed = []
+            elif self.freed:
+                # All delayed Lisp cleanup is piggied back on the
+                # transmission.
+                text = ('(free (%s) %s %s)\n'
+                        % (' '.join(map(str, self.freed)), action, text))
+                self.freed = []
+            else:
+                text = '(%s %s)\n' % (action, text)
+            data = text.encode('UTF-8')
+        prefix = '<%d\t' % len(data)
+        if run.debug_file is not None:
+            handle = open(run.debug_file, 'a')
+            handle.write(prefix + data.decode('UTF-8', 'replace'))
+            handle.close()
+        sys.stdout.buffer.write(prefix.encode('ASCII'))
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def pymacs_load_helper(file_without_extension, prefix, noerror=None,
+                       lazy=None, profile=None):
+    # This function imports a Python module, then returns a Lisp expression
+    # which, when later evaluated, will install trampoline definitions
+    # in Emacs for accessing the Python module facilities.  Module, given
+    # through FILE_WITHOUT_EXTENSION, may be a full path, yet without the
+    # `.py' or `.pyc' suffix, in which case the directory is temporarily
+    # added to the Python search path for the sole duration of that import.
+    # All defined symbols on the Lisp side have have PREFIX prepended,
+    # and have Python underlines in Python turned into dashes.  If PREFIX
+    # is None, it then defaults to the base name of MODULE with underlines
+    # turned to dashes, followed by a dash.  Only the names listed in the
+    # module "pymacs_exports" or else "__all__" are defined, if either
+    # exists.  If LAZY, functions rather get stubs, and a handle is only
+    # allocated by "pymacs_stub_helper" once the stub gets called.  When
+    # the module gets loaded again, handles of functions still exported are
+    # rebound in place, and vanished functions get undefined in Lisp.  If
+    # PROFILE, the time spent in each step is kept, see "Load_Profile".
+    directory, module_name = os.path.split(file_without_extension)
+    module_components = module_name.split('.')
+    if prefix is None:
+        prefix = module_components[-1].replace('_', '-') + '-'
+    if profile:
+        profile = Load_Profile(module_name)
+        profile.hook()
+    try:
+        module = sys.modules.get(module_name)
+        imported = preloaded.pop(module_name, None)
+        try:
+            # Reloading also needs the directory, to find the module again.
+            if directory:
+                sys.path.insert(0, directory)
+            if module:
+                # A first load of a module imported by a server is free.
+                if imported is None or module_changed(module, imported):
+                    reload(module)
+            else:
+                module = __import__(module_name)
+                # Whenever MODULE_NAME is of the form [PACKAGE.]...MODULE,
+                # __import__ returns the outer PACKAGE, not the module.
+                for component in module_components[1:]:
+                    module = getattr(module, component)
+        finally:
+            if directory:
+                del sys.path[0]
+    except ImportError:
+        if noerror:
+            return None
+        else:
+            raise
+    finally:
+        if profile:
+            profile.unhook()
+    if profile:
+        profile.phase('import')
+    load_hook = module.__dict__.get('pymacs_load_hook')
+    if load_hook:
+        load_hook()
+        if profile:
+            profile.phase('load hook')
+    interactions = module.__dict__.get('interactions', {})
+    if not isinstance(interactions, dict):
+        interactions = {}
+    exports = module.__dict__.get('pymacs_exports')
+    if exports is None:
+        exports = module.__dict__.get('__all__')
+    if exports is None:
+        items = module.__dict__.items()
+    else:
+        items = [(name, module.__dict__.get(name)) for name in exports]
+    # Functions exported by a previous load get reused when possible.
+    key = module.__name__, prefix
+    previous = loaded_exports.get(key, {})
+    exports = {}
+    fresh = []
+    stubs = []
+    for name, value in items:
+        if callable(value) and value is not lisp:
+            try:
+                interaction = value.interaction
+            except AttributeError:
+                interaction = interactions.get(value)
+            symbol = prefix + name.replace('_', '-')
+            if lazy and not callable(interaction):
+                stubs.append(lisp[symbol])
+                stubs.append(name)
+                stubs.append(interaction)
+                continue
+            function = execution_wrapper(module, value)
+            entry = previous.get(symbol)
+            if (entry is not None and python[entry[0]] is entry[1]
+                    and not callable(interaction) and interaction == entry[2]):
+                # Rebind the handle in place, the Lisp function stays.
+                del previous[symbol]
+                python[entry[0]] = function
+                exports[symbol] = entry[0], function, interaction, None
+            else:
+                fresh.append((symbol, function, interaction))
+    # Functions left from the previous load get undefined in Lisp.  Their
+    # handles are not freed here, as Lisp may still hold their trampolines
+    # elsewhere, like in hooks or timers.  Garbage collection frees them
+    # once Lisp drops them, see "pymacs-unexport".
+    symbols = []
+    for symbol, entry in previous.items():
+        if python[entry[0]] is entry[1]:
+            symbols.append(lisp[symbol])
+    arguments = []
+    for symbol, function, interaction in fresh:
+        index = allocate_python(function)
+        if callable(interaction):
+            interaction_index = allocate_python(interaction)
+            arguments += [index, lisp[symbol], interaction_index]
+        else:
+            interaction_index = None
+            arguments += [index, lisp[symbol], interaction]
+        exports[symbol] = index, function, interaction, interaction_index
+    loaded_exports[key] = exports
+    forms = [lisp.progn]
+    if symbols:
+        forms.append([lisp.pymacs_unexport, [lisp.quote, symbols]])
+    if arguments:
+        forms.append([lisp.pymacs_defuns, [lisp.quote, arguments]])
+    if stubs:
+        forms.append([lisp.pymacs_stubs, module.__name__,
+                      [lisp.quote, stubs]])
+    if profile:
+        profile.phase('trampolines')
+        load_profiles.append(profile)
+    if len(forms) > 1:
+        forms.append(module)
+        return forms
+    return [lisp.quote, module]
+
+# For each (MODULE_NAME, PREFIX) given to "pymacs_load_helper", a dictionary
+# of the functions it defined in Lisp.  Each Lisp name is associated with
+# (INDEX, FUNCTION, INTERACTION, INTERACTION_INDEX), where FUNCTION is the
+# handle value, and INTERACTION_INDEX is None unless INTERACTION is callable.
+loaded_exports = {}
+
+
+class Load_Profile:
+
+    # A profile tells where the time went while "pymacs_load_helper" was
+    # loading a module: importing it, running its "pymacs_load_hook", and
+    # preparing trampolines.  While importing, "__import__" is diverted so
+    # nested imports get timed as well, at least those which really load
+    # something.  Only imports from the thread which loads the module are
+    # timed: worker threads might import meanwhile, and are left alone.
+    # Yet, a module they load while a timed import runs is included in that
+    # import.  Emacs later adds the time it took for evaluating the
+    # definitions, through "pymacs_load_profiled".
+
+    def __init__(self, module_name):
+        self.module_name = module_name
+        # Each phase is (TITLE, SECONDS).
+        self.phases = []
+        # Each import is (DEPTH, NAME, SECONDS), in the order they started.
+        self.imports = []
+        self.depth = 0
+        self.start = time.time()
+
+    def phase(self, title):
+        # Close the current phase, giving it TITLE, and start another.
+        now = time.time()
+        self.phases.append((title, now - self.start))
+        self.start = now
+
+    def hook(self):
+        self.thread = threading.current_thread()
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+
+    def unhook(self):
+        builtins.__import__ = self.original_import
+
+    def timed_import(self, name, *arguments, **keywords):
+        if threading.current_thread() is not self.thread:
+            return self.original_import(name, *arguments, **keywords)
+        count = len(sys.modules)
+        index = len(self.imports)
+        self.imports.append(None)
+        self.depth += 1
+        start = time.time()
+        try:
+            return self.original_import(name, *arguments, **keywords)
+        finally:
+            self.depth -= 1
+            if len(sys.modules) == count:
+                # Nothing new was loaded, so nested imports were no-ops.
+                del self.imports[index:]
+            else:
+                if len(arguments) > 2:
+                    fromlist = arguments[2]
+                else:
+                    fromlist = keywords.get('fromlist')
+                if fromlist:
+                    name = 'from %s import %s' % (name or '.',
+                                                 ', '.join(fromlist))
+                self.imports[index] = self.depth, name, time.time() - start
+
+    def report(self, write):
+        total = 0
+        for title, seconds in self.phases:
+            total += seconds
+        write('Module %s, %.1f ms in total\n'
+              % (self.module_name, total * 1000))
+        for title, seconds in self.phases:
+            write('%10.1f ms  %s\n' % (seconds * 1000, title))
+            if title == 'import':
+                for depth, name, seconds in self.imports:
+                    write('%10.1f ms  %s%s\n'
+                          % (seconds * 1000, '  ' * (depth + 1), name))
+
+# Profiles for modules loaded while Emacs asked for it, oldest first.
+load_profiles = []
+
+
+def pymacs_load_profiled(seconds):
+    # Add the time SECONDS taken by Emacs for the latest profiled load.
+    load_profiles[-1].phases.append(('definitions in Emacs', seconds))
+
+
+def pymacs_load_report(reset=False):
+    # Return a textual report of all load profiles.  If RESET, forget them.
+    fragments = []
+    for profile in load_profiles:
+        if fragments:
+            fragments.append('\n')
+        profile.report(fragments.append)
+    if reset:
+        del load_profiles[:]
+    return ''.join(fragments)
+
+
+def pymacs_stub_helper(module_name, name):
+    # Allocate a handle for function NAME within the module MODULE_NAME,
+    # and return its index.  This is called from a stub installed by
+    # "pymacs_load_helper", when it first gets called.
+    module = sys.modules[module_name]
+    return allocate_python(execution_wrapper(module, module.__dict__[name]))
+
+
+def execution_wrapper(module, value):
+    # Return VALUE, a function from MODULE, wrapped according to how it
+    # should execute, see "Thread_Function" and "Process_Function".
+    try:
+        execution = value.execution
+    except AttributeError:
+        executions = module.__dict__.get('executions', {})
+        if not isinstance(executions, dict):
+            executions = {}
+        execution = executions.get(value)
+    if execution == 'thread':
+        return Thread_Function(value)
+    if execution == 'process':
+        return Process_Function(value)
+    return value
+
+
+def module_changed(module, imported):
+    # Tell if the source of MODULE was modified since time IMPORTED.
+    file_name = getattr(module, '__file__', None)
+    if file_name is None:
+        return False
+    if file_name.endswith('.pyc') or file_name.endswith('.pyo'):
+        file_name = file_name[:-1]
+    try:
+        return os.path.getmtime(file_name) > imported
+    except OSError:
+        return False
+
+
+def doc_string(function):
+    import inspect
+    return inspect.getdoc(function)
+
+## Execution of Python functions within worker threads.
+
+# A Python function installed by "pymacs_load_helper" normally runs within
+# the protocol thread, which is the thread reading requests from Emacs.  A
+# function having an "execution" attribute set to 'thread', or associated
+# with 'thread' in the "executions" dictionary of its module, rather runs
+# within a pool of worker threads, so many such functions may progress at
+# once.  Only the protocol thread communicates with Emacs: whenever a worker
+# uses "lisp", the request is queued and the protocol thread, woken up
+# through a pipe, transmits it on behalf of the worker.  The protocol
+# thread only does so while Emacs expects a message from Python, that is,
+# while Emacs waits for the value of a synchronous call, or while it is
+# idle with asynchronous requests still pending.
+
+
+class Thread_Function:
+
+    # Wrap a Python function which should run within the thread pool.  When
+    # called synchronously, Emacs still waits for the returned value, yet the
+    # protocol thread serves all workers meanwhile.
+
+    def __init__(self, function):
+        self.function = function
+        self.__doc__ = getattr(function, '__doc__', None)
+
+    def __call__(self, *arguments):
+        return thread_pool.call(self.function, arguments)
+
+
+class Thread_Pool:
+
+    # Number of worker threads, all started when first needed.
+    size = 4
+
+    def __init__(self):
+        self.threads = []
+        self.main_thread = None
+        # Number of asynchronous requests not replied to yet.
+        self.busy = 0
+        # Each job is a (FUNCTION, ARGUMENTS, REPLY) triplet, where REPLY is
+        # either an asynchronous request identifier, or a list receiving
+        # the outcome of a synchronous call.
+        self.jobs = queue.Queue()
+        # Lisp requests from workers, see "marshal".
+        self.requests = queue.Queue()
+        # (IDENTIFIER, ACTION, VALUE) for asynchronous requests, completed
+        # yet not replied to.
+        self.finished = queue.Queue()
+        self.wake_input = self.wake_output = None
+
+    def start(self):
+        self.main_thread = threading.current_thread()
+        self.wake_input, self.wake_output = os.pipe()
+        for counter in range(self.size):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def in_worker(self):
+        # Tell if the current thread is not the protocol thread.
+        return (bool(self.threads)
+                and threading.current_thread() is not self.main_thread)
+
+    def submit(self, function, arguments, identifier):
+        # Have a worker compute FUNCTION(*ARGUMENTS) for asynchronous request
+        # IDENTIFIER.  The reply to Emacs is sent later, see "wait_input".
+        if not self.threads:
+            self.start()
+        self.busy += 1
+        self.jobs.put((function, arguments, identifier))
+
+    def call(self, function, arguments):
+        # Have a worker compute FUNCTION(*ARGUMENTS), and return its value.
+        if self.in_worker():
+            return function(*arguments)
+        if not self.threads:
+            self.start()
+        outcome = []
+        self.jobs.put((function, arguments, outcome))
+        while not outcome:
+            self.serve()
+        return self.unpack(outcome)
+
+    def marshal(self, function, arguments):
+        # From a worker, have the protocol thread compute
+        # FUNCTION(*ARGUMENTS), and return its value.
+        outcome = []
+        event = threading.Event()
+        self.requests.put((function, arguments, outcome, event))
+        self.wake()
+        event.wait()
+        return self.unpack(outcome)
+
+    def unpack(self, outcome):
+        success, value = outcome[0]
+        if success:
+            return value
+        raise value
+
+    def wake(self):
+        os.write(self.wake_output, '.'.encode('ASCII'))
+
+    def work(self):
+        # This is the main routine of each worker thread.
+        while True:
+            function, arguments, reply = self.jobs.get()
+            if isinstance(reply, list):
+                try:
+                    reply.append((True, function(*arguments)))
+                except:
+                    reply.append((False, sys.exc_info()[1]))
+                self.wake()
+            else:
+                try:
+                    action = 'return'
+                    value = function(*arguments)
+                except:
+                    action = 'raise'
+                    value = format_error()
+                self.complete(reply, action, value)
+
+    def complete(self, identifier, action, value):
+        # Have the protocol thread reply to asynchronous request IDENTIFIER.
+        # When ACTION is 'raise', VALUE may be a (SHORT, LONG) pair of
+        # diagnostics, the protocol thread then chooses which to send.
+        self.finished.put((identifier, action, value))
+        self.wake()
+
+    def serve(self):
+        # In the protocol thread, wait until woken up, then execute all
+        # Lisp requests from workers.  Asynchronous requests completed
+        # meanwhile are left for "wait_input", which checks for them
+        # before waiting, as their wake up may get consumed here.
+        os.read(self.wake_input, 512)
+        while True:
+            try:
+                function, arguments, outcome, event = (
+                    self.requests.get_nowait())
+            except queue.Empty:
+                break
+            try:
+                outcome.append((True, function(*arguments)))
+            except:
+                outcome.append((False, sys.exc_info()[1]))
+            event.set()
+
+    def wait_input(self, protocol):
+        # While PROTOCOL is idle, wait for input from Emacs, meanwhile serving
+        # workers and replying to completed asynchronous requests.
+        import select
+        while True:
+            self.reply_finished(protocol)
+            if not self.busy or protocol.pending:
+                break
+            ready = select.select([protocol.input_fd, self.wake_input],
+                                  [], [])[0]
+            if self.wake_input in ready:
+                self.serve()
+            if protocol.input_fd in ready:
+                self.reply_finished(protocol)
+                break
+
+    def reply_finished(self, protocol):
+        # Through PROTOCOL, reply to all completed asynchronous requests.
+        while True:
+            try:
+                identifier, action, value = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            self.busy -= 1
+            if action == 'raise' and isinstance(value, tuple):
+                value = describe_error(value)
+            protocol.send_async(identifier, action, value)
+
+thread_pool = Thread_Pool()
+
+# A function having an "execution" attribute set to 'process', or
+# associated with 'process' in the "executions" dictionary of its module,
+# runs within a pool of worker processes instead, so CPU-bound functions
+# are not limited by the global interpreter lock.  Arguments and values
+# are pickled, so such functions should only be given and return plain
+# Python values.  Worker processes may not use "lisp".
+
+
+class Process_Function:
+
+    # Wrap a Python function which should run within the process pool.  A
+    # synchronous call waits within a worker thread, so the protocol thread
+    # may still serve other workers meanwhile.
+
+    def __init__(self, function):
+        self.function = function
+        self.__doc__ = getattr(function, '__doc__', None)
+
+    def __call__(self, *arguments):
+        return thread_pool.call(process_pool.apply, (self.function, arguments))
+
+
+class Process_Pool:
+
+    # Number of worker processes, None meaning as many as there are
+    # processors.  Processes are all started when first needed.
+    size = None
+
+    def __init__(self):
+        self.pool = None
+
+    def start(self):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(self.size, ignore_interrupts)
+
+    def apply(self, function, arguments):
+        # Return FUNCTION(*ARGUMENTS), as computed by a worker process.
+        if self.pool is None:
+            self.start()
+        return self.pool.apply(function, arguments)
+
+    def submit(self, function, arguments, identifier):
+        # Have a worker process compute FUNCTION(*ARGUMENTS) for asynchronous
+        # request IDENTIFIER.  The reply goes through the thread pool, which
+        # also lets the protocol thread wait for it.
+        if self.pool is None:
+            self.start()
+        if not thread_pool.threads:
+            thread_pool.start()
+        thread_pool.busy += 1
+
+        def finish(outcome):
+            # This is called within a thread of the process pool, which
+            # may not wait on Emacs.
+            action, value = outcome
+            thread_pool.complete(identifier, action, value)
+
+
+
+        def fail(exception):
+            # The value could not be transmitted back.
+            thread_pool.complete(identifier, 'raise', repr(exception))
+
+        self.pool.apply_async(run_process_job, (function, arguments),
+                              callback=finish, error_callback=fail)
+
+
+
+
+process_pool = Process_Pool()
+
+
+def ignore_interrupts():
+    # Only the Pymacs helper itself should react to Emacs interrupting it.
+    if signal is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_process_job(function, arguments):
+    # Within a worker process, return ('return', VALUE) for the value of
+    # FUNCTION(*ARGUMENTS), or ('raise', (SHORT, LONG)) for a diagnostic,
+    # see "format_error".
+    try:
+        return 'return', function(*arguments)
+    except:
+        return 'raise', format_error()
+
+
+def format_error():
+    # Return (SHORT, LONG) diagnostics for the exception being handled,
+    # without and with the traceback.
+    import traceback
+    short = traceback.format_exception_only(
+        sys.exc_info()[0], sys.exc_info()[1])
+    return ''.join(short).rstrip(), traceback.format_exc()
+
+
+def describe_error(diagnostics=None):
+    # Return a diagnostic to be raised within Emacs, either for the exception
+    # being handled, or chosen within (SHORT, LONG) DIAGNOSTICS.  The full
+    # traceback is only given on `debug-on-error'.  As Emacs gets asked,
+    # this should only be called from the protocol thread.
+    if diagnostics is None:
+        diagnostics = format_error()
+    if lisp.debug_on_error.value() is None:
+        return diagnostics[0]
+    return diagnostics[1]
+
+## Bulk transfer of buffer text.
+
+# Buffer text is normally transmitted as a string, which gets escaped on
+# one side and parsed back on the other.  For big text, the functions below
+# rather have Emacs and Python share a temporary file.  Such files are
+# created in "/dev/shm" whenever it exists, so they likely stay in memory.
+
+# Text having at least this many characters goes through a file.
+bulk_threshold = 65536
+
+if os.path.isdir('/dev/shm'):
+    bulk_directory = '/dev/shm'
+else:
+    bulk_directory = None
+
+
+def get_region(start=None, end=None):
+    """\
+Return the text of the current Emacs buffer, from START to END.  Both
+default to the limits of the accessible portion of the buffer.
+"""
+    text = bulk_region(start, end, bulk_threshold)
+    if not isinstance(text, basestring):
+        mapped = text
+        text = mapped[:].decode('UTF-8')
+        mapped.close()
+    return text
+
+
+def map_region(start=None, end=None):
+    """\
+Return a read-only memory map of the text of the current Emacs buffer,
+from START to END, encoded in UTF-8.  Both default to the limits of the
+accessible portion of the buffer.  The map should be closed when done.
+"""
+    return bulk_region(start, end, 0)
+
+
+def bulk_region(start, end, threshold):
+    # Return the text from START to END, or a memory map of it whenever it
+    # holds at least THRESHOLD characters.
+    import mmap
+    name = bulk_file()
+    try:
+        text = lisp.pymacs_bulk_region(start, end, name, threshold)
+        if text is not None:
+            return text
+        handle = open(name, 'rb')
+        try:
+            size = os.fstat(handle.fileno()).st_size
+            if not size:
+                # An empty file may not be mapped.
+                return handle.read()
+            return mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            handle.close()
+    finally:
+        os.remove(name)
+
+
+def insert_text(text):
+    """\
+Insert TEXT at point within the current Emacs buffer, leaving point
+after it.  TEXT may also be bytes, encoded in UTF-8.
+"""
+    if len(text) < bulk_threshold:
+        if not isinstance(text, basestring):
+            text = text.decode('UTF-8')
+        lisp.insert(text)
+        return
+
+    if isinstance(text, str):
+        text = text.encode('UTF-8')
+
+
+
+    name = bulk_file()
+    try:
+        handle = open(name, 'wb')
+        try:
+            handle.write(text)
+        finally:
+            handle.close()
+        lisp.pymacs_bulk_insert(name)
+    finally:
+        os.remove(name)
+
+
+def bulk_file():
+    # Create a temporary file for bulk transfer, and return its name.
+    import tempfile
+    handle, name = tempfile.mkstemp('.txt', 'pymacs-', bulk_directory)
+    os.close(handle)
+    return name
+
+## Garbage collection matters.
+
+# Many Python types do not have direct Lisp equivalents, and may not be
+# directly returned to Lisp for this reason.  They are rather allocated in
+# a table of handles, below, and a handle index is used for communication
+# instead of the Python value.  Whenever such a handle is freed from the
+# Lisp side, its slot in the table is kept for later reuse.
+
+
+class Handle_Table:
+
+    # Each handle uses a slot in a list, and each slot has a generation,
+    # which changes whenever the slot gets freed.  The generation is packed
+    # within the low order bits of the handle index, so an index which
+    # outlived its object designates "zombie" rather than some unrelated
+    # object reusing the slot, at least until generations wrap around.
+    # Free slots are stacked, and vacant slots at the end of the list are
+    # trimmed away.  Stack entries for slots reserved for zombies, trimmed
+    # away or used again are skipped lazily, so no operation needs to search
+    # the stack, which only gets cleaned once it outgrows the list.
+    # Generations of trimmed slots are kept, so they go on changing once
+    # these slots get used again.
+
+    generation_bits = 8
+    generation_mask = (1 << generation_bits) - 1
+
+    def __init__(self):
+        # Vacant slots hold None, as None is never allocated.
+        self.values = []
+        # May be longer than VALUES, for slots which got trimmed away.
+        self.generations = []
+        self.free = []
+
+    def __getitem__(self, index):
+        slot = index >> self.generation_bits
+        if (slot >= len(self.values)
+                or self.generations[slot] != index & self.generation_mask):
+            return zombie
+        return self.values[slot]
+
+    def __setitem__(self, index, value):
+        # Rebind the live handle INDEX to VALUE.
+        slot = index >> self.generation_bits
+        assert self.generations[slot] == index & self.generation_mask, index
+        self.values[slot] = value
+
+    def allocate(self, value):
+        # Allocate some handle to hold VALUE, return its index.
+        values = self.values
+        free = self.free
+        while free:
+            slot = free.pop()
+            if slot < len(values) and values[slot] is None:
+                values[slot] = value
+                return slot << self.generation_bits | self.generations[slot]
+        slot = len(values)
+        values.append(value)
+        if slot == len(self.generations):
+            self.generations.append(0)
+        return slot << self.generation_bits | self.generations[slot]
+
+    def release(self, indices):
+        # Return many handles to the pool.  Stale indices are ignored.
+        values = self.values
+        generations = self.generations
+        for index in indices:
+            slot = index >> self.generation_bits
+            generation = index & self.generation_mask
+            if (slot < len(values) and generations[slot] == generation
+                    and values[slot] is not None):
+                values[slot] = None
+                generations[slot] = (generation + 1) & self.generation_mask
+                self.free.append(slot)
+        self.trim()
+
+    def reserve(self, indices, value):
+        # Ensure that handles INDICES hold VALUE, and are _not_ in the pool.
+        values = self.values
+        generations = self.generations
+        for index in indices:
+            slot = index >> self.generation_bits
+            while slot >= len(values):
+                if len(values) == len(generations):
+                    generations.append(0)
+                self.free.append(len(values))
+                values.append(None)
+            values[slot] = value
+            generations[slot] = index & self.generation_mask
+
+    def trim(self):
+        # Drop vacant slots at the end of the list, and forget about them,
+        # yet keep their generations: stale indices may still refer to them.
+        values = self.values
+        if values and values[-1] is None:
+            while values and values[-1] is None:
+                values.pop()
+            limit = len(values)
+            if len(self.free) > 2 * limit:
+                # At least half of the entries get dropped, so cleaning
+                # costs a constant time per release, amortised.
+                self.free = [slot for slot in self.free
+                             if slot < limit and values[slot] is None]
+
+python = Handle_Table()
+
+
+def allocate_python(value):
+    assert not isinstance(value, str), (type(value), repr(value))
+    # Allocate some handle to hold VALUE, return its index.
+    return python.allocate(value)
+
+
+def free_python(indices):
+    # Return many handles to the pool.
+    python.release(indices)
+
+
+def zombie_python(indices):
+    # Ensure that some handles are _not_ in the pool.
+    python.reserve(indices, zombie)
+
+
+def zombie(*arguments):
+    # This catch-all function is set as the value for any function which
+    # disappeared with a previous Pymacs helper process, so calling
+    # such a function from Emacs will trigger a decipherable diagnostic.
+    diagnostic = "Object vanished when the Pymacs helper was killed"
+    if lisp.pymacs_dreadful_zombies.value():
+
+
+
+        raise ZombieError(diagnostic)
+    lisp.message(diagnostic)
+
+## Emacs services for Python applications.
+
+
+class Let:
+
+    def __init__(self, **keywords):
+        # The stack holds (METHOD, DATA) pairs, where METHOD is the expected
+        # unbound pop_* method, and DATA holds information to be restored.
+        # METHOD may not be bound to the instance, as this would induce
+        # reference cycles, and then, __del__ would not be called timely.
+        self.stack = []
+        if keywords:
+            self.push(**keywords)
+
+    def __del__(self):
+        self.pops()
+
+
+    def __bool__(self):
+        # So stylistic `if let:' executes faster.
+        return True
+
+
+
+
+
+    def pops(self):
+        while self.stack:
+            self.stack[-1][0](self)
+
+    def push(self, **keywords):
+        data = []
+        for name, value in keywords.items():
+            data.append((name, getattr(lisp, name).value()))
+            setattr(lisp, name, value)
+        self.stack.append((Let.pop, data))
+        return self
+
+    def pop(self):
+        method, data = self.stack.pop()
+        assert method == Let.pop, (method, data)
+        for name, value in data:
+            setattr(lisp, name, value)
+
+    def push_excursion(self):
+        self.stack.append((Let.pop_excursion, (lisp.current_buffer(),
+                                               lisp.point_marker(),
+                                               lisp.mark_marker())))
+        return self
+
+    def pop_excursion(self):
+        method, data = self.stack.pop()
+        assert method == Let.pop_excursion, (method, data)
+        buffer, point_marker, mark_marker = data
+        lisp.set_buffer(buffer)
+        lisp.goto_char(point_marker)
+        lisp.set_mark(mark_marker)
+        lisp.set_marker(point_marker, None)
+        lisp.set_marker(mark_marker, None)
+
+    def push_match_data(self):
+        self.stack.append((Let.pop_match_data, lisp.match_data()))
+        return self
+
+    def pop_match_data(self):
+        method, data = self.stack.pop()
+        assert method == Let.pop_match_data, (method, data)
+        lisp.set_match_data(data)
+
+    def push_restriction(self):
+        self.stack.append((Let.pop_restriction, (lisp.point_min_marker(),
+                                                 lisp.point_max_marker())))
+        return self
+
+    def pop_restriction(self):
+        method, data = self.stack.pop()
+        assert method == Let.pop_restriction, (method, data)
+        point_min_marker, point_max_marker = data
+        lisp.narrow_to_region(point_min_marker, point_max_marker)
+        lisp.set_marker(point_min_marker, None)
+        lisp.set_marker(point_max_marker, None)
+
+    def push_selected_window(self):
+        self.stack.append((Let.pop_selected_window, lisp.selected_window()))
+        return self
+
+    def pop_selected_window(self):
+        method, data = self.stack.pop()
+        assert method == Let.pop_selected_window, (method, data)
+        lisp.select_window(data)
+
+    def push_window_excursion(self):
+        self.stack.append((Let.pop_window_excursion,
+                           lisp.current_window_configuration()))
+        return self
+
+    def pop_window_excursion(self):
+        method, data = self.stack.pop()
+        assert method == Let.pop_window_excursion, (method, data)
+        lisp.set_window_configuration(data)
+
+
+class Batch:
+
+    # While a batch is active, calling a Lisp function does not wait for
+    # Emacs.  The call is rather queued, and a Deferred is returned in place
+    # of its value.  All queued calls are sent together, in a single round
+    # trip, whenever the batch gets flushed: on exit, when the queue reaches
+    # LIMIT calls, when the value of a Deferred is needed, or before any
+    # other Lisp evaluation.  A batch is activated by a "with" statement.
+    # When the statement exits through an exception, queued calls are
+    # discarded rather than sent.
+
+    def __init__(self, limit=1000):
+        self.limit = limit
+        self.calls = []
+        self.deferreds = []
+        self.previous = None
+
+    def __enter__(self):
+        if thread_pool.in_worker():
+            diagnostic = "Batch may not be used within a worker thread"
+
+
+
+            raise BatchError(diagnostic)
+        protocol = lisp._protocol
+        if protocol.batch is not None:
+            protocol.batch.flush()
+        self.previous = protocol.batch
+        protocol.batch = self
+        return self
+
+    def __exit__(self, *exception):
+        protocol = lisp._protocol
+        try:
+            if exception[0] is None:
+                self.flush()
+            else:
+                self.calls = []
+                self.deferreds = []
+        finally:
+            protocol.batch = self.previous
+            self.previous = None
+
+    def call(self, function, arguments):
+        # Queue a call to FUNCTION over ARGUMENTS, return its Deferred.
+        arguments = list(arguments)
+        for index, argument in enumerate(arguments):
+            if isinstance(argument, Deferred):
+                arguments[index] = argument.value()
+        if lisp._protocol.binary:
+            self.calls.append(encode_call(function, arguments))
+        else:
+            fragments = ['(']
+            write = fragments.append
+            print_lisp(function, write, False)
+            for argument in arguments:
+                write(' ')
+                print_lisp(argument, write, True)
+            write(')')
+            self.calls.append(''.join(fragments))
+        deferred = Deferred(self)
+        self.deferreds.append(deferred)
+        if len(self.calls) >= self.limit:
+            self.flush()
+        return deferred
+
+    def flush(self):
+        # Send all queued calls to Emacs, and resolve their Deferreds.
+        calls = self.calls
+        deferreds = self.deferreds
+        if not calls:
+            return
+        self.calls = []
+        self.deferreds = []
+        protocol = lisp._protocol
+        if protocol.binary:
+
+            text = (('l%d:y4:list' % (len(calls) + 1)).encode('ASCII')
+                    + b''.join(calls))
+
+
+        else:
+            text = '(list %s)' % ' '.join(calls)
+        # Python code called back by Emacs is not part of this batch.
+        batch = protocol.batch
+        protocol.batch = None
+        try:
+            protocol.send('batch', text)
+            values = protocol.loop()
+        finally:
+            protocol.batch = batch
+        for deferred, value in zip(deferreds, values):
+            deferred.result = value
+            deferred.done = True
+
+
+class Deferred:
+
+    # The eventual value of a Lisp function call queued within a Batch.
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.done = False
+        self.result = None
+
+    def __repr__(self):
+        if self.done:
+            return '<Deferred %r>' % (self.result,)
+        return '<Deferred>'
+
+    def value(self):
+        if not self.done:
+            self.batch.flush()
+            if not self.done:
+                diagnostic = "Batched call did not complete"
+
+
+
+                raise BatchError(diagnostic)
+        return self.result
+
+
+class Symbol:
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return 'lisp[%s]' % repr(self.text)
+
+    def __str__(self):
+        return '\'' + self.text
+
+    def value(self):
+        return lisp._eval(self.text)
+
+    def copy(self):
+        return lisp._expand(self.text)
+
+    def set(self, value):
+        if value is None:
+            lisp._eval('(setq %s nil)' % self.text)
+        else:
+            fragments = []
+            write = fragments.append
+            write('(progn (setq %s ' % self.text)
+            print_lisp(value, write, True)
+            write(') nil)')
+            lisp._eval(''.join(fragments))
+
+    def __call__(self, *arguments):
+        # Calls from worker threads are never queued, see "Batch".
+        if (lisp._protocol.batch is not None
+                and not thread_pool.in_worker()):
+            return lisp._protocol.batch.call(self, arguments)
+        if lisp._protocol.binary:
+            return lisp._eval_call(self, arguments)
+        fragments = []
+        write = fragments.append
+        write('(%s' % self.text)
+        for argument in arguments:
+            write(' ')
+            print_lisp(argument, write, True)
+        write(')')
+        return lisp._eval(''.join(fragments))
+
+
+class Lisp:
+    # When SNAPSHOT is not None, it holds a Python copy of the Emacs Lisp
+    # value, fetched at once by cache() or refresh(), from which sequence
+    # reads are then served without any round trip to Emacs.  Writes through
+    # the handle go to Emacs and update the snapshot as well, but Emacs Lisp
+    # changes made otherwise are not seen until refresh() or invalidate().
+
+    snapshot = None
+
+    def __init__(self, index):
+        self.index = index
+
+    def __del__(self):
+        lisp._protocol.freed.append(self.index)
+
+    def __repr__(self):
+        return ('lisp(%s)' % repr(lisp('(prin1-to-string %s)' % self)))
+
+    def __str__(self):
+        return '(aref pymacs-lisp %d)' % self.index
+
+    def value(self):
+        return self
+
+    def copy(self):
+        return lisp._expand(str(self))
+
+    def cache(self):
+        if self.snapshot is None:
+            self.refresh()
+        return self
+
+    def refresh(self):
+        self.snapshot = self.copy()
+        return self
+
+    def invalidate(self):
+        self.snapshot = None
+        return self
+
+
+class Buffer(Lisp):
+    pass
+
+    #def write(text):
+    #    # So you could do things like
+    #    # print >>lisp.current_buffer(), "Hello World"
+    #    lisp.insert(text, self)
+
+    #def point(self):
+    #    return lisp.point(self)
+
+
+class List(Lisp):
+
+    def __call__(self, *arguments):
+        if lisp._protocol.batch is not None:
+            return lisp._protocol.batch.call(self, arguments)
+        if lisp._protocol.binary:
+            return lisp._eval_call(self, arguments)
+        fragments = []
+        write = fragments.append
+        write('(%s' % self)
+        for argument in arguments:
+            write(' ')
+            print_lisp(argument, write, True)
+        write(')')
+        return lisp._eval(''.join(fragments))
+
+    def __len__(self):
+        if self.snapshot is not None:
+            return len(self.snapshot)
+        return lisp._eval('(length %s)' % self)
+
+    def __iter__(self):
+        if self.snapshot is not None:
+            return iter(self.snapshot)
+        return iter(lisp._elements('(append %s nil)' % self))
+
+    def __getitem__(self, key):
+        if self.snapshot is not None:
+            return self.snapshot[key]
+        value = lisp._eval('(nth %d %s)' % (key, self))
+        if value is None and key >= len(self):
+
+
+
+            raise IndexError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        fragments = []
+        write = fragments.append
+        write('(setcar (nthcdr %d %s) ' % (key, self))
+        print_lisp(value, write, True)
+        write(')')
+        lisp._eval(''.join(fragments))
+        if self.snapshot is not None:
+            self.snapshot[key] = value
+
+
+class Table(Lisp):
+
+    def __len__(self):
+        if self.snapshot is not None:
+            return len(self.snapshot)
+        return lisp._eval('(hash-table-count %s)' % self)
+
+    def __getitem__(self, key):
+        if self.snapshot is not None:
+            return self.snapshot.get(key)
+        fragments = []
+        write = fragments.append
+        write('(gethash ')
+        print_lisp(key, write, True)
+        write(' %s)' % self)
+        return lisp._eval(''.join(fragments))
+
+    def __setitem__(self, key, value):
+        fragments = []
+        write = fragments.append
+        write('(puthash ')
+        print_lisp(key, write, True)
+        write(' ')
+        print_lisp(value, write, True)
+        write(' %s)' % self)
+        lisp._eval(''.join(fragments))
+        if self.snapshot is not None:
+            self.snapshot[key] = value
+
+    def refresh(self):
+        # Python equality of keys may only stand for "equal", and keys
+        # should expand to integers, strings or symbols, so they may index
+        # a Python dictionary.  Floats and t would compare equal to some
+        # integers in Python, and be merged with them.  Otherwise, the table
+        # does not get any snapshot, and reads keep going to Emacs.
+        pairs = lisp._expand(
+            '(cons (eq (hash-table-test %s) \'equal)'
+            ' (let (pairs)'
+            ' (maphash (lambda (key value)'
+            ' (setq pairs (cons (list key value) pairs)))'
+            ' %s) pairs))' % (self, self))
+        self.snapshot = None
+        if pairs[0]:
+            for key, value in pairs[1:]:
+                if isinstance(key, (bool, float, list, tuple, Lisp)):
+                    return self
+            snapshot = dict(pairs[1:])
+            if len(snapshot) == len(pairs) - 1:
+                self.snapshot = snapshot
+        return self
+
+
+class Vector(Lisp):
+
+    def __len__(self):
+        if self.snapshot is not None:
+            return len(self.snapshot)
+        return lisp._eval('(length %s)' % self)
+
+    def __iter__(self):
+        if self.snapshot is not None:
+            return iter(self.snapshot)
+        return iter(lisp._elements('(append %s nil)' % self))
+
+    def __getitem__(self, key):
+        if self.snapshot is not None:
+            return self.snapshot[key]
+        return lisp._eval('(aref %s %d)' % (self, key))
+
+    def __setitem__(self, key, value):
+        fragments = []
+        write = fragments.append
+        write('(aset %s %d ' % (self, key))
+        print_lisp(value, write, True)
+        write(')')
+        lisp._eval(''.join(fragments))
+        if self.snapshot is not None:
+            self.snapshot[key] = value
+
+    def refresh(self):
+        # Vectors expand into tuples, a list allows for updating in place.
+        self.snapshot = list(self.copy())
+        return self
+
+
+class Lisp_Interface:
+
+    def __init__(self):
+        self.__dict__['_cache'] = {'nil': None}
+        self.__dict__['_protocol'] = Protocol()
+
+    def __call__(self, text):
+        return self._eval('(progn %s)' % text)
+
+    def _eval(self, text):
+        if thread_pool.in_worker():
+            return thread_pool.marshal(self._eval, (text,))
+        if self._protocol.batch is not None:
+            self._protocol.batch.flush()
+        self._protocol.send('eval', self._protocol.source(text))
+        return self._protocol.loop()
+
+    def _eval_call(self, function, arguments):
+        # Only used with the binary protocol, which does not need Lisp text.
+        if thread_pool.in_worker():
+            return thread_pool.marshal(self._eval_call, (function, arguments))
+        self._protocol.send('eval', encode_call(function, arguments))
+        return self._protocol.loop()
+
+    def _expand(self, text):
+        if thread_pool.in_worker():
+            return thread_pool.marshal(self._expand, (text,))
+        if self._protocol.batch is not None:
+            self._protocol.batch.flush()
+        self._protocol.send('expand', self._protocol.source(text))
+        return self._protocol.loop()
+
+    def _elements(self, text):
+        # Same as "_eval", for TEXT giving a Lisp list, but return a tuple
+        # of its elements, each transmitted as if fetched separately.
+        if thread_pool.in_worker():
+            return thread_pool.marshal(self._elements, (text,))
+        if self._protocol.batch is not None:
+            self._protocol.batch.flush()
+        self._protocol.send('batch', self._protocol.source(text))
+        return self._protocol.loop()
+
+    def __getattr__(self, name):
+        if name[0] == '_':
+
+
+
+            raise AttributeError(name)
+        return self[name.replace('_', '-')]
+
+    def __setattr__(self, name, value):
+        if name[0] == '_':
+
+
+
+            raise AttributeError(name)
+        self[name.replace('_', '-')] = value
+
+    def __getitem__(self, name):
+        try:
+            return self._cache[name]
+        except KeyError:
+            symbol = self._cache[name] = Symbol(name)
+            return symbol
+
+    def __setitem__(self, name, value):
+        try:
+            symbol = self._cache[name]
+        except KeyError:
+            symbol = self._cache[name] = Symbol(name)
+        symbol.set(value)
+
+lisp = Lisp_Interface()
+
+# Strings are escaped as a whole and written as a single fragment.  Plain
+# ASCII text usually has only a few specials, which "str.replace" escapes
+# quickly, while control characters (and non-ASCII bytes within Python 2
+# strings) are rarer and left to a slower regular expression.  The UTF-8
+# bytes of a multibyte string are rather all mapped through
+# "print_lisp_byte_table", indexed by byte.
+
+print_lisp_controls = re.compile(r'[\x00-\x1f\x7f-\xff]')
+
+
+def print_lisp_escape_ascii(value):
+    # Return VALUE, an ASCII string, escaped for a Lisp string.
+    value = (value.replace('\\', '\\\\').replace('"', '\\"')
+             .replace('\n', '\\n').replace('\t', '\\t')
+             .replace('\r', '\\r').replace('\b', '\\b')
+             .replace('\f', '\\f'))
+    if print_lisp_controls.search(value):
+        value = print_lisp_controls.sub(
+            lambda match: '\\%.3o' % ord(match.group()), value)
+    return value
+
+print_lisp_byte_table = ['\\%.3o' % code for code in range(256)]
+for code in range(32, 127):
+    print_lisp_byte_table[code] = chr(code)
+for character, escape in zip('"\\\b\f\n\r\t', '"\\bfnrt'):
+    print_lisp_byte_table[ord(character)] = '\\' + escape
+del code, character, escape
+
+
+
+def print_lisp_string(value, write):
+    try:
+        value.encode('ASCII')
+    except UnicodeError:
+        write('(decode-coding-string "'
+              + ''.join(map(print_lisp_byte_table.__getitem__,
+                            value.encode('UTF-8')))
+              + '" \'utf-8)')
+    else:
+        write('"' + print_lisp_escape_ascii(value) + '"')
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def print_lisp(value, write, quoted):
+    # Write VALUE as Lisp source through WRITE, quoting it when QUOTED.
+    # Lists and tuples are walked using an explicit stack rather than
+    # recursively, so deeply nested values do not exhaust the Python stack.
+    # ELEMENTS iterates over what remains to print in the current sequence,
+    # CLOSING is the text ending that sequence, and its IDENTITY stays in
+    # OPENED while it is being printed.  The stack saves these for the
+    # enclosing sequences.  VALUE itself is seen as a sequence of one.
+    stack = []
+    opened = set()
+    elements = iter((value,))
+    closing = identity = None
+    first = True
+    while True:
+        for value in elements:
+            if first:
+                first = False
+            else:
+                write(' ')
+            if value is None:
+                write('nil')
+            elif isinstance(bool, type) and isinstance(value, bool):
+                write(('nil', 't')[value])
+            elif isinstance(value, int):
+                write(repr(value))
+            elif isinstance(value, float):
+                write(repr(value))
+            elif isinstance(value, basestring):
+                print_lisp_string(value, write)
+            elif isinstance(value, list):
+                if quoted:
+                    write("'")
+                if len(value) == 0:
+                    write('nil')
+                else:
+                    stack.append((elements, closing, identity))
+                    identity = id(value)
+                    if identity in opened:
+                        print_lisp_circular()
+                    opened.add(identity)
+                    if len(value) == 2 and value[0] == lisp.quote:
+                        write("'")
+                        elements = islice(value, 1, None)
+                        closing = None
+                    else:
+                        write('(')
+                        elements = iter(value)
+                        closing = ')'
+                    first = True
+                    quoted = False
+                    break
+            elif isinstance(value, tuple):
+                if len(value) == 0:
+                    write('[]')
+                else:
+                    stack.append((elements, closing, identity))
+                    identity = id(value)
+                    if identity in opened:
+                        print_lisp_circular()
+                    opened.add(identity)
+                    write('[')
+                    elements = iter(value)
+                    closing = ']'
+                    first = True
+                    quoted = False
+                    break
+            elif isinstance(value, Lisp):
+                write(str(value))
+            elif isinstance(value, Symbol):
+                if quoted:
+                    write("'")
+                write(value.text)
+            elif callable(value):
+                write('(pymacs-defun %d nil)' % allocate_python(value))
+            else:
+                write('(pymacs-python %d)' % allocate_python(value))
+        else:
+            # The current sequence is exhausted.
+            if closing is not None:
+                write(closing)
+            if not stack:
+                return
+            opened.remove(identity)
+            elements, closing, identity = stack.pop()
+
+
+def print_lisp_circular():
+    # A sequence being printed contains itself.
+
+
+
+    raise ValueError("Circular structure may not go to Lisp.")
+
+## Binary protocol.
+
+# Once negotiated at start time, the binary protocol replaces Lisp and
+# Python source text by tagged values, which either side decodes without
+# having to compile or parse source code.  Numbers are written in decimal
+# and terminated by `;', while strings, symbols and sequences have their
+# length in decimal, terminated by `:', before their contents.  Strings
+# are UTF-8 encoded.  The tags are:
+#
+#   n  nil or None            t  t or True
+#   iN;  integer              fX;  float
+#   sN:  string               yN:  symbol
+#   lN:  list of N values     vN:  vector of N values (tuple in Python)
+#   '  quoted Lisp value      rN:  Lisp source text (read by Emacs)
+#   pN;  Python handle        dN;  Python callable handle
+#   HN;  Lisp handle          LN;  VN;  TN;  BN;  handle for a Lisp list,
+#                             vector, hash table or buffer
+#
+# From Python to Emacs, values are encoded as Lisp forms, for Emacs to
+# evaluate just like what the text protocol would have `read'.
+
+
+def encode_float(value):
+    # Return the decimal text of VALUE, a float, for Emacs to read.  Emacs
+    # writes infinities and NaNs as 1.0e+INF, -1.0e+INF and 0.0e+NaN.
+    if value * 0 == 0:
+        return repr(value)
+    if value != value:
+        return '0.0e+NaN'
+    if value > 0:
+        return '1.0e+INF'
+    return '-1.0e+INF'
+
+
+def decode_float(text):
+    # Return the float for TEXT, some decimal number written by Emacs.
+    if text.endswith('e+INF'):
+        if text.startswith('-'):
+            return float('-inf')
+        return float('inf')
+    if text.endswith('e+NaN'):
+        return float('nan')
+    return float(text)
+
+
+
+def encode_lisp(value, write, quoted):
+    # Same as "print_lisp", but for the binary protocol.  Sequences are
+    # prefixed with their length, so nothing closes them.
+    stack = []
+    opened = set()
+    elements = iter((value,))
+    identity = None
+    while True:
+        for value in elements:
+            if value is None:
+                write(b'n')
+            elif isinstance(value, bool):
+                write((b'n', b't')[value])
+            elif isinstance(value, int):
+                write(('i%d;' % value).encode('ASCII'))
+            elif isinstance(value, float):
+                write(('f%s;' % encode_float(value)).encode('ASCII'))
+            elif isinstance(value, str):
+                data = value.encode('UTF-8')
+                write(('s%d:' % len(data)).encode('ASCII'))
+                write(data)
+            elif isinstance(value, list):
+                if quoted:
+                    write(b"'")
+                if len(value) == 0:
+                    write(b'n')
+                else:
+                    stack.append((elements, identity))
+                    identity = id(value)
+                    if identity in opened:
+                        print_lisp_circular()
+                    opened.add(identity)
+                    if len(value) == 2 and value[0] == lisp.quote:
+                        write(b"'")
+                        elements = islice(value, 1, None)
+                    else:
+                        write(('l%d:' % len(value)).encode('ASCII'))
+                        elements = iter(value)
+                    quoted = False
+                    break
+            elif isinstance(value, tuple):
+                write(('v%d:' % len(value)).encode('ASCII'))
+                if len(value) > 0:
+                    stack.append((elements, identity))
+                    identity = id(value)
+                    if identity in opened:
+                        print_lisp_circular()
+                    opened.add(identity)
+                    elements = iter(value)
+                    quoted = False
+                    break
+            elif isinstance(value, Lisp):
+                write(('H%d;' % value.index).encode('ASCII'))
+            elif isinstance(value, Symbol):
+                if quoted:
+                    write(b"'")
+                data = value.text.encode('UTF-8')
+                write(('y%d:' % len(data)).encode('ASCII'))
+                write(data)
+            elif callable(value):
+                write(('d%d;' % allocate_python(value)).encode('ASCII'))
+            else:
+                write(('p%d;' % allocate_python(value)).encode('ASCII'))
+        else:
+            # The current sequence is exhausted.
+            if not stack:
+                return
+            opened.remove(identity)
+            elements, identity = stack.pop()
+
+def encode_call(function, arguments):
+    # Return the encoded Lisp form applying FUNCTION over ARGUMENTS.
+    fragments = [('l%d:' % (len(arguments) + 1)).encode('ASCII')]
+    write = fragments.append
+    encode_lisp(function, write, False)
+    for argument in arguments:
+        encode_lisp(argument, write, True)
+    return b''.join(fragments)
+
+def decode_lisp(data):
+    # Return the Python value for DATA, some value encoded by Emacs.
+    value, position = decode_lisp_at(data, 0)
+    return value
+
+def decode_lisp_at(data, position):
+    # Decode the value at POSITION in DATA, return (VALUE, POSITION).
+    # Sequences are decoded using an explicit stack rather than
+    # recursively, see "print_lisp".  KIND is the tag of the current
+    # sequence, REMAINING tells how many of its elements are still to
+    # decode, and VALUES holds those already decoded.  The stack saves
+    # these for enclosing sequences.  The value itself is seen as the
+    # only element of a sequence.
+    stack = []
+    kind = None
+    values = []
+    remaining = 1
+    while True:
+        if remaining == 0:
+            # The current sequence is complete.
+            if not stack:
+                return values[0], position
+            if kind == b'v':
+                value = tuple(values)
+            else:
+                value = values
+            kind, values, remaining = stack.pop()
+            values.append(value)
+            continue
+        remaining -= 1
+        tag = data[position:position + 1]
+        position += 1
+        if tag == b'n':
+            values.append(None)
+        elif tag == b't':
+            values.append(True)
+        elif tag in (b'i', b'f', b'p', b'H', b'L', b'V', b'T', b'B'):
+            end = data.index(b';', position)
+            number = data[position:end]
+            position = end + 1
+            if tag == b'i':
+                values.append(int(number))
+            elif tag == b'f':
+                values.append(decode_float(number.decode('ASCII')))
+            elif tag == b'p':
+                values.append(python[int(number)])
+            else:
+                values.append(decode_lisp_classes[tag](int(number)))
+        elif tag in (b's', b'y', b'l', b'v'):
+            end = data.index(b':', position)
+            size = int(data[position:end])
+            position = end + 1
+            if tag == b's':
+                end = position + size
+                try:
+                    values.append(data[position:end].decode('UTF-8'))
+                except UnicodeDecodeError:
+                    values.append(
+                        data[position:end].decode('ISO-8859-1'))
+                position = end
+            elif tag == b'y':
+                end = position + size
+                values.append(lisp[data[position:end].decode('UTF-8')])
+                position = end
+            else:
+                stack.append((kind, values, remaining))
+                kind = tag
+                values = []
+                remaining = size
+        else:
+            raise ProtocolError("Invalid binary tag %r" % tag)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+decode_lisp_classes = {b'H': Lisp, b'L': List, b'V': Vector,
+                       b'T': Table, b'B': Buffer}
+
+
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,1906 @@
+;;; pymacs.el --- Interface between Emacs Lisp and Python
+
+;; Copyright © 2001-2003, 2012, 2013 Progiciels Bourbeau-Pinard inc.
+
+;; Author: François Pinard <pinard@iro.umontreal.ca>
+;; Maintainer: François Pinard <pinard@iro.umontreal.ca>
+;; URL: https://github.com/pinard/Pymacs
+;; Version: 0.25
+;; Keywords: Python interface protocol
+
+;; This program is free software; you can redistribute it and/or modify
+;; it under the terms of the GNU General Public License as published by
+;; the Free Software Foundation; either version 2, or (at your option)
+;; any later version.
+;;
+;; This program is distributed in the hope that it will be useful,
+;; but WITHOUT ANY WARRANTY; without even the implied warranty of
+;; MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+;; GNU General Public License for more details.
+;;
+;; You should have received a copy of the GNU General Public License
+;; along with this program; if not, write to the Free Software Foundation,
+;; Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+;;; Commentary:
+
+;; Pymacs is a powerful tool which, once started from Emacs, allows
+;; both-way communication between Emacs Lisp and Python.  Pymacs aims
+;; Python as an extension language for Emacs rather than the other way
+;; around.  Visit http://pymacs.progiciels-bpi.ca to read its manual,
+;; which also contains installation instructions.
+
+;;; Code:
+
+;; The code is organized into pages, grouping declarations by topic.
+;; Such pages are introduced by a form feed and a topic description.
+
+;;; Portability stunts.
+
+(defvar pymacs-use-hash-tables
+  (and (fboundp 'make-hash-table) (fboundp 'gethash) (fboundp 'puthash))
+  "Set to t if hash tables are available.")
+
+(eval-and-compile
+
+  ;; pymacs-called-interactively-p
+  (defalias 'pymacs-called-interactively-p
+    (cond ((fboundp 'called-interactively-p) 'called-interactively-p)
+          ;; Emacs before 22.
+          (t 'interactive-p)))
+
+  ;; pymacs-cancel-timer
+  (defalias 'pymacs-cancel-timer
+    (cond ((fboundp 'cancel-timer) 'cancel-timer)
+          ;; XEmacs case - yet having post-gc-hook, this is unused.
+          ((fboundp 'delete-itimer) 'delete-itimer)
+          (t 'ignore)))
+
+  ;; pymacs-kill-without-query
+  (if (fboundp 'set-process-query-on-exit-flag)
+      (defun pymacs-kill-without-query (process)
+        "Tell recent Emacs how to quickly destroy PROCESS while exiting."
+        (set-process-query-on-exit-flag process nil))
+    (defalias 'pymacs-kill-without-query
+      (if (fboundp 'process-kill-without-query-process)
+          'process-kill-without-query-process
+        'ignore)))
+
+  ;; pymacs-multibyte-string-p
+  (cond ((fboundp 'multibyte-string-p)
+         (defalias 'pymacs-multibyte-string-p 'multibyte-string-p))
+        ((fboundp 'find-charset-string)
+         (defun pymacs-multibyte-string-p (string)
+           "Tell XEmacs if STRING should be handled as multibyte."
+           (not (member (find-charset-string string) '(nil (ascii))))))
+        (t
+         ;; Tell XEmacs that STRING is unibyte, when Mule is not around!
+         (defalias 'pymacs-multibyte-string-p 'ignore)))
+
+  ;; pymacs-report-error
+  (defalias 'pymacs-report-error (symbol-function 'error))
+
+  ;; pymacs-set-buffer-multibyte
+  (if (fboundp 'set-buffer-multibyte)
+      (defalias 'pymacs-set-buffer-multibyte 'set-buffer-multibyte)
+    (defun pymacs-set-buffer-multibyte (flag)
+      "For use in Emacs 20.2 or earlier.  Under XEmacs: no operation."
+      (setq enable-multibyte-characters flag)))
+
+  ;; pymacs-substring-no-properties
+  (if (fboundp 'substring-no-properties)
+      (defalias 'pymacs-substring-no-properties 'substring-no-properties)
+    (defun pymacs-substring-no-properties (string &optional from to)
+      "Return a substring of STRING, without text properties."
+      (let ((text (substring string (or from 0) to)))
+        (set-text-properties 0 (length text) nil text)
+        text)))
+
+  ;; pymacs-timerp
+  (defalias 'pymacs-timerp
+    (cond ((fboundp 'timerp) 'timerp)
+          ;; XEmacs case - yet having post-gc-hook, this is unused.
+          ((fboundp 'itimerp) 'itimerp)
+          (t 'ignore)))
+
+  )
+
+;;; Published variables and functions.
+
+(defvar pymacs-python-command "python"
+  "Shell command used to start Python interpreter.")
+
+(defvar pymacs-load-path nil
+  "List of additional directories to search for Python modules.
+The directories listed will be searched first, in the order given.")
+
+(defvar pymacs-helper-socket nil
+  "Unix socket where a Pymacs helper server listens, or nil.
+When this variable is nil, Emacs launches its own Pymacs helper.  Otherwise,
+Emacs rather connects to a server started beforehand with the `-u SOCKET'
+option, which forks a fresh Pymacs helper for each connection.  Modules
+which the server imported before forking need not be imported again.")
+
+(defvar pymacs-zygote nil
+  "Non-nil means that Pymacs helpers get forked by a zygote.
+Emacs then launches a Pymacs helper server of its own, the zygote, which
+forks a Pymacs helper whenever one is needed.  Each module loaded with
+`pymacs-load' also gets imported in the zygote, so later helpers inherit
+it, and restarting the Pymacs helper is nearly instantaneous.  This
+variable has no effect when `pymacs-helper-socket' is set.")
+
+(defvar pymacs-trace-transit '(5000 . 30000)
+  "Keep the communication buffer growing, for debugging.
+When this variable is nil, the `*Pymacs*' communication buffer gets erased
+before each communication round-trip.  Setting it to `t' guarantees that
+the full communication is saved, which is useful for debugging.
+It could also be given as (KEEP . LIMIT): whenever the buffer exceeds LIMIT
+bytes, it is reduced to approximately KEEP bytes.")
+
+(defvar pymacs-protocol 'text
+  "Protocol used with the Pymacs helper, either `text' or `binary'.
+With `text', each side sends program text for the other side to parse
+and evaluate.  With `binary', values are rather transmitted in a tagged
+and length-prefixed encoding, which is faster to produce and decode.
+The protocol is selected whenever the Pymacs helper starts.")
+
+(defvar pymacs-transport 'buffer
+  "How Emacs gathers messages from the Pymacs helper, `buffer' or `string'.
+With `buffer', the whole communication goes through the `*Pymacs*' buffer,
+which keeps a trace as directed by `pymacs-trace-transit'.  With `string',
+a process filter gathers what Python sends in a string, requests are
+prepared in a scratch buffer, and `*Pymacs*' stays empty.  The latest
+messages are then kept in a ring, see `pymacs-trace-ring-size'.
+The transport is selected whenever the Pymacs helper starts.")
+
+(defvar pymacs-trace-ring-size 0
+  "How many of the latest messages to keep, with the `string' transport.
+When positive, that many messages are kept in a ring, in both directions,
+and `pymacs-show-transit' displays them.  This is meant for debugging.")
+
+(defvar pymacs-forget-mutability nil
+  "Transmit copies to Python instead of Lisp handles, as much as possible.
+When this variable is nil, most mutable objects are transmitted as handles.
+This variable is meant to be temporarily rebound to force copies.")
+
+(defvar pymacs-mutable-strings nil
+  "Prefer transmitting Lisp strings to Python as handles.
+When this variable is nil, strings are transmitted as copies, and the
+Python side thus has no way for modifying the original Lisp strings.
+This variable is ignored whenever `forget-mutability' is set.")
+
+(defvar pymacs-timeout-at-start 30
+  "Maximum reasonable time, in seconds, for starting the Pymacs helper.
+A machine should be pretty loaded before one needs to increment this.")
+
+(defvar pymacs-timeout-at-reply 5
+  "Expected maximum time, in seconds, to get the first line of a reply.
+The status of the Pymacs helper is checked at every such timeout.")
+
+(defvar pymacs-timeout-at-line 2
+  "Expected maximum time, in seconds, to get another line of a reply.
+The status of the Pymacs helper is checked at every such timeout.")
+
+(defvar pymacs-auto-restart 'ask
+  "Should the Pymacs helper be restarted whenever it dies?
+Possible values are nil, t or ask.")
+
+(defvar pymacs-dreadful-zombies nil
+  "If zombies should trigger hard errors, whenever they get called.
+If `nil', calling a zombie will merely produce a diagnostic message.")
+
+(defvar pymacs-load-history nil "Pymacs loading history.")
+
+(defvar pymacs-lazy-load nil
+  "Non-nil means that `pymacs-load' only installs stubs for Python functions.
+A stub gets replaced by the real Lisp function, which requires a handle on
+the Python side, only when it is first called.  Functions whose interaction
+is given by a Python function are nevertheless defined right away.")
+
+(defvar pymacs-profile-load nil
+  "Non-nil means that `pymacs-load' measures where loading time goes.
+Importing the Python module, including nested imports, running its
+`pymacs_load_hook', preparing trampolines and defining them in Emacs
+are timed separately.  See `pymacs-load-report'.")
+
+(defvar pymacs-after-load-functions nil
+  "Special hook run after loading a Python module.
+Each function there is called with a single argument, the Python
+module name passed to as the first argument of `pymacs-load'.")
+
+;;;###autoload
+(defun pymacs-load (module &optional prefix noerror)
+  "Import the Python module named MODULE into Emacs.
+Each function in the Python module is made available as an Emacs function.
+If the module has a `pymacs_exports' or else an `__all__' list, only the
+functions it names are made available.
+The Lisp name of each function is the concatenation of PREFIX with
+the Python name, in which underlines are replaced by dashes.  If PREFIX is
+not given, it defaults to MODULE followed by a dash.
+If NOERROR is not nil, do not raise error when the module is not found.
+See `pymacs-lazy-load' for deferring the work until functions get called,
+and `pymacs-profile-load' for finding out why loading is slow."
+  (interactive
+   (let* ((module (read-string "Python module? "))
+          (default (concat (car (last (split-string module "\\."))) "-"))
+          (prefix (read-string (format "Prefix? [%s] " default)
+                               nil nil default)))
+     (list module prefix)))
+  (message "Pymacs loading %s..." module)
+  (let ((lisp-code (pymacs-call "pymacs_load_helper" module prefix noerror
+                                (and pymacs-lazy-load t)
+                                (and pymacs-profile-load t))))
+    (cond (lisp-code (let* ((start (float-time))
+                            (result (eval lisp-code)))
+                       (when pymacs-profile-load
+                         (pymacs-call "pymacs_load_profiled"
+                                      (- (float-time) start)))
+                       (add-to-list 'pymacs-load-history
+                                    (list module prefix noerror)
+                                    ;; append so that order is kept
+                                    'append)
+                       (pymacs-zygote-import module)
+                       (message "Pymacs loading %s...done" module)
+                       (run-hook-with-args 'pymacs-after-load-functions module)
+                       result))
+          (noerror (message "Pymacs loading %s...failed" module) nil))))
+
+(defun pymacs-load-report (&optional reset)
+  "Display where the time went while loading Python modules.
+Only the loads done while `pymacs-profile-load' was non-nil are reported.
+With a prefix argument RESET, forget about these loads afterwards."
+  (interactive "P")
+  (let ((text (pymacs-call "pymacs_load_report" (and reset t))))
+    (with-output-to-temp-buffer "*Pymacs load report*"
+      (princ text))))
+
+;;;###autoload
+(defun pymacs-autoload (function module &optional prefix docstring interactive)
+  "Pymacs's equivalent of the standard emacs facility `autoload'.
+Define FUNCTION to autoload from Python MODULE using PREFIX.
+If PREFIX is not given, it defaults to MODULE followed by a dash.
+Optional DOCSTRING documents FUNCTION until it gets loaded.
+INTERACTIVE is normally the argument to the function `interactive',
+t means `interactive' without arguments, nil means not interactive,
+which is the default."
+  (unless (symbolp function)
+    (error "`%s' should be a symbol" function))
+  (unless (stringp module)
+    (error "`%s' should be a string" module))
+  (unless (pymacs-python-reference function)
+
+    (defalias function
+      `(lambda (&rest args)
+         ,(or docstring
+              (format "Function `%s' to be loaded from Python module `%s'"
+                      function module))
+         ,(cond ((eq interactive t) '(interactive))
+                (interactive `(interactive ,interactive)))
+         (pymacs-load ,module ,prefix)
+         (unless (or (pymacs-python-reference ',function)
+                     (get ',function 'pymacs-stub))
+           (error "Pymacs autoload failed to define function %s" ',function))
+         (apply ',function args)))))
+
+;;;###autoload
+(defun pymacs-eval (text)
+  "Compile TEXT as a Python expression, and return its value."
+  (interactive "sPython expression: ")
+  (let ((value (pymacs-serve-until-reply "eval" `(princ ,text))))
+    (when (pymacs-called-interactively-p)
+      (message "%S" value))
+    value))
+
+;;;###autoload
+(defun pymacs-exec (text)
+  "Compile and execute TEXT as a sequence of Python statements.
+This functionality is experimental, and does not appear to be useful."
+  (interactive "sPython statements: ")
+  (let ((value (pymacs-serve-until-reply "exec" `(princ ,text))))
+    (when (pymacs-called-interactively-p)
+      (message "%S" value))
+    value))
+
+;;;###autoload
+(defun pymacs-call (function &rest arguments)
+  "Return the result of calling a Python function FUNCTION over ARGUMENTS.
+FUNCTION is a string denoting the Python function, ARGUMENTS are separate
+Lisp expressions, one per argument.  Immutable Lisp constants are converted
+to Python equivalents, other structures are converted into Lisp handles."
+  (pymacs-serve-until-reply
+   "call" `(pymacs-print-for-call ',function ',arguments)))
+
+;;;###autoload
+(defun pymacs-apply (function arguments)
+  "Return the result of calling a Python function FUNCTION over ARGUMENTS.
+FUNCTION is a string denoting the Python function, ARGUMENTS is a list of
+Lisp expressions.  Immutable Lisp constants are converted to Python
+equivalents, other structures are converted into Lisp handles."
+  (pymacs-serve-until-reply
+   "call" `(pymacs-print-for-call ',function ',arguments)))
+
+;;;###autoload
+(defun pymacs-call-async (callback function &rest arguments)
+  "Call a Python function FUNCTION over ARGUMENTS, without waiting.
+FUNCTION and ARGUMENTS are as for `pymacs-call'.  The call is queued
+on the Python side, and an identifier for it is returned right away.
+Once the Python function returns, CALLBACK, unless nil, gets called with
+the resulting value as its only argument.  If the Python function raises
+an exception instead, the diagnostic is displayed as a message.  Many
+asynchronous calls may be pending at once, Python runs them in order.
+A synchronous Pymacs request meanwhile only waits for the asynchronous
+call Python is running, if any, as Python serves it right after."
+  (pymacs-check-helper)
+  (let ((process (get-buffer-process pymacs-transit-buffer)))
+    (unless pymacs-async-callbacks
+      ;; Everything received from Python so far has been processed.
+      (set-marker pymacs-async-marker (process-mark process)
+                  pymacs-transit-buffer))
+    (unless (eq (process-filter process) 'pymacs-filter)
+      ;; Unlike the default filter, this one gets decoded text unless
+      ;; told otherwise, while the buffer holds bytes.
+      (set-process-coding-system process 'binary 'binary)
+      (set-process-filter process 'pymacs-filter))
+    (setq pymacs-async-counter (1+ pymacs-async-counter)
+          pymacs-async-callbacks (cons (cons pymacs-async-counter callback)
+                                       pymacs-async-callbacks))
+    (pymacs-async-send "async" `(pymacs-print-for-call
+                                 ',function ',arguments
+                                 ,pymacs-async-counter))
+    pymacs-async-counter))
+
+;;; Integration details.
+
+;; This page tries to increase the integration seamlessness of Pymacs
+;; with the reminder of Emacs.
+
+;; Module "desktop" savagely kills `*Pymacs*' in some circumstances.
+;; Let's avoid such damage.
+
+(eval-after-load 'desktop
+  '(push "\\*Pymacs\\*" desktop-clear-preserve-buffers))
+
+;; Python functions and modules should ideally look like Lisp
+;; functions and modules.
+
+(when t
+
+  (defadvice documentation (around pymacs-ad-documentation activate)
+    ;; Integration of doc-strings.
+    (let* ((reference (pymacs-python-reference function))
+           (python-doc (when reference
+                         (pymacs-eval (format "doc_string(%s)" reference)))))
+      (if (or reference python-doc)
+          (setq ad-return-value
+                (concat
+                 "It interfaces to a Python function.\n\n"
+                 (when python-doc
+                   (if raw python-doc (substitute-command-keys python-doc)))))
+        ad-do-it))))
+
+(defun pymacs-python-reference (object)
+  ;; Return the text reference of a Python object if possible, else nil.
+  (when (functionp object)
+    (let* ((definition (indirect-function object))
+           (body (and (pymacs-proper-list-p definition)
+                      (> (length definition) 2)
+                      (eq (car definition) 'lambda)
+                      (cddr definition))))
+      (when (and body (listp (car body)) (eq (caar body) 'interactive))
+        ;; Skip the interactive specification of a function.
+        (setq body (cdr body)))
+      (when (and body
+                 ;; Advised functions start with a string.
+                 (not (stringp (car body)))
+                 ;; Python trampolines hold exactly one expression.
+                 (= (length body) 1))
+        (let ((expression (car body)))
+          ;; EXPRESSION might now hold something like:
+          ;;    (pymacs-apply (quote (pymacs-python . N)) ARGUMENT-LIST)
+          (when (and (pymacs-proper-list-p expression)
+                     (= (length expression) 3)
+                     (eq (car expression) 'pymacs-apply)
+                     (eq (car (cadr expression)) 'quote))
+            (setq object (cadr (cadr expression))))))))
+  (when (eq (car-safe object) 'pymacs-python)
+    (format "python[%d]" (cdr object))))
+
+;; The following functions are experimental -- they are not satisfactory yet.
+
+(defun pymacs-file-handler (operation &rest arguments)
+  ;; Integration of load-file, autoload, etc.
+  ;; Emacs might want the contents of some `MODULE.el' which does not exist,
+  ;; while there is a `MODULE.py' or `MODULE.pyc' file in the same directory.
+  ;; The goal is to generate a virtual contents for this `MODULE.el' file, as
+  ;; a set of Lisp trampoline functions to the Python module functions.
+  ;; Python modules can then be loaded or autoloaded as if they were Lisp.
+  (cond ((and (eq operation 'file-readable-p)
+              (let ((module (substring (car arguments) 0 -3)))
+                (or (pymacs-file-force operation arguments)
+                    (file-readable-p (concat module ".py"))
+                    (file-readable-p (concat module ".pyc"))))))
+        ((and (eq operation 'load)
+              (not (pymacs-file-force
+                    'file-readable-p (list (car arguments))))
+              (file-readable-p (car arguments)))
+         (let ((lisp-code (pymacs-call "pymacs_load_helper"
+                                       (substring (car arguments) 0 -3)
+                                       nil)))
+           (unless lisp-code
+             (pymacs-report-error "Python import error"))
+           (eval lisp-code)))
+        ((and (eq operation 'insert-file-contents)
+              (not (pymacs-file-force
+                    'file-readable-p (list (car arguments))))
+              (file-readable-p (car arguments)))
+         (let ((lisp-code (pymacs-call "pymacs_load_helper"
+                                       (substring (car arguments) 0 -3)
+                                       nil)))
+           (unless lisp-code
+             (pymacs-report-error "Python import error"))
+           (insert (prin1-to-string lisp-code))))
+        (t (pymacs-file-force operation arguments))))
+
+(defun pymacs-file-force (operation arguments)
+  ;; Bypass the file handler.
+  (let ((inhibit-file-name-handlers
+         (cons 'pymacs-file-handler
+               (and (eq inhibit-file-name-operation operation)
+                    inhibit-file-name-handlers)))
+        (inhibit-file-name-operation operation))
+    (apply operation arguments)))
+
+;;(add-to-list 'file-name-handler-alist '("\\.el\\'" . pymacs-file-handler))
+
+;;; Bulk transfer of buffer text.
+
+;; Big buffer text travels between Emacs and Python through a temporary
+;; file, UTF-8 encoded, rather than as a string within the protocol.  See
+;; `get_region' and `insert_text' on the Python side.
+
+(defun pymacs-bulk-region (start end file threshold)
+  ;; Return the buffer text from START to END, which default to the limits
+  ;; of the accessible portion.  However, if this text holds THRESHOLD
+  ;; characters or more, rather write it into FILE and return nil.
+  (setq start (or start (point-min))
+        end (or end (point-max)))
+  (if (< (abs (- end start)) threshold)
+      (buffer-substring-no-properties start end)
+    ;; The file is only meant for Python, so no handlers nor hooks apply,
+    ;; and it needs neither a lock file nor to reach the disk.
+    (let ((coding-system-for-write 'utf-8-unix)
+          (file-name-handler-alist nil)
+          (write-region-annotate-functions nil)
+          (create-lockfiles nil)
+          (write-region-inhibit-fsync t))
+      (write-region start end file nil 'quiet))
+    nil))
+
+(defun pymacs-bulk-insert (file)
+  ;; Insert the contents of FILE at point, and move point after it.  The
+  ;; file always holds UTF-8 text, so coding detection, file handlers and
+  ;; hooks are avoided.
+  (let ((coding-system-for-read 'utf-8-unix)
+        (file-name-handler-alist nil)
+        (after-insert-file-functions nil))
+    (goto-char (+ (point) (cadr (insert-file-contents file)))))
+  nil)
+
+;;; Gargabe collection of Python IDs.
+
+;; Python objects which have no Lisp representation are allocated on the
+;; Python side as `python[INDEX]', and INDEX is transmitted to Emacs, with
+;; the value to use on the Lisp side for it.  Whenever Lisp does not need a
+;; Python object anymore, it should be freed on the Python side.  The
+;; following variables and functions are meant to fill this duty.
+
+(defvar pymacs-used-ids nil
+  "Hash table of received IDs, currently allocated on the Python side.
+Each ID is associated with t.")
+
+;; This is set whenever the Pymacs helper successfully starts, and is
+;; also used to later detect the death of a previous helper.  If
+;; pymacs-use-hash-tables is unset, this variable receives `t' when
+;; the helper starts, so the detection works nevertheless.
+(defvar pymacs-weak-hash nil
+  "Weak hash table, meant to find out which IDs are still needed.")
+
+(defvar pymacs-gc-wanted nil
+  "Flag that it is desirable to clean up unused IDs on the Python side.")
+
+(defvar pymacs-gc-inhibit nil
+  "Flag that a new Pymacs garbage collection should just not run now.")
+
+(defvar pymacs-gc-timer nil
+  "Timer to trigger Pymacs garbage collection at regular time intervals.
+The timer is used only if `post-gc-hook' is not available.")
+
+(defvar pymacs-gc-slice 2000
+  "How many IDs a Pymacs garbage collection examines at a time.
+A collection proceeds by slices whenever Emacs is idle, see
+`pymacs-gc-idle-delay', and also before each request to Python.
+Unused IDs found within a slice are freed at once on the Python side.")
+
+(defvar pymacs-gc-idle-delay 0.5
+  "Seconds of idle time before Pymacs garbage collection resumes.
+The value is used when the Pymacs helper starts.")
+
+(defvar pymacs-gc-idle-timer nil
+  "Idle timer meant to run Pymacs garbage collection by slices.")
+
+;; A collection examines the IDs in pymacs-gc-pending, while those which
+;; are still used get moved to pymacs-gc-survivors, for examination by
+;; the next collection.  New IDs go there as well.  Both lists may hold
+;; IDs which were removed from pymacs-used-ids in other ways, these are
+;; merely skipped.
+(defvar pymacs-gc-pending nil
+  "IDs remaining to examine by the current Pymacs garbage collection.")
+
+(defvar pymacs-gc-survivors nil
+  "IDs to examine by the next Pymacs garbage collection.")
+
+(defvar pymacs-gc-scanned 0
+  "How many IDs Pymacs garbage collection examined, so far.")
+
+(defvar pymacs-gc-freed 0
+  "How many IDs Pymacs garbage collection freed, so far.")
+
+(defun pymacs-schedule-gc (&optional xemacs-list)
+  (unless pymacs-gc-inhibit
+    (setq pymacs-gc-wanted t)))
+
+(defun pymacs-garbage-collect ()
+  ;; Examine a slice of IDs, starting a new collection if one is wanted,
+  ;; and clean up those unused on the Python side.  Return non-nil if the
+  ;; current collection is not complete.
+  (when (and pymacs-use-hash-tables (not pymacs-gc-inhibit))
+    (when (and pymacs-gc-wanted (not pymacs-gc-pending))
+      (setq pymacs-gc-pending pymacs-gc-survivors
+            pymacs-gc-survivors nil
+            pymacs-gc-wanted nil))
+    (let ((pymacs-gc-inhibit t)
+          (counter pymacs-gc-slice)
+          unused-ids)
+      (while (and pymacs-gc-pending (> counter 0))
+        (let ((cell pymacs-gc-pending))
+          (setq pymacs-gc-pending (cdr cell)
+                counter (1- counter))
+          (when (gethash (car cell) pymacs-used-ids)
+            (setq pymacs-gc-scanned (1+ pymacs-gc-scanned))
+            (if (gethash (car cell) pymacs-weak-hash)
+                ;; Reuse the cons cell, to avoid consing.
+                (setcdr cell pymacs-gc-survivors)
+                (setq pymacs-gc-survivors cell)
+              (remhash (car cell) pymacs-used-ids)
+              (setq unused-ids (cons (car cell) unused-ids))))))
+      (when unused-ids
+        (setq pymacs-gc-freed (+ pymacs-gc-freed (length unused-ids)))
+        (pymacs-free-python unused-ids)))
+    pymacs-gc-pending))
+
+(defun pymacs-free-python (ids)
+  ;; This function tells the Pymacs helper, if it runs, to free IDS.  The
+  ;; message is not replied to, so Emacs does not wait.
+  (let ((process (and pymacs-transit-buffer
+                      (get-buffer-process pymacs-transit-buffer))))
+    (when (and process (pymacs-helper-running-p (process-status process)))
+      (pymacs-async-send
+       "free" `(princ ,(mapconcat 'number-to-string ids " "))))))
+
+(defun pymacs-gc-idle ()
+  ;; This function is run by an idle timer.  Unless a request is being
+  ;; served, or the Pymacs helper is not running, slices of IDs get
+  ;; examined until the collection completes, or some input arrives.
+  (when (and (not pymacs-serving)
+             pymacs-transit-buffer
+             (buffer-name pymacs-transit-buffer)
+             (get-buffer-process pymacs-transit-buffer)
+             (pymacs-helper-running-p
+              (process-status (get-buffer-process pymacs-transit-buffer))))
+    (while (and (or pymacs-gc-wanted pymacs-gc-pending)
+                (not (input-pending-p))
+                (pymacs-garbage-collect)))))
+
+(defun pymacs-gc-statistics ()
+  "Report how many IDs Pymacs garbage collection examined and freed.
+The number of IDs currently in use is reported as well.  The value is
+a list (SCANNED FREED LIVE)."
+  (interactive)
+  (let ((live (if (hash-table-p pymacs-used-ids)
+                  (hash-table-count pymacs-used-ids)
+                0)))
+    (when (pymacs-called-interactively-p)
+      (message "Pymacs IDs: %d scanned, %d freed, %d live"
+               pymacs-gc-scanned pymacs-gc-freed live))
+    (list pymacs-gc-scanned pymacs-gc-freed live)))
+
+(defun pymacs-defuns (arguments)
+  ;; Take one argument, a list holding a number of items divisible by 3.  The
+  ;; first argument is an INDEX, the second is a NAME, the third is the
+  ;; INTERACTION specification, and so forth.  Register Python INDEX with a
+  ;; function with that NAME and INTERACTION on the Lisp side.  The strange
+  ;; calling convention is to minimise quoting at call time.
+  (while (>= (length arguments) 3)
+    (let ((index (nth 0 arguments))
+          (name (nth 1 arguments))
+          (interaction (nth 2 arguments)))
+      (fset name (pymacs-defun index interaction))
+      (setq arguments (nthcdr 3 arguments)))))
+
+(defun pymacs-unexport (names)
+  ;; This function is called while a Python module gets reloaded, for
+  ;; functions which it does not export anymore.  Each of NAMES gets
+  ;; undefined.  Their Python handles are left to garbage collection, as a
+  ;; hook, timer or closure might still hold their trampolines, which should
+  ;; go on calling the former functions rather than other objects.
+  (mapc 'fmakunbound names))
+
+(defun pymacs-defun (index interaction)
+  ;; Register INDEX on the Lisp side with a Python object that is a function,
+  ;; and return a lambda form calling that function.  If the INTERACTION
+  ;; specification is nil, the function is not interactive.  Otherwise, the
+  ;; function is interactive, INTERACTION is then either a string, or the
+  ;; index of an argument-less Python function returning the argument list.
+  (let ((object (pymacs-python index)))
+    (cond ((null interaction)
+           `(lambda (&rest arguments)
+              (pymacs-apply ',object arguments)))
+          ((stringp interaction)
+           `(lambda (&rest arguments)
+              (interactive ,interaction)
+              (pymacs-apply ',object arguments)))
+          (t `(lambda (&rest arguments)
+                (interactive (pymacs-call ',(pymacs-python interaction)))
+                (pymacs-apply ',object arguments))))))
+
+(defun pymacs-stubs (module arguments)
+  ;; Take a Python MODULE name, and a list holding a number of items
+  ;; divisible by 3.  The first item is a NAME, the second is the Python
+  ;; FUNCTION name within MODULE, the third is the INTERACTION string or
+  ;; nil, and so forth.  Define each NAME as a stub for FUNCTION.
+  (while arguments
+    (let ((name (nth 0 arguments))
+          (function (nth 1 arguments))
+          (interaction (nth 2 arguments)))
+      (fset name `(lambda (&rest arguments)
+                    ,@(and interaction `((interactive ,interaction)))
+                    (pymacs-stub-apply ',name ,module ,function ,interaction
+                                       arguments)))
+      (put name 'pymacs-stub t)
+      (setq arguments (nthcdr 3 arguments)))))
+
+(defun pymacs-stub-apply (name module function interaction arguments)
+  ;; This function is called by the stub for NAME, see `pymacs-stubs', with
+  ;; the ARGUMENTS it got.  A handle is obtained for FUNCTION within Python
+  ;; MODULE, NAME gets redefined as the real Lisp function, which is then
+  ;; applied to ARGUMENTS.
+  (let ((index (pymacs-call "pymacs_stub_helper" module function)))
+    (fset name (pymacs-defun index interaction))
+    (put name 'pymacs-stub nil)
+    (apply name arguments)))
+
+(defun pymacs-python (index)
+  ;; Register on the Lisp side a Python object having INDEX, and return it.
+  ;; The result is meant to be recognised specially by `print-for-eval', and
+  ;; in the function position by `print-for-apply' and `print-for-call'.
+  (let ((object (cons 'pymacs-python index)))
+    (when pymacs-use-hash-tables
+      (puthash index object pymacs-weak-hash)
+      (puthash index t pymacs-used-ids)
+      (setq pymacs-gc-survivors (cons index pymacs-gc-survivors)))
+    object))
+
+;;; Generating Python code.
+
+;; Many Lisp expressions cannot fully be represented in Python, at least
+;; because the object is mutable on the Lisp side.  Such objects are allocated
+;; somewhere into a vector of handles, and the handle index is used for
+;; communication instead of the expression itself.
+
+(defvar pymacs-lisp nil
+  "Vector of handles to hold transmitted expressions.")
+
+;; Slots from pymacs-lisp-top to the end of pymacs-lisp were never used
+;; since the vector last grew or shrank.  Below it, free slots hold nil,
+;; and they are stacked in pymacs-freed-list.
+(defvar pymacs-lisp-top 0
+  "Index of the first never used slot in `pymacs-lisp'.")
+
+(defvar pymacs-freed-list nil
+  "List of unallocated indices in Lisp, below `pymacs-lisp-top'.")
+
+(defvar pymacs-lisp-live 0
+  "Number of Lisp handles currently held for Python.")
+
+(defvar pymacs-lisp-peak 0
+  "Highest number of Lisp handles simultaneously held for Python.")
+
+;; When the Python GC is done with a Lisp object, a communication occurs so to
+;; free the object on the Lisp side as well.
+
+(defun pymacs-allocate-lisp (expression)
+  ;; This function allocates some handle for an EXPRESSION, and return its
+  ;; index.  The vector of handles grows by half when full.
+  (let ((index (car pymacs-freed-list)))
+    (if index
+        (setq pymacs-freed-list (cdr pymacs-freed-list))
+      (when (= pymacs-lisp-top (length pymacs-lisp))
+        (setq pymacs-lisp
+              (vconcat pymacs-lisp
+                       (make-vector (max 100 (/ (length pymacs-lisp) 2))
+                                    nil))))
+      (setq index pymacs-lisp-top
+            pymacs-lisp-top (1+ pymacs-lisp-top)))
+    (aset pymacs-lisp index expression)
+    (setq pymacs-lisp-live (1+ pymacs-lisp-live))
+    (when (> pymacs-lisp-live pymacs-lisp-peak)
+      (setq pymacs-lisp-peak pymacs-lisp-live))
+    index))
+
+(defun pymacs-receive-free (form)
+  ;; This function frees the Lisp handles which FORM, a message received
+  ;; from the Pymacs helper, may start with, and returns the remainder of
+  ;; FORM.  That remainder is nil if FORM was only meant to free handles.
+  (if (eq (car form) 'free)
+      (progn
+        (pymacs-free-lisp (cadr form))
+        (cddr form))
+    form))
+
+(defun pymacs-free-lisp (indices)
+  ;; This function is triggered from Python side for Lisp handles which lost
+  ;; their last reference.  These references should be cut on the Lisp side as
+  ;; well, or else, the objects will never be garbage-collected.
+  (while indices
+    (let ((index (car indices)))
+      (when (< index pymacs-lisp-top)
+        (aset pymacs-lisp index nil)
+        (setq pymacs-freed-list (cons index pymacs-freed-list)
+              pymacs-lisp-live (1- pymacs-lisp-live)))
+      (setq indices (cdr indices))))
+  ;; After a burst of handles, give back most of the vector.
+  (when (and (> (length pymacs-lisp) 100)
+             (< (* 4 pymacs-lisp-live) (length pymacs-lisp)))
+    (pymacs-shrink-lisp)))
+
+(defun pymacs-shrink-lisp ()
+  ;; This function forgets about free slots at the end of the used part of
+  ;; the vector of handles, then shrinks the vector down to twice what
+  ;; remains used, at least when this saves something.
+  (let ((top pymacs-lisp-top))
+    (while (and (> top 0) (null (aref pymacs-lisp (1- top))))
+      (setq top (1- top)))
+    (when (< top pymacs-lisp-top)
+      (let ((indices pymacs-freed-list)
+            freed)
+        (while indices
+          (when (< (car indices) top)
+            (setq freed (cons (car indices) freed)))
+          (setq indices (cdr indices)))
+        (setq pymacs-freed-list (nreverse freed)
+              pymacs-lisp-top top)))
+    (let ((size (max 100 (* 2 top))))
+      (when (< size (length pymacs-lisp))
+        (setq pymacs-lisp (substring pymacs-lisp 0 size))))))
+
+(defun pymacs-lisp-statistics ()
+  "Report how many Lisp handles are, or were at most, held for Python.
+The capacity of the vector of handles is reported as well.  The value is
+a list (CAPACITY LIVE PEAK)."
+  (interactive)
+  (when (pymacs-called-interactively-p)
+    (message "Pymacs Lisp handles: %d capacity, %d live, %d peak"
+             (length pymacs-lisp) pymacs-lisp-live pymacs-lisp-peak))
+  (list (length pymacs-lisp) pymacs-lisp-live pymacs-lisp-peak))
+
+(defun pymacs-print-for-apply (function arguments)
+  ;; This function prints a Python expression calling FUNCTION, which is a
+  ;; string naming a Python function, or a Python reference, over all its
+  ;; ARGUMENTS, which are Lisp expressions.
+  (let ((separator "")
+        argument)
+    (if (eq (car-safe function) 'pymacs-python)
+        (princ (format "python[%d]" (cdr function)))
+      (princ function))
+    (princ "(")
+    (while arguments
+      (setq argument (car arguments)
+            arguments (cdr arguments))
+      (princ separator)
+      (setq separator ", ")
+      (pymacs-print-for-eval argument))
+    (princ ")")))
+
+(defun pymacs-print-for-call (function arguments &optional identifier)
+  ;; This function prints the argument of a `call' action, which is the
+  ;; binary encoding of a list holding FUNCTION, either a string naming a
+  ;; Python function or a Python reference, followed by all its ARGUMENTS,
+  ;; which are Lisp expressions.  The binary encoding is used whatever the
+  ;; protocol, so Python gets the call without compiling anything.  For an
+  ;; `async' action, the list starts with the request IDENTIFIER.
+  (if identifier
+      (princ (format "l%d:i%d;" (+ 2 (length arguments)) identifier))
+    (princ (format "l%d:" (1+ (length arguments)))))
+  (if (eq (car-safe function) 'pymacs-python)
+      (princ (format "p%d;" (cdr function)))
+    (let ((text (encode-coding-string function 'utf-8)))
+      (princ (format "s%d:" (length text)))
+      (princ text)))
+  (while arguments
+    (pymacs-binary-print (car arguments))
+    (setq arguments (cdr arguments))))
+
+(defun pymacs-print-batch (values)
+  ;; This function prints VALUES, the list of results for a batch of calls
+  ;; queued on the Python side, as a Python tuple.  Each value is printed
+  ;; separately, as if it was the result of an individual call.
+  (if pymacs-binary-active
+      (progn
+        (princ (format "v%d:" (length values)))
+        (while values
+          (pymacs-binary-print (car values))
+          (setq values (cdr values))))
+    (princ "(")
+    (while values
+      (pymacs-print-for-eval (car values))
+      (princ ", ")
+      (setq values (cdr values)))
+    (princ ")")))
+
+(defun pymacs-print-for-eval (expression)
+  ;; This function prints a Python expression out of a Lisp EXPRESSION.
+  ;; The whole text is inserted at once, see `pymacs-python-text'.
+  (princ (pymacs-python-text expression)))
+
+(defun pymacs-python-string (string fragments)
+  ;; This function pushes the fragments of a Python string literal for
+  ;; STRING over FRAGMENTS, in reverse order, and returns the result.  The
+  ;; string is scanned once, each run of characters needing no escape is
+  ;; copied once, without text properties.  A multibyte string becomes a
+  ;; bytes literal for its UTF-8 encoding, with bytes beyond ASCII escaped
+  ;; in octal, which is decoded on the Python side.
+  (let* ((multibyte (pymacs-multibyte-string-p string))
+         (text (if multibyte (encode-coding-string string 'utf-8) string))
+         (regexp (if multibyte "[\"\\\n\200-\377]" "[\"\\\n]"))
+         (start 0)
+         match character)
+    (setq fragments (cons (if multibyte "b\"" "\"") fragments))
+    (save-match-data
+      (while (setq match (string-match regexp text start))
+        (when (> match start)
+          (setq fragments (cons (pymacs-substring-no-properties
+                                 text start match)
+                                fragments)))
+        (setq character (aref text match)
+              fragments (cons (cond ((eq character ?\n) "\\n")
+                                    ((< character 128) (string ?\\ character))
+                                    (t (format "\\%03o" character)))
+                              fragments)
+              start (1+ match))))
+    (when (< start (length text))
+      (setq fragments (cons (pymacs-substring-no-properties text start)
+                            fragments)))
+    (cons (if multibyte "\".decode('UTF-8')" "\"") fragments)))
+
+(defun pymacs-python-text (expression)
+  ;; This function returns the text of a Python expression out of a Lisp
+  ;; EXPRESSION.  Lists and vectors are walked using an explicit stack
+  ;; rather than recursively, so deep structures do not exceed
+  ;; `max-lisp-eval-depth'.  PENDING holds the elements still to translate
+  ;; within the current sequence, and CLOSING is the text ending it, while
+  ;; STACK saves both for enclosing sequences.  EXPRESSION itself is seen as
+  ;; a sequence of one.  Text fragments are accumulated in reverse order,
+  ;; and concatenated only once at the end.
+  (let ((pending (list expression))
+        (first t)
+        closing stack fragments done)
+    (while (or pending stack)
+      (if (not pending)
+          (setq fragments (cons closing fragments)
+                pending (car (car stack))
+                closing (cdr (car stack))
+                stack (cdr stack)
+                first nil)
+        (setq expression (car pending)
+              pending (cdr pending)
+              done nil)
+        (if first
+            (setq first nil)
+          (setq fragments (cons ", " fragments)))
+        (cond ((not expression)
+               (setq fragments (cons "None" fragments)
+                     done t))
+              ((eq expression t)
+               (setq fragments (cons "True" fragments)
+                     done t))
+              ((numberp expression)
+               (setq fragments (cons (number-to-string expression) fragments)
+                     done t))
+              ((stringp expression)
+               (when (or pymacs-forget-mutability
+                         (not pymacs-mutable-strings))
+                 (setq fragments (pymacs-python-string expression fragments)
+                       done t)))
+              ((symbolp expression)
+               (let ((name (symbol-name expression)))
+                 ;; The symbol can only be transmitted when in the main oblist.
+                 (when (eq expression (intern-soft name))
+                   (setq fragments (cons (concat "lisp[" (prin1-to-string name)
+                                                 "]")
+                                         fragments)
+                         done t))))
+              ((vectorp expression)
+               (when pymacs-forget-mutability
+                 (setq fragments (cons "(" fragments)
+                       stack (cons (cons pending closing) stack)
+                       closing (if (= (length expression) 1) ",)" ")")
+                       pending (append expression nil)
+                       first t
+                       done t)))
+              ((eq (car-safe expression) 'pymacs-python)
+               (setq fragments (cons (format "python[%d]" (cdr expression))
+                                     fragments)
+                     done t))
+              ((pymacs-proper-list-p expression)
+               (when pymacs-forget-mutability
+                 (setq fragments (cons "[" fragments)
+                       stack (cons (cons pending closing) stack)
+                       closing "]"
+                       pending expression
+                       first t
+                       done t))))
+        (unless done
+          (let ((class (cond ((vectorp expression) "Vector")
+                             ((and pymacs-use-hash-tables
+                                   (hash-table-p expression))
+                              "Table")
+                             ((bufferp expression) "Buffer")
+                             ((pymacs-proper-list-p expression) "List")
+                             (t "Lisp"))))
+            (setq fragments (cons (format "%s(%d)" class
+                                          (pymacs-allocate-lisp expression))
+                                  fragments))))))
+    (mapconcat #'identity (nreverse fragments) "")))
+
+;;; Binary protocol.
+
+;; When `pymacs-protocol' is `binary', values are exchanged in a tagged
+;; encoding instead of as program text.  Numbers are written in decimal and
+;; terminated by `;', strings, symbols and sequences have their length in
+;; decimal, terminated by `:', before their contents.  See "Pymacs.py" for
+;; the list of tags.  Python code sent to `eval' or `exec' stays textual.
+
+(defvar pymacs-binary-active nil
+  "Set to t once the Pymacs helper agreed to use the binary protocol.")
+
+(defvar pymacs-binary-position nil
+  "Buffer position of the next binary encoded value to decode.")
+
+(defun pymacs-print-value (expression)
+  ;; This function prints EXPRESSION as a value for Python, according to
+  ;; the protocol in use.
+  (if pymacs-binary-active
+      (pymacs-binary-print expression)
+    (pymacs-print-for-eval expression)))
+
+(defun pymacs-binary-print (expression)
+  ;; This function prints the binary encoding of a Lisp EXPRESSION.
+  ;; Copies and handles are decided as in `pymacs-print-for-eval'.  As
+  ;; sequences are prefixed with their length, nothing closes them, so a
+  ;; single PENDING list holds all the elements still to print, including
+  ;; those of enclosing sequences.  Deep structures are thus walked without
+  ;; exceeding `max-lisp-eval-depth'.
+  (let ((pending (list expression))
+        done)
+    (while pending
+      (setq expression (car pending)
+            pending (cdr pending)
+            done nil)
+      (cond ((not expression)
+             (princ "n")
+             (setq done t))
+            ((eq expression t)
+             (princ "t")
+             (setq done t))
+            ((integerp expression)
+             (princ (format "i%d;" expression))
+             (setq done t))
+            ((numberp expression)
+             (princ (format "f%S;" expression))
+             (setq done t))
+            ((stringp expression)
+             (when (or pymacs-forget-mutability
+                       (not pymacs-mutable-strings))
+               (let ((text (if (pymacs-multibyte-string-p expression)
+                               (encode-coding-string expression 'utf-8)
+                             expression)))
+                 (princ (format "s%d:" (length text)))
+                 (princ text))
+               (setq done t)))
+            ((symbolp expression)
+             (let ((name (symbol-name expression)))
+               ;; The symbol can only be transmitted when in the main oblist.
+               (when (eq expression (intern-soft name))
+                 (when (pymacs-multibyte-string-p name)
+                   (setq name (encode-coding-string name 'utf-8)))
+                 (princ (format "y%d:" (length name)))
+                 (princ name)
+                 (setq done t))))
+            ((vectorp expression)
+             (when pymacs-forget-mutability
+               (princ (format "v%d:" (length expression)))
+               (setq pending (append expression pending)
+                     done t)))
+            ((eq (car-safe expression) 'pymacs-python)
+             (princ (format "p%d;" (cdr expression)))
+             (setq done t))
+            ((pymacs-proper-list-p expression)
+             (when pymacs-forget-mutability
+               (princ (format "l%d:" (length expression)))
+               (setq pending (append expression pending)
+                     done t))))
+      (unless done
+        (princ (cond ((vectorp expression) "V")
+                     ((and pymacs-use-hash-tables
+                           (hash-table-p expression))
+                      "T")
+                     ((bufferp expression) "B")
+                     ((pymacs-proper-list-p expression) "L")
+                     (t "H")))
+        (princ (pymacs-allocate-lisp expression))
+        (princ ";")))))
+
+(defun pymacs-binary-read (position)
+  ;; This function decodes the binary encoded Lisp form found at POSITION
+  ;; in the current buffer, and returns it.
+  (let ((pymacs-binary-position position))
+    (pymacs-binary-read-1)))
+
+(defun pymacs-binary-read-1 ()
+  ;; Decode one form at `pymacs-binary-position', and skip over it.
+  ;; Sequences are decoded using an explicit stack rather than recursively,
+  ;; so deep structures do not exceed `max-lisp-eval-depth'.  TAG tells the
+  ;; kind of the current sequence, COUNTER how many of its elements remain
+  ;; to decode, and VALUES holds those already decoded, in reverse order,
+  ;; while STACK saves all three for enclosing sequences.  A quote is seen
+  ;; as a sequence of one, and so is the form itself, having no TAG.
+  (let ((counter 1)
+        tag values stack value next)
+    (while (or (> counter 0) stack)
+      (if (= counter 0)
+          ;; The current sequence is complete.
+          (setq value (cond ((eq tag ?v) (vconcat (nreverse values)))
+                            ((eq tag ?') (cons 'quote values))
+                            (t (nreverse values)))
+                tag (nth 0 (car stack))
+                counter (nth 1 (car stack))
+                values (cons value (nth 2 (car stack)))
+                stack (cdr stack))
+        (setq next (char-after pymacs-binary-position)
+              pymacs-binary-position (1+ pymacs-binary-position)
+              counter (1- counter))
+        (if (memq next '(?' ?l ?v))
+            (setq stack (cons (list tag counter values) stack)
+                  tag next
+                  counter (if (eq next ?')
+                              1
+                            (pymacs-binary-read-number ?:))
+                  values nil)
+          (setq values
+                (cons
+                 (cond ((eq next ?n) nil)
+                       ((eq next ?t) t)
+                       ((memq next '(?i ?f ?p ?d ?H))
+                        (let ((number (pymacs-binary-read-number ?\;)))
+                          (cond ((eq next ?p) (list 'pymacs-python number))
+                                ((eq next ?d) (list 'pymacs-defun number nil))
+                                ((eq next ?H) (list 'aref 'pymacs-lisp number))
+                                (t number))))
+                       ((memq next '(?s ?y ?r))
+                        (let* ((size (pymacs-binary-read-number ?:))
+                               (text (decode-coding-string
+                                      (buffer-substring-no-properties
+                                       pymacs-binary-position
+                                       (+ pymacs-binary-position size))
+                                      'utf-8)))
+                          (setq pymacs-binary-position
+                                (+ pymacs-binary-position size))
+                          (cond ((eq next ?s) text)
+                                ((eq next ?y) (intern text))
+                                (t (car (read-from-string text))))))
+                       (t (pymacs-report-error
+                           "Pymacs binary protocol error: tag %S" next)))
+                 values)))))
+    (car values)))
+
+(defun pymacs-binary-read-number (terminator)
+  ;; Decode a decimal number ended with TERMINATOR, and skip over both.
+  (let ((end pymacs-binary-position)
+        (limit (point-max)))
+    (while (not (eq (char-after end) terminator))
+      (when (>= end limit)
+        (pymacs-report-error "Pymacs binary protocol error: %s"
+                             "unterminated number"))
+      (setq end (1+ end)))
+    (prog1 (string-to-number
+            (buffer-substring-no-properties pymacs-binary-position end))
+      (setq pymacs-binary-position (1+ end)))))
+
+;;; Asynchronous requests.
+
+;; Requests sent with `pymacs-call-async' carry an identifier, and Python
+;; does not reply to them right away.  It rather runs them once it is not
+;; busy with synchronous requests, and then sends `(async (ID return VALUE))'
+;; or `(async (ID raise DIAGNOSTIC))'.  While such requests are pending, a
+;; process filter notices what Python sends, calls the callbacks, and serves
+;; sub-requests that asynchronously running Python code makes to Emacs.
+
+(defvar pymacs-async-callbacks nil
+  "Association list from pending asynchronous request identifiers to
+their callbacks.")
+
+(defvar pymacs-async-counter 0
+  "Identifier of the last asynchronous request.")
+
+(defvar pymacs-async-marker (make-marker)
+  "Where the next unprocessed message from Python starts, for the filter.")
+
+(defvar pymacs-serving nil
+  "Non-nil while Emacs serves the Pymacs helper, which then waits on Emacs.")
+
+(defun pymacs-filter (process string)
+  ;; This process filter inserts STRING like the default filter does, or
+  ;; gathers it into messages with the `string' transport.
+  ;; Unless Emacs is already busy serving Python, it then processes any
+  ;; complete message which concerns asynchronous requests, or which only
+  ;; frees Lisp handles.
+  (let ((buffer (process-buffer process)))
+    (when (buffer-live-p buffer)
+      (if pymacs-string-active
+          (pymacs-transit-gather string)
+        (with-current-buffer buffer
+          (save-excursion
+            (goto-char (process-mark process))
+            (insert string)
+            (set-marker (process-mark process) (point)))))
+      (when (and (or pymacs-async-callbacks pymacs-string-active)
+                 (not pymacs-serving))
+        (pymacs-async-serve)))))
+
+(defun pymacs-async-serve ()
+  ;; Process all complete messages received from the Pymacs helper, then
+  ;; call the callbacks of completed requests.  Callbacks are called last,
+  ;; so they may themselves send synchronous requests.
+  (let (completed form)
+    (let ((pymacs-serving t)
+          (inhibit-quit t))
+      (while (setq form (pymacs-async-next-form))
+        (setq completed (pymacs-async-dispatch form completed)))
+      (unless pymacs-string-active
+        (with-current-buffer pymacs-transit-buffer
+          (when (and (not pymacs-trace-transit)
+                     (= pymacs-async-marker
+                        (process-mark (get-buffer-process (current-buffer)))))
+            (erase-buffer)))))
+    (setq completed (nreverse completed))
+    (while completed
+      (funcall (car (car completed)) (cdr (car completed)))
+      (setq completed (cdr completed)))))
+
+(defun pymacs-async-next-form ()
+  ;; Return the next complete message from the Pymacs helper, or nil if
+  ;; there is none yet.  Copies of requests sent to Python are skipped.
+  (if pymacs-string-active
+      (let ((text (pymacs-transit-next-message)))
+        (and text (pymacs-transit-read text)))
+    (with-current-buffer pymacs-transit-buffer
+      (let ((limit (process-mark (get-buffer-process (current-buffer))))
+            form end)
+        (save-excursion
+          (save-match-data
+            (goto-char pymacs-async-marker)
+            (while (and (not form)
+                        (looking-at "\\([<>]\\)\\([0-9]+\\)\t")
+                        (<= (setq end (+ (match-end 0)
+                                         (string-to-number (match-string 2))))
+                            limit))
+              (when (string-equal (match-string 1) "<")
+                (goto-char (match-end 0))
+                (setq form (if pymacs-binary-active
+                               (pymacs-binary-read (point))
+                             (read (current-buffer)))))
+              (set-marker pymacs-async-marker end)
+              (goto-char end))))
+        form))))
+
+(defun pymacs-async-dispatch (form completed)
+  ;; Act on FORM, received from the Pymacs helper while it runs asynchronous
+  ;; requests.  It is either the final reply for such a request, or some
+  ;; sub-request, which gets served like `pymacs-serve-until-reply' does.
+  ;; COMPLETED is a list of (CALLBACK . VALUE) pairs, to which the reply
+  ;; gets pushed if it has a callback.  Return the updated list.
+  (setq form (pymacs-receive-free form))
+  (let ((action (car form)))
+    (cond
+     ((not form))
+     ((eq action 'async)
+      (let* ((arguments (cadr form))
+             (entry (assq (car arguments) pymacs-async-callbacks))
+             (pair (pymacs-interruptible-eval (nth 2 arguments))))
+        (setq pymacs-async-callbacks (delq entry pymacs-async-callbacks))
+        (cond ((not (cdr pair))
+               (message "%s" (car pair)))
+              ((eq (nth 1 arguments) 'raise)
+               (message "Python: %s" (car pair)))
+              ((cdr entry)
+               (setq completed (cons (cons (cdr entry) (car pair))
+                                     completed))))))
+     (t
+      (let* ((pair (and (memq action '(eval expand batch))
+                        (pymacs-interruptible-eval (cadr form))))
+             (value (car pair)))
+        (cond ((not pair)
+               (message "Pymacs protocol error: %s" form))
+              ((not (cdr pair))
+               (pymacs-async-send
+                "raise" `(let ((pymacs-forget-mutability t))
+                           (pymacs-print-value ',value))))
+              ((eq action 'eval)
+               (pymacs-async-send "return" `(pymacs-print-value ',value)))
+              ((eq action 'expand)
+               (pymacs-async-send
+                "return" `(let ((pymacs-forget-mutability t))
+                            (pymacs-print-value ',value))))
+              (t (pymacs-async-send
+                  "return" `(pymacs-print-batch ',value))))))))
+  completed)
+
+(defun pymacs-async-send (action inserter)
+  ;; This function sends a request made by printing ACTION and evaluating
+  ;; INSERTER, without waiting for any reply.  The request is prepared
+  ;; aside, as inserting it in the transit buffer might split a message
+  ;; being received from Python.
+  (let ((process (get-buffer-process pymacs-transit-buffer)))
+    (with-temp-buffer
+      (pymacs-set-buffer-multibyte nil)
+      (pymacs-prepare-request action inserter)
+      (process-send-region process (point-min) (point-max)))))
+
+;;; Communication protocol.
+
+(require 'ring)
+
+(defvar pymacs-transit-buffer nil
+  "Communication buffer between Emacs and Python.")
+
+(defvar pymacs-zygote-process nil
+  "Pymacs helper server launched by Emacs when `pymacs-zygote' is set.")
+
+(defvar pymacs-zygote-socket nil
+  "Unix socket on which `pymacs-zygote-process' listens.")
+
+(defvar pymacs-zygote-requests 0
+  "Number of imports asked from `pymacs-zygote-process'.")
+
+(defvar pymacs-helper-pid nil
+  "Process ID of a Pymacs helper forked by a server, or nil.")
+
+(defvar pymacs-string-active nil
+  "Set to t once messages from the Pymacs helper get gathered in a string.")
+
+(defvar pymacs-transit-input ""
+  "Text received from the Pymacs helper, while awaiting a message prefix.
+This and the next few variables are only used with the `string' transport.")
+
+(defvar pymacs-transit-missing nil
+  "How many bytes are still missing from the message being received.
+This is nil while the prefix of the next message is awaited.")
+
+(defvar pymacs-transit-chunks nil
+  "Pieces of the message being received, the most recent first.")
+
+(defvar pymacs-transit-messages nil
+  "Complete messages received from the Pymacs helper, the oldest first.")
+
+(defvar pymacs-transit-scratch nil
+  "Buffer where requests get prepared, with the `string' transport.")
+
+(defvar pymacs-transit-ring nil
+  "Ring of the latest messages, with the `string' transport, or nil.")
+
+;; The principle behind the communication protocol is that it is easier to
+;; generate than parse, and that each language already has its own parser.
+;; So, the Emacs side generates Python text for the Python side to interpret,
+;; while the Python side generates Lisp text for the Lisp side to interpret.
+;; About nothing but expressions are transmitted, which are evaluated on
+;; arrival.  The pseudo `reply' function is meant to signal the final result
+;; of a series of exchanges following a request, while the pseudo `error'
+;; function is meant to explain why an exchange could not have been completed.
+
+;; The protocol itself is rather simple, and contains human readable text
+;; only.  A message starts at the beginning of a line in the communication
+;; buffer, either with `>' for the Lisp to Python direction, or `<' for the
+;; Python to Lisp direction.  This is followed by a decimal number giving the
+;; length of the message text, a TAB character, and the message text itself.
+;; Message direction alternates systematically between messages, it never
+;; occurs that two successive messages are sent in the same direction.  The
+;; first message is received from the Python side, it is `(version VERSION)'.
+
+(defun pymacs-start-services ()
+  ;; This function gets called automatically, as needed.
+  (let ((buffer (get-buffer-create "*Pymacs*")))
+    (with-current-buffer buffer
+      ;; Erase the buffer in case some previous incarnation of the
+      ;; Pymacs helper died.  Otherwise, the "(goto-char (point-min))"
+      ;; below might not find the proper synchronising reply and later
+      ;; trigger a spurious "Protocol error" diagnostic.
+      (erase-buffer)
+      (setq pymacs-binary-active nil
+            pymacs-helper-pid nil
+            pymacs-string-active nil
+            pymacs-async-callbacks nil)
+      (buffer-disable-undo)
+      (pymacs-set-buffer-multibyte nil)
+      (set-buffer-file-coding-system 'raw-text)
+      (save-match-data
+        ;; Launch the Pymacs helper, or connect to a server for one.
+        (let* ((socket (if pymacs-helper-socket
+                           (expand-file-name pymacs-helper-socket)
+                         (and pymacs-zygote (pymacs-zygote-start))))
+               (process
+                (if socket
+                    (make-network-process
+                     :name "pymacs" :buffer buffer :family 'local
+                     :service socket :coding 'binary)
+                  (apply 'start-process "pymacs" buffer
+                         (pymacs-helper-command
+                          (and (>= emacs-major-version 24) '("-f")))))))
+          (pymacs-kill-without-query process)
+          ;; Receive the synchronising reply.
+          (while (progn
+                   (goto-char (point-min))
+                   (not (re-search-forward "<\\([0-9]+\\)\t" nil t)))
+            (unless (accept-process-output process pymacs-timeout-at-start)
+              (pymacs-report-error
+               "Pymacs helper did not start within %d seconds"
+               pymacs-timeout-at-start)))
+          (let ((marker (process-mark process))
+                (limit-position (+ (match-end 0)
+                                   (string-to-number (match-string 1)))))
+            (while (< (marker-position marker) limit-position)
+              (unless (accept-process-output process pymacs-timeout-at-start)
+                (pymacs-report-error
+                 "Pymacs helper probably was interrupted at start")))))
+        ;; Check that synchronisation occurred.
+        (goto-char (match-end 0))
+        (let ((reply (read (current-buffer))))
+          ;; A helper forked by a server also gives its process ID.
+          (if (and (pymacs-proper-list-p reply)
+                   (memq (length reply) '(2 3))
+                   (eq (car reply) 'version))
+              (progn
+                (unless (string-equal (cadr reply) "0.25")
+                  (pymacs-report-error
+                   "Pymacs Lisp version is 0.25, Python is %s"
+                   (cadr reply)))
+                (setq pymacs-helper-pid (nth 2 reply)))
+            (pymacs-report-error "Pymacs got an invalid initial reply"))))
+      ;; Possibly gather all further messages in a string.
+      (when (eq pymacs-transport 'string)
+        (erase-buffer)
+        (unless (buffer-live-p pymacs-transit-scratch)
+          (setq pymacs-transit-scratch
+                (get-buffer-create " *Pymacs scratch*"))
+          (with-current-buffer pymacs-transit-scratch
+            (buffer-disable-undo)
+            (pymacs-set-buffer-multibyte nil)))
+        (setq pymacs-transit-input ""
+              pymacs-transit-missing nil
+              pymacs-transit-chunks nil
+              pymacs-transit-messages nil
+              pymacs-transit-ring (and (> pymacs-trace-ring-size 0)
+                                       (make-ring pymacs-trace-ring-size))
+              pymacs-string-active t)
+        ;; The filter should count bytes, not decoded characters.
+        (set-process-coding-system (get-buffer-process buffer)
+                                   'binary 'binary)
+        (set-process-filter (get-buffer-process buffer) 'pymacs-filter)))
+    ;; Negotiate the protocol, the text protocol being used until then.
+    (when (eq pymacs-protocol 'binary)
+      (let ((pymacs-transit-buffer buffer)
+            (pymacs-gc-inhibit t))
+        (setq pymacs-binary-active
+              (and (pymacs-serve-until-reply "protocol" '(princ "binary"))
+                   t))))
+    (if (not pymacs-use-hash-tables)
+        (setq pymacs-weak-hash t)
+      (when (and pymacs-used-ids
+                 (> (hash-table-count pymacs-used-ids) 0))
+        ;; A previous Pymacs session occurred in this Emacs session,
+        ;; some IDs hang around which do not correspond to anything on
+        ;; the Python side.  Python should not recycle such IDs for
+        ;; new objects.
+        (let ((pymacs-transit-buffer buffer)
+              (pymacs-forget-mutability t)
+              (pymacs-gc-inhibit t)
+              ids)
+          (maphash (lambda (id value) (setq ids (cons id ids)))
+                   pymacs-used-ids)
+          (pymacs-call "zombie_python" ids)))
+      (setq pymacs-used-ids (make-hash-table)
+            pymacs-gc-pending nil
+            pymacs-gc-survivors nil
+            pymacs-weak-hash (make-hash-table :weakness 'value))
+      (if (boundp 'post-gc-hook)
+          (add-hook 'post-gc-hook 'pymacs-schedule-gc)
+        (setq pymacs-gc-timer (run-at-time 20 20 'pymacs-schedule-gc)))
+      (when (pymacs-timerp pymacs-gc-idle-timer)
+        (pymacs-cancel-timer pymacs-gc-idle-timer))
+      (when (fboundp 'run-with-idle-timer)
+        (setq pymacs-gc-idle-timer
+              (run-with-idle-timer pymacs-gc-idle-delay t 'pymacs-gc-idle))))
+    ;; If nothing failed, only then declare that Pymacs has started!
+    (setq pymacs-transit-buffer buffer)
+    (let ((modules pymacs-load-history))
+      (setq pymacs-load-history nil)
+      (when (and modules (yes-or-no-p "Reload modules in previous session? "))
+        (mapc (lambda (args)
+                ;; Be defensive in case sys.path differs
+                (condition-case err
+                    (apply 'pymacs-load args)
+                  (error
+                   (message "%s: %s" (car err) (error-message-string err)))))
+              modules)))))
+
+(defun pymacs-helper-command (options)
+  ;; This function returns the program and its arguments, for launching
+  ;; the Pymacs helper with OPTIONS, a list of strings.
+  (append (list (let ((python (getenv "PYMACS_PYTHON")))
+                  (if (or (null python) (equal python ""))
+                      pymacs-python-command
+                    python))
+                "-c" (concat "import sys;"
+                             " from Pymacs import main;"
+                             " main(*sys.argv[1:])"))
+          options
+          (mapcar 'expand-file-name pymacs-load-path)))
+
+(defun pymacs-zygote-start ()
+  ;; This function launches the zygote unless it already runs, and returns
+  ;; the Unix socket on which it listens.  A new zygote first imports the
+  ;; modules of the previous session, if any, as these may be reloaded.
+  (unless (and pymacs-zygote-process
+               (eq (process-status pymacs-zygote-process) 'run))
+    ;; The socket goes within a directory only the user may enter.
+    (let* ((directory (make-temp-file "pymacs-" t))
+           (socket (expand-file-name "socket" directory)))
+      (set-file-modes directory 448)
+      (with-current-buffer (get-buffer-create " *Pymacs zygote*")
+        (erase-buffer)
+        (let ((process (apply 'start-process "pymacs-zygote" (current-buffer)
+                              (pymacs-helper-command
+                               (list "-z" "-u" socket)))))
+          (pymacs-kill-without-query process)
+          (while (progn
+                   (goto-char (point-min))
+                   (not (search-forward "ready\n" nil t)))
+            (unless (accept-process-output process pymacs-timeout-at-start)
+              (pymacs-report-error
+               "Pymacs zygote did not start within %d seconds"
+               pymacs-timeout-at-start)))
+          (setq pymacs-zygote-process process
+                pymacs-zygote-socket socket
+                pymacs-zygote-requests 0))))
+    (mapc (lambda (args) (pymacs-zygote-import (car args)))
+          pymacs-load-history))
+  (pymacs-zygote-wait)
+  pymacs-zygote-socket)
+
+(defun pymacs-zygote-wait ()
+  ;; This function waits until the zygote acknowledged all imports asked so
+  ;; far, so the next Pymacs helper it forks holds all these modules.
+  (with-current-buffer (process-buffer pymacs-zygote-process)
+    (while (< (let ((count 0))
+                (save-excursion
+                  (goto-char (point-min))
+                  (while (re-search-forward "^\\(imported\\|failed\\) "
+                                            nil t)
+                    (setq count (1+ count))))
+                count)
+              pymacs-zygote-requests)
+      (unless (accept-process-output pymacs-zygote-process
+                                     pymacs-timeout-at-start)
+        (pymacs-report-error
+         "Pymacs zygote did not import within %d seconds"
+         pymacs-timeout-at-start)))))
+
+(defun pymacs-zygote-import (module)
+  ;; This function asks the zygote, if it runs, to import MODULE, so all
+  ;; Pymacs helpers it forks later inherit that module.
+  (when (and pymacs-zygote-process
+             (eq (process-status pymacs-zygote-process) 'run))
+    (setq pymacs-zygote-requests (1+ pymacs-zygote-requests))
+    (process-send-string pymacs-zygote-process (concat module "\n"))))
+
+(defun pymacs-terminate-services ()
+  ;; This function is mainly provided for documentation purposes.
+  (interactive)
+  (garbage-collect)
+  (while (pymacs-garbage-collect))
+  (when (or (not pymacs-used-ids)
+            (= (hash-table-count pymacs-used-ids) 0)
+            (yes-or-no-p "\
+Killing the Pymacs helper might create zombie objects.  Kill? "))
+    (cond ((boundp 'post-gc-hook)
+           (remove-hook 'post-gc-hook 'pymacs-schedule-gc))
+          ((pymacs-timerp pymacs-gc-timer)
+           (pymacs-cancel-timer pymacs-gc-timer)))
+    (when (pymacs-timerp pymacs-gc-idle-timer)
+      (pymacs-cancel-timer pymacs-gc-idle-timer))
+    (when (buffer-live-p pymacs-transit-buffer)
+      (kill-buffer pymacs-transit-buffer))
+    (setq pymacs-gc-inhibit nil
+          pymacs-gc-timer nil
+          pymacs-gc-idle-timer nil
+          pymacs-transit-buffer nil
+          pymacs-binary-active nil
+          pymacs-helper-pid nil
+          pymacs-string-active nil
+          pymacs-transit-input ""
+          pymacs-transit-missing nil
+          pymacs-transit-chunks nil
+          pymacs-transit-messages nil
+          pymacs-async-callbacks nil
+          pymacs-lisp nil
+          pymacs-lisp-top 0
+          pymacs-lisp-live 0
+          pymacs-lisp-peak 0
+          pymacs-freed-list nil)))
+
+(defun pymacs-check-helper ()
+  ;; This function starts the Pymacs helper if it is not running.
+  (unless (and pymacs-transit-buffer
+               (buffer-name pymacs-transit-buffer)
+               (get-buffer-process pymacs-transit-buffer))
+    (when pymacs-weak-hash
+      (unless (or (eq pymacs-auto-restart t)
+                  (and (eq pymacs-auto-restart 'ask)
+                       (yes-or-no-p "The Pymacs helper died.  Restart it? ")))
+        (pymacs-report-error "There is no Pymacs helper!")))
+    (pymacs-start-services)))
+
+(defun pymacs-serve-until-reply (action inserter)
+  ;; This function builds a Python request by printing ACTION and
+  ;; evaluating INSERTER, which itself prints an argument.  It then
+  ;; sends the request to the Pymacs helper, and serves all
+  ;; sub-requests coming from the Python side, until either a reply or
+  ;; an error is finally received.
+  (pymacs-check-helper)
+  (when (or pymacs-gc-wanted pymacs-gc-pending)
+    (pymacs-garbage-collect))
+  (when (and pymacs-async-callbacks (not pymacs-serving))
+    ;; Python serves such a request in between asynchronous requests, rather
+    ;; than within the one it might be running.
+    (setq action (concat "sync " action)))
+  (let (completed)
+    (prog1
+        (let ((inhibit-quit t)
+              (pymacs-serving t)
+              done value)
+          (while (not done)
+            (let ((form (pymacs-receive-free
+                         (pymacs-round-trip action inserter))))
+              ;; A message only freeing handles is not a reply, nor is the
+              ;; outcome of an asynchronous request, wait more.
+              (while (or (not form) (eq (car form) 'async))
+                (when form
+                  (setq completed (pymacs-async-dispatch form completed)))
+                (setq form (pymacs-receive-free (pymacs-round-trip nil nil))))
+              (setq action (car form))
+              (let* ((pair (pymacs-interruptible-eval (cadr form)))
+                     (success (cdr pair)))
+                (setq value (car pair))
+                (cond ((eq action 'eval)
+                       (if success
+                           (setq action "return"
+                                 inserter `(pymacs-print-value ',value))
+                         (setq action "raise"
+                               inserter `(let ((pymacs-forget-mutability t))
+                                           (pymacs-print-value ,value)))))
+                      ((eq action 'batch)
+                       (if success
+                           (setq action "return"
+                                 inserter `(pymacs-print-batch ',value))
+                         (setq action "raise"
+                               inserter `(let ((pymacs-forget-mutability t))
+                                           (pymacs-print-value ,value)))))
+                      ((eq action 'expand)
+                       (if success
+                           (setq action "return"
+                                 inserter `(let ((pymacs-forget-mutability t))
+                                             (pymacs-print-value ,value)))
+                         (setq action "raise"
+                               inserter `(let ((pymacs-forget-mutability t))
+                                           (pymacs-print-value ,value)))))
+                      ((eq action 'return)
+                       (if success
+                           (setq done t)
+                         (pymacs-report-error "%s" value)))
+                      ((eq action 'raise)
+                       (if success
+                           (pymacs-report-error "Python: %s" value)
+                         (pymacs-report-error "%s" value)))
+                      (t (pymacs-report-error "Protocol error: %s" form))))))
+          value)
+      ;; Callbacks may now be called for asynchronous requests which
+      ;; completed meanwhile, and results received since then processed.
+      (setq completed (nreverse completed))
+      (while completed
+        (funcall (car (car completed)) (cdr (car completed)))
+        (setq completed (cdr completed)))
+      (when (and pymacs-async-callbacks (not pymacs-serving))
+        (pymacs-async-serve)))))
+
+(defun pymacs-round-trip (action inserter)
+  ;; This function produces a Python request by printing and
+  ;; evaluating INSERTER, which itself prints an argument.  It sends
+  ;; the request to the Pymacs helper, awaits for any kind of reply,
+  ;; and returns it.  If ACTION is nil, nothing is sent, and the next
+  ;; message from the Pymacs helper is merely awaited.
+  (if pymacs-string-active
+      (pymacs-string-round-trip action inserter)
+    (pymacs-buffer-round-trip action inserter)))
+
+(defun pymacs-buffer-round-trip (action inserter)
+  ;; This function does the work of `pymacs-round-trip' when the whole
+  ;; communication goes through the transit buffer.
+  (with-current-buffer pymacs-transit-buffer
+    (when action
+      ;; Python may have sent messages freeing handles, while Emacs was not
+      ;; waiting for it.  Process them before they get trimmed away.
+      (when (and (not pymacs-async-callbacks)
+                 (eq (marker-buffer pymacs-async-marker) (current-buffer)))
+        (pymacs-async-serve))
+      ;; Possibly trim the beginning of the transit buffer.  While
+      ;; asynchronous requests are pending, messages from Python not yet
+      ;; processed are kept.
+      (cond (pymacs-async-callbacks
+             (unless pymacs-trace-transit
+               (delete-region (point-min) pymacs-async-marker)))
+            ((not pymacs-trace-transit)
+             (erase-buffer))
+            ((consp pymacs-trace-transit)
+             (when (> (buffer-size) (cdr pymacs-trace-transit))
+               (let ((cut (- (buffer-size) (car pymacs-trace-transit))))
+                 (when (> cut 0)
+                   (save-excursion
+                     (goto-char cut)
+                     (unless (memq (preceding-char) '(0 ?\n))
+                       (forward-line 1))
+                     (delete-region (point-min) (point)))))))))
+    ;; Send the request, wait for a reply, and process it.
+    (let* ((process (get-buffer-process pymacs-transit-buffer))
+           (status (process-status process))
+           (marker (process-mark process))
+           (moving (= (point) marker))
+           send-position reply-position reply)
+      (save-excursion
+        (save-match-data
+          (if (or (not action) pymacs-async-callbacks)
+              ;; Only await what follows the previous message.  While
+              ;; asynchronous requests are pending, Python may be in the
+              ;; middle of sending something, so the request goes aside.
+              (progn
+                (when action
+                  (pymacs-async-send action inserter))
+                (setq reply-position (marker-position pymacs-async-marker)))
+            ;; Encode request.
+            (setq send-position (marker-position marker))
+            (let ((standard-output marker))
+              (princ action)
+              (princ " ")
+              (eval inserter))
+            (goto-char marker)
+            (unless (= (preceding-char) ?\n)
+              (princ "\n" marker))
+            ;; Send request text.
+            (goto-char send-position)
+            (insert (format ">%d\t" (- marker send-position)))
+            (setq reply-position (marker-position marker))
+            (process-send-region process send-position marker))
+          ;; Receive reply text.
+          (while (and (pymacs-helper-running-p status)
+                      (progn
+                        (goto-char reply-position)
+                        (not (re-search-forward "<\\([0-9]+\\)\t" nil t))))
+            (unless (accept-process-output process pymacs-timeout-at-reply)
+              (setq status (process-status process))))
+          (when (pymacs-helper-running-p status)
+            (let ((limit-position (+ (match-end 0)
+                                     (string-to-number (match-string 1)))))
+              (while (and (pymacs-helper-running-p status)
+                          (< (marker-position marker) limit-position))
+                (unless (accept-process-output process pymacs-timeout-at-line)
+                  (setq status (process-status process))))))
+          ;; Decode reply.
+          (if (not (pymacs-helper-running-p status))
+              (pymacs-report-error "Pymacs helper status is `%S'" status)
+            (goto-char (match-end 0))
+            (set-marker pymacs-async-marker
+                        (+ (match-end 0) (string-to-number (match-string 1))))
+            (setq reply (if pymacs-binary-active
+                            (pymacs-binary-read (point))
+                          (read (current-buffer)))))))
+      (when (and moving (not pymacs-trace-transit))
+        (goto-char marker))
+      reply)))
+
+(defun pymacs-string-round-trip (action inserter)
+  ;; This function does the work of `pymacs-round-trip' with the `string'
+  ;; transport.  The request is prepared in a scratch buffer, and the reply
+  ;; is awaited until the process filter completes it.  Nothing is ever
+  ;; searched or trimmed in the transit buffer.
+  (let* ((process (get-buffer-process pymacs-transit-buffer))
+         (status (process-status process))
+         text)
+    (when action
+      (with-current-buffer pymacs-transit-scratch
+        (erase-buffer)
+        (pymacs-prepare-request action inserter)
+        (process-send-region process (point-min) (point-max))))
+    (while (and (pymacs-helper-running-p status)
+                (not (setq text (pymacs-transit-next-message))))
+      (unless (accept-process-output process pymacs-timeout-at-reply)
+        (setq status (process-status process))))
+    (unless text
+      (pymacs-report-error "Pymacs helper status is `%S'" status))
+    (pymacs-transit-read text)))
+
+(defun pymacs-prepare-request (action inserter)
+  ;; This function prints a request in the current buffer, which should be
+  ;; empty, by printing ACTION and evaluating INSERTER.  The message prefix
+  ;; is then added, and the request is also kept in the ring, if any.
+  (let ((standard-output (current-buffer)))
+    (princ action)
+    (princ " ")
+    (eval inserter))
+  (unless (= (preceding-char) ?\n)
+    (insert "\n"))
+  (goto-char (point-min))
+  (insert (format ">%d\t" (1- (point-max))))
+  (when pymacs-transit-ring
+    (ring-insert pymacs-transit-ring (buffer-string))))
+
+(defun pymacs-transit-gather (string)
+  ;; This function gathers STRING, as received from the Pymacs helper, into
+  ;; complete messages queued on `pymacs-transit-messages'.  The prefix of
+  ;; each message is parsed once, then received bytes are merely counted
+  ;; until the message is complete, and its pieces are then joined once.
+  (let ((start 0)
+        (length (length string))
+        end)
+    (while (< start length)
+      (if pymacs-transit-missing
+          ;; Take what belongs to the current message.
+          (progn
+            (setq end (min length (+ start pymacs-transit-missing))
+                  pymacs-transit-missing (- pymacs-transit-missing
+                                            (- end start))
+                  pymacs-transit-chunks (cons (if (and (= start 0)
+                                                       (= end length))
+                                                  string
+                                                (substring string start end))
+                                              pymacs-transit-chunks)
+                  start end)
+            (when (= pymacs-transit-missing 0)
+              (pymacs-transit-complete)))
+        ;; Look for the prefix of the next message.
+        (setq pymacs-transit-input (concat pymacs-transit-input
+                                           (substring string start))
+              start length)
+        ;; Anything before a prefix is unexpected, like a stray warning
+        ;; from the helper.  It gets reported and skipped, so messages are
+        ;; recognised again from the next prefix.
+        (save-match-data
+          (if (string-match "<\\([0-9]+\\)\t" pymacs-transit-input)
+              (progn
+                (when (> (match-beginning 0) 0)
+                  (pymacs-transit-junk
+                   (substring pymacs-transit-input 0 (match-beginning 0))))
+                (setq pymacs-transit-missing
+                      (string-to-number
+                       (match-string 1 pymacs-transit-input))
+                      string (substring pymacs-transit-input (match-end 0))
+                      length (length string)
+                      start 0
+                      pymacs-transit-input "")
+                (when (= pymacs-transit-missing 0)
+                  (pymacs-transit-complete)))
+            ;; Only keep what might still start a prefix.
+            (let ((keep (string-match "<[0-9]*\\'" pymacs-transit-input)))
+              (unless (eq keep 0)
+                (pymacs-transit-junk
+                 (substring pymacs-transit-input 0 keep))
+                (setq pymacs-transit-input
+                      (if keep
+                          (substring pymacs-transit-input keep)
+                        ""))))))))))
+
+(defun pymacs-transit-junk (text)
+  ;; This function reports TEXT, received from the Pymacs helper outside
+  ;; any message.
+  (message "Pymacs helper sent unexpected text: %S" text))
+
+(defun pymacs-transit-complete ()
+  ;; This function queues the message just received, and readies for the
+  ;; next one.  The message is also kept in the ring, if any.
+  (let ((text (if (cdr pymacs-transit-chunks)
+                  (apply 'concat (nreverse pymacs-transit-chunks))
+                (or (car pymacs-transit-chunks) ""))))
+    (when pymacs-transit-ring
+      (ring-insert pymacs-transit-ring
+                   (format "<%d\t%s" (length text) text)))
+    (setq pymacs-transit-messages (nconc pymacs-transit-messages (list text))
+          pymacs-transit-chunks nil
+          pymacs-transit-missing nil)))
+
+(defun pymacs-transit-next-message ()
+  ;; This function removes the oldest complete message received from the
+  ;; Pymacs helper, and returns its text without the prefix.  It returns
+  ;; nil when no complete message has been received yet.
+  (let ((text (car pymacs-transit-messages)))
+    (setq pymacs-transit-messages (cdr pymacs-transit-messages))
+    text))
+
+(defun pymacs-transit-read (text)
+  ;; This function decodes and returns the form within message TEXT.
+  (if (not pymacs-binary-active)
+      (car (read-from-string text))
+    (with-current-buffer pymacs-transit-scratch
+      (erase-buffer)
+      (insert text)
+      (pymacs-binary-read (point-min)))))
+
+(defun pymacs-show-transit ()
+  "Display the latest messages exchanged with the Pymacs helper.
+Messages are only kept with the `string' transport, and when
+`pymacs-trace-ring-size' is positive.  See `pymacs-transport'."
+  (interactive)
+  (with-output-to-temp-buffer "*Pymacs transit*"
+    (when pymacs-transit-ring
+      (mapc 'princ (reverse (ring-elements pymacs-transit-ring))))))
+
+(defun pymacs-interruptible-eval (expression)
+  ;; This function produces a pair (VALUE . SUCCESS) for EXPRESSION.
+  ;; A cautious evaluation of EXPRESSION is attempted, and any
+  ;; error while evaluating is caught, including Emacs quit (C-g).
+  ;; Any Emacs quit also gets forward as a SIGINT to the Pymacs handler.
+  ;; With SUCCESS being true, VALUE is the expression value.
+  ;; With SUCCESS being false, VALUE is an interruption diagnostic.
+  (condition-case info
+      (cons (let ((inhibit-quit nil)) (eval expression)) t)
+    (quit (setq quit-flag t)
+          (pymacs-interrupt-helper)
+          (cons "*Interrupted!*" nil))
+    (error (cons (prin1-to-string info) nil))))
+
+(defun pymacs-interrupt-helper ()
+  ;; This function sends an interrupt signal to the Pymacs helper.  When
+  ;; Emacs reaches it through a socket, the helper is not a subprocess, so
+  ;; it gets signalled through its process ID.
+  (if pymacs-helper-pid
+      (signal-process pymacs-helper-pid 'SIGINT)
+    (interrupt-process pymacs-transit-buffer)))
+
+(defun pymacs-helper-running-p (status)
+  ;; Tell if STATUS, as given by `process-status', is the one of a working
+  ;; Pymacs helper, either launched by Emacs or reached through a socket.
+  (memq status '(run open)))
+
+(defun pymacs-proper-list-p (expression)
+  ;; Tell if a list is proper, id est, that it is `nil' or ends with `nil'.
+  (cond ((not expression))
+        ((consp expression) (not (cdr (last expression))))))
+
+(provide 'pymacs)
+;;; pymacs.el ends here
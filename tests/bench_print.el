@@ -0,0 +1,77 @@
+;;; Measure how fast Emacs prints Lisp values as Python expressions.
+;; Usage: emacs -batch -l bench_print.el
+
+;; Lists of 100000 elements are printed into a buffer, as when given as
+;; arguments to a Python function.  The current `pymacs-print-for-eval',
+;; which gathers the whole text before inserting it once, is compared
+;; with the former printer, which recursed over each element and inserted
+;; every fragment separately.  A list nested deeper than the former printer
+;; allows is also printed.
+
+(push ".." load-path)
+(load "pymacs.el" nil t)
+
+(defun bench-print-recursive (expression)
+  ;; Print EXPRESSION with one `princ' per fragment, as Pymacs did.
+  (cond ((not expression) (princ "None"))
+        ((eq expression t) (princ "True"))
+        ((numberp expression) (princ expression))
+        ((stringp expression)
+         (let* ((multibyte (pymacs-multibyte-string-p expression))
+                (text (if multibyte
+                          (encode-coding-string expression 'utf-8)
+                        (copy-sequence expression))))
+           (set-text-properties 0 (length text) nil text)
+           (when multibyte
+             (princ "b"))
+           (princ (mapconcat #'identity
+                             (split-string (prin1-to-string text) "\n")
+                             "\\n"))
+           (when multibyte
+             (princ ".decode('UTF-8')"))))
+        ((vectorp expression)
+         (let ((limit (length expression))
+               (counter 0))
+           (princ "(")
+           (while (< counter limit)
+             (unless (zerop counter)
+               (princ ", "))
+             (bench-print-recursive (aref expression counter))
+             (setq counter (1+ counter)))
+           (when (= limit 1)
+             (princ ","))
+           (princ ")")))
+        (t
+         (princ "[")
+         (bench-print-recursive (car expression))
+         (while (setq expression (cdr expression))
+           (princ ", ")
+           (bench-print-recursive (car expression)))
+         (princ "]"))))
+
+(defun bench-print-measure (title printer expression)
+  ;; Print EXPRESSION using PRINTER, and report the elapsed time.
+  (let ((start (float-time)))
+    (with-temp-buffer
+      (let ((standard-output (point-marker))
+            (pymacs-forget-mutability t))
+        (funcall printer expression)))
+    (princ (format "%-10s %-24s %8.1f milliseconds\n"
+                   title printer (* 1000 (- (float-time) start)))
+           t)))
+
+(let ((integers (number-sequence 1 100000))
+      (strings (make-list 100000 "Some \"text\"\nover two lines."))
+      (accents (make-list 100000 "Ça fait déjà l'été."))
+      (vectors (make-list 10000 [1 2.5 "a" nil t 6 7 8 9 10]))
+      (deep (list 0))
+      (counter 1))
+  (while (< counter 100000)
+    (setq deep (list counter deep)
+          counter (1+ counter)))
+  (dolist (printer '(bench-print-recursive pymacs-print-for-eval))
+    (bench-print-measure "integers" printer integers)
+    (bench-print-measure "strings" printer strings)
+    (bench-print-measure "accents" printer accents)
+    (bench-print-measure "vectors" printer vectors))
+  (bench-print-measure "deep" 'pymacs-print-for-eval deep))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Measure how fast the Pymacs helper prints strings for Emacs.
+# Usage: python bench_print.py [SIZE]
+
+# Strings of SIZE characters, either pure ASCII or mostly not, are printed
+# as Lisp strings.  The current print_lisp, which escapes whole strings at
+# once, is compared with the former encoder, which wrote one fragment per
+# character.
+
+import sys, time
+import setup
+import Pymacs
+
+specials = {ord('"'): '\\"', ord('\\'): '\\\\', ord('\b'): '\\b',
+            ord('\f'): '\\f', ord('\n'): '\\n', ord('\r'): '\\r',
+            ord('\t'): '\\t'}
+
+
+def print_charwise(value, write, quoted):
+    # Print the UTF-8 bytes of VALUE, one fragment per byte, as Pymacs did.
+    write('(decode-coding-string "')
+    for byte in bytearray(value.encode('UTF-8')):
+        special = specials.get(byte)
+        if special is not None:
+            write(special)
+        elif 32 <= byte < 127:
+            write(chr(byte))
+        else:
+            write('\\%.3o' % byte)
+    write('" \'utf-8)')
+
+
+def measure(printer, text, count):
+    start = time.time()
+    for counter in range(count):
+        fragments = []
+        printer(text, fragments.append, False)
+        ''.join(fragments)
+    elapsed = time.time() - start
+    return count * len(text) / elapsed / 1e6
+
+
+def main(*arguments):
+    if arguments:
+        size = int(arguments[0])
+    else:
+        size = 1000000
+    line = 'The quick brown fox jumps over the "lazy" dog.\n'
+    if sys.version_info[0] >= 3:
+        other = 'Ça fait déjà l’été — 夏天到了。\n'
+    else:
+        other = 'Ça fait déjà l’été — 夏天到了。\n'.decode('UTF-8')
+    for title, text in (('ASCII', line * (size // len(line) + 1)),
+                        ('non-ASCII', other * (size // len(other) + 1))):
+        text = text[:size]
+        for name, printer in (('charwise', print_charwise),
+                              ('print_lisp', Pymacs.print_lisp)):
+            rate = measure(printer, text, 5)
+            sys.stdout.write('%-10s %-12s %8.1f million characters/second\n'
+                             % (title, name, rate))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
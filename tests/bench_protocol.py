@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Measure how many messages per second the Pymacs helper may receive.
+# Usage: python bench_protocol.py [COUNT]
+
+# A writer thread feeds COUNT requests, as Emacs would send them, into
+# a pipe, while this process decodes them.  The current chunked reader in
+# Pymacs.Protocol is compared with the former byte-at-a-time reader.
+
+import os, sys, threading, time
+import setup
+import Pymacs
+
+
+class Bytewise_Protocol(Pymacs.Protocol):
+    # The message prefix is read one byte at a time, as Pymacs once did.
+
+    def receive(self):
+        prefix = os.read(self.input_fd, 3)
+        while prefix[-1:] != '\t'.encode('ASCII'):
+            prefix += os.read(self.input_fd, 1)
+        size = int(prefix[1:-1])
+        data = os.read(self.input_fd, size)
+        while len(data) < size:
+            data += os.read(self.input_fd, size - len(data))
+        return data.decode('UTF-8').split(None, 1)
+
+
+def feed(writer, data, count):
+    for counter in range(count):
+        os.write(writer, data)
+    os.close(writer)
+
+
+def measure(protocol_class, text, count):
+    data = ('>%d\t%s' % (len(text), text)).encode('ASCII')
+    reader, writer = os.pipe()
+    thread = threading.Thread(target=feed, args=(writer, data, count))
+    start = time.time()
+    thread.start()
+    protocol = protocol_class(reader)
+    for counter in range(count):
+        protocol.receive()
+    elapsed = time.time() - start
+    thread.join()
+    os.close(reader)
+    return count / elapsed
+
+
+def main(*arguments):
+    if arguments:
+        count = int(arguments[0])
+    else:
+        count = 100000
+    for title, text in (
+            ('callback', 'return None\n'),
+            ('call', 'eval python[42](3, "x")\n'),
+            ('1 KB', 'return "%s"\n' % ('x' * 1000))):
+        for protocol_class in Bytewise_Protocol, Pymacs.Protocol:
+            rate = measure(protocol_class, text, count)
+            sys.stdout.write('%-10s %-20s %10.0f messages/second\n'
+                             % (title, protocol_class.__name__, rate))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
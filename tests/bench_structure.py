@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Measure how fast the Pymacs helper prints nested structures for Emacs.
+# Usage: python bench_structure.py [SIZE]
+
+# Wide, deep and mixed structures of about SIZE elements are printed as Lisp
+# source.  The current print_lisp, which walks sequences with an explicit
+# stack, is compared with the former recursive printer.  The deep structure
+# is kept within the recursion limit, so the former printer may handle it.
+
+import sys, time
+import setup
+import Pymacs
+lisp = Pymacs.lisp
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def print_recursive(value, write, quoted):
+    # Print VALUE with one recursive call per element, as Pymacs did.
+    if value is None:
+        write('nil')
+    elif isinstance(value, bool):
+        write(('nil', 't')[value])
+    elif isinstance(value, int):
+        write(repr(value))
+    elif isinstance(value, float):
+        write(repr(value))
+    elif isinstance(value, basestring):
+        Pymacs.print_lisp_string(value, write)
+    elif isinstance(value, list):
+        if quoted:
+            write("'")
+        if len(value) == 0:
+            write('nil')
+        elif len(value) == 2 and value[0] == lisp.quote:
+            write("'")
+            print_recursive(value[1], write, False)
+        else:
+            write('(')
+            print_recursive(value[0], write, False)
+            for sub_value in value[1:]:
+                write(' ')
+                print_recursive(sub_value, write, False)
+            write(')')
+    elif isinstance(value, tuple):
+        write('[')
+        if len(value) > 0:
+            print_recursive(value[0], write, False)
+            for sub_value in value[1:]:
+                write(' ')
+                print_recursive(sub_value, write, False)
+        write(']')
+    elif isinstance(value, Pymacs.Symbol):
+        if quoted:
+            write("'")
+        write(value.text)
+
+
+def deep(size):
+    # Lists nested as deeply as the former printer allows, repeated.
+    depth = min(size, sys.getrecursionlimit() // 2)
+    value = []
+    for counter in range(size // depth):
+        chain = innermost = []
+        for level in range(depth):
+            innermost.append([level])
+            innermost = innermost[-1]
+        value.append(chain)
+    return value
+
+
+def mixed(size):
+    # Something like a parse tree, with nodes of a few elements.
+    def node(size):
+        if size < 4:
+            return [lisp.token, size, 'text']
+        return [lisp.node, (size, 1.5, None), node(size // 2),
+                node(size - size // 2 - 1)]
+    return node(size // 4)
+
+
+def measure(printer, value, count):
+    start = time.time()
+    for counter in range(count):
+        fragments = []
+        printer(value, fragments.append, True)
+        ''.join(fragments)
+    return (time.time() - start) / count
+
+
+def main(*arguments):
+    if arguments:
+        size = int(arguments[0])
+    else:
+        size = 100000
+    for title, value in (('wide', list(range(size))),
+                         ('deep', deep(size)),
+                         ('mixed', mixed(size))):
+        for name, printer in (('recursive', print_recursive),
+                              ('print_lisp', Pymacs.print_lisp)):
+            elapsed = measure(printer, value, 5)
+            sys.stdout.write('%-8s %-12s %8.1f milliseconds\n'
+                             % (title, name, elapsed * 1000))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
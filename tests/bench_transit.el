@@ -0,0 +1,34 @@
+;;; Measure how fast Emacs receives big replies from the Pymacs helper.
+;; Usage: emacs -batch -l bench_transit.el
+
+;; Python strings of one and ten million bytes are returned to Emacs, a few
+;; times each, and the average delay between sending the request and getting
+;; the value is reported.  The `buffer' transport, which searches the
+;; `*Pymacs*' buffer as output arrives, is compared with the `string'
+;; transport, in which the process filter counts bytes until the reply is
+;; complete.
+
+(push ".." load-path)
+(load "pymacs.el" nil t)
+(setenv "PYTHONPATH" "..")
+
+(defun bench-transit-measure (transport size count)
+  ;; Get a string of SIZE bytes COUNT times, and report the average delay.
+  (let ((start (float-time))
+        (counter 0))
+    (while (< counter count)
+      (unless (= (length (pymacs-eval (format "'x' * %d" size))) size)
+        (error "Reply of the wrong size"))
+      (setq counter (1+ counter)))
+    (princ (format "%-8s %9d bytes %8.1f milliseconds\n"
+                   transport size
+                   (/ (* 1000 (- (float-time) start)) count))
+           t)))
+
+(dolist (transport '(buffer string))
+  (let ((pymacs-transport transport)
+        (pymacs-trace-transit nil))
+    (pymacs-start-services)
+    (bench-transit-measure transport 1000000 10)
+    (bench-transit-measure transport 10000000 5)
+    (pymacs-terminate-services)))
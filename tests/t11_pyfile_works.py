@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+# Checking if Pymacs.py works (Emacs and the Pymacs helper are not used).
+
+import re
+import setup
+import Pymacs
+lisp = Pymacs.lisp
+
+def test_print_lisp():
+
+    def validate(input, quoted, expected):
+        fragments = []
+        Pymacs.print_lisp(input, fragments.append, quoted)
+        output = re.sub(r'\(pymacs-(defun|python) [0-9]*',
+                        r'(pymacs-\1 0',
+                        ''.join(fragments))
+        assert output == expected, (output, expected)
+
+    if isinstance(bool, type):
+        false_string = 'nil'
+        true_string = 't'
+    else:
+        false_string = '0'
+        true_string = '1'
+    tests = []
+    tests += [(False, None, 'nil'),
+              (False, False, false_string),
+              (False, True, true_string),
+              (False, 3, '3'),
+              (False, 0, '0'),
+              (False, -3, '-3'),
+              (False, 3., '3.0'),
+              (False, 0., '0.0'),
+              (False, -3., '-3.0'),
+              (False, '', '""'),
+              (False, 'a', '"a"'),
+              (False, 'byz', '"byz"'),
+              (False, 'c\'bz', '"c\'bz"'),
+              (False, 'd"z', r'"d\"z"'),
+              (False, 'e\\bz', r'"e\\bz"'),
+              (False, 'f\bz', r'"f\bz"'),
+              (False, 'g\fz', r'"g\fz"'),
+              (False, 'h\nz', r'"h\nz"'),
+              (False, 'i\rz', r'"i\rz"'),
+              (False, 'j\r\nz', r'"j\r\nz"'),
+              (False, 'k\tz', r'"k\tz"'),
+              (False, 'l\x1bz', r'"l\033z"')]
+
+    tests += [(False, 'p', '"p"'),
+              (False, 'qyz', '"qyz"'),
+              (False, 'rêvé',
+                  (r'(decode-coding-string "r\303\252v\303\251"'
+                      ' \'utf-8)')),
+              (False, 's—z!',
+                  (r'(decode-coding-string "s\342\200\224z!"'
+                      ' \'utf-8)'))]
+
+
+
+
+
+
+
+
+
+    tests += [(False, (), '[]'),
+              (False, (0,), '[0]'),
+              (False, (0.0,), '[0.0]'),
+              (False, ('a',), '["a"]'),
+              (False, (0, 0.0, "a"), '[0 0.0 "a"]'),
+              (True, [], 'nil'),
+              (True, [0], '(0)'),
+              (True, [0.0], '(0.0)'),
+              (True, ['a'], '("a")'),
+              (True, [0, 0.0, "a"], '(0 0.0 "a")'),
+              (False, lisp['nil'], 'nil'),
+              (True, lisp['t'], 't'),
+              (True, lisp['ab_cd'], 'ab_cd'),
+              (True, lisp['ab-cd'], 'ab-cd'),
+              (True, lisp['lambda'], 'lambda'),
+              (False, lisp.nil, 'nil'),
+              (True, lisp.t, 't'),
+              (True, lisp.ab_cd, 'ab-cd')]
+    # TODO: Lisp and derivatives
+    tests += [(False, ord, '(pymacs-defun 0 nil)'),
+              (False, object(), '(pymacs-python 0)')]
+    for quotable, input, output in tests:
+        yield validate, input, False, output
+        if quotable:
+            yield validate, input, True, '\'' + output
+        else:
+            yield validate, input, True, output
+
+def test_print_lisp_nesting():
+    # Deep structures do not exhaust the Python stack.
+    value = deepest = []
+    for counter in range(50000):
+        deepest.append([counter])
+        deepest = deepest[-1]
+    fragments = []
+    Pymacs.print_lisp(value, fragments.append, False)
+    output = ''.join(fragments)
+    assert output.startswith('((0 (1 (2 '), output[:20]
+    assert output.endswith(' (49999)' + ')' * 50000), output[-20:]
+    fragments = []
+    Pymacs.encode_lisp(value, fragments.append, False)
+
+    output = b''.join(fragments).decode('ASCII')
+
+
+    assert output.startswith('l1:l2:i0;l2:i1;l2:i2;'), output[:20]
+    assert output.endswith('l2:i49998;l1:i49999;'), output[-20:]
+    # A value holding itself is refused, a value appearing twice is not.
+    shared = [1]
+    fragments = []
+    Pymacs.print_lisp([shared, (shared,)], fragments.append, False)
+    assert ''.join(fragments) == '((1) [(1)])', fragments
+    circular = [1]
+    circular.append((circular,))
+    for encoder in Pymacs.print_lisp, Pymacs.encode_lisp:
+        try:
+            encoder(circular, [].append, False)
+        except ValueError:
+            pass
+        else:
+            assert False, "ValueError expected"
+
+def test_receive():
+
+    def validate(read_size):
+        import os
+        reader, writer = os.pipe()
+        try:
+            os.write(writer, data)
+            protocol = Pymacs.Protocol(reader)
+            protocol.read_size = read_size
+            for expected in messages:
+                output = list(protocol.receive())
+                assert output == expected, (output, expected)
+        finally:
+            os.close(reader)
+            os.close(writer)
+
+    messages = [['eval', '3 + 5\n'],
+                ['exec', 'import os\n'],
+                ['return', '"' + 'x' * 5000 + '"\n'],
+                ['eval', 'None\n']]
+    data = ''.join(['>%d\t%s %s' % (len(action) + 1 + len(text),
+                                    action, text)
+                    for action, text in messages])
+
+    data = data.encode('ASCII')
+    for read_size in 1, 7, 65536:
+        yield validate, read_size
+
+def test_encode_lisp():
+
+    def validate(input, quoted, expected):
+        fragments = []
+        Pymacs.encode_lisp(input, fragments.append, quoted)
+
+        output = re.sub(b'([dp])[0-9]+;', br'\g<1>0;', b''.join(fragments))
+        output = output.decode('UTF-8')
+
+
+        assert output == expected, (output, expected)
+
+    tests = [(False, None, 'n'),
+             (False, 3, 'i3;'),
+             (False, -3, 'i-3;'),
+             (False, 3.5, 'f3.5;'),
+             (False, '', 's0:'),
+             (False, 'a"\n', 's3:a"\n'),
+             (False, (), 'v0:'),
+             (False, (0, 'a'), 'v2:i0;s1:a'),
+             (True, [], 'n'),
+             (True, [0, 0.0, 'a'], 'l3:i0;f0.0;s1:a'),
+             (False, float('inf'), 'f1.0e+INF;'),
+             (False, float('-inf'), 'f-1.0e+INF;'),
+             (False, float('nan'), 'f0.0e+NaN;'),
+             (True, [[1]], 'l1:l1:i1;'),
+             (True, [lisp.quote, lisp.x], '\'y1:x'),
+             (True, lisp.ab_cd, 'y5:ab-cd'),
+             (False, Pymacs.Lisp(4), 'H4;'),
+             (False, ord, 'd0;'),
+             (False, object(), 'p0;')]
+    if isinstance(bool, type):
+        tests += [(False, False, 'n'),
+                  (False, True, 't')]
+
+    tests.append((False, 'rêvé', 's6:rêvé'))
+
+
+    for quotable, input, output in tests:
+        yield validate, input, False, output
+        if quotable:
+            yield validate, input, True, '\'' + output
+        else:
+            yield validate, input, True, output
+
+def test_decode_lisp():
+
+    def validate(input, expected):
+
+        input = input.encode('UTF-8')
+        output = Pymacs.decode_lisp(input)
+        assert output == expected, (output, expected)
+
+    tests = [('n', None),
+             ('t', True),
+             ('i42;', 42),
+             ('i-7;', -7),
+             ('f2.5;', 2.5),
+             ('f1.0e+INF;', float('inf')),
+             ('f-1.0e+INF;', float('-inf')),
+             ('s0:', ''),
+             ('s5:a;b:c', 'a;b:c'),
+             ('y5:ab-cd', lisp['ab-cd']),
+             ('l0:', []),
+             ('l3:i1;s1:al1:n', [1, 'a', [None]]),
+             ('v2:i1;f1.0;', (1, 1.0)),
+             ('l3:l1:i1;v2:l0:v0:i2;', [[1], ([], ()), 2])]
+
+    tests.append(('s6:rêvé', 'rêvé'))
+
+
+    for input, output in tests:
+        yield validate, input, output
+
+def test_decode_lisp_nesting():
+    # Deep structures do not exhaust the Python stack.
+    input = 'l2:i0;' * 50000 + 'n'
+
+    input = input.encode('ASCII')
+    value = Pymacs.decode_lisp(input)
+    for counter in range(50000):
+        assert value[0] == 0 and len(value) == 2, value[:1]
+        value = value[1]
+    assert value is None, value
+
+def test_code_cache():
+    cache = Pymacs.Code_Cache(2)
+    assert eval(cache.compile('3 + 5', 'eval')) == 8
+    assert eval(cache.compile('3 + 5', 'eval')) == 8
+    assert (cache.hits, cache.misses) == (1, 1), (cache.hits, cache.misses)
+    cache.compile('x = 1', 'exec')
+    cache.compile('3 + 5', 'eval')
+    cache.compile('None', 'eval')
+    assert (cache.hits, cache.misses) == (2, 3), (cache.hits, cache.misses)
+    assert len(cache.codes) == 2, cache.codes
+    assert ('exec', 'x = 1') not in cache.codes, cache.codes
+    # Long texts are compiled, but not retained.
+    text = 'x = %r' % ('a' * 5000)
+    cache.compile(text, 'exec')
+    cache.compile(text, 'exec')
+    assert (cache.hits, cache.misses) == (2, 5), (cache.hits, cache.misses)
+    assert ('exec', text) not in cache.codes, cache.codes
+    cache.clear()
+    assert (cache.hits, cache.misses) == (0, 0), (cache.hits, cache.misses)
+    assert len(cache.codes) == 0, cache.codes
+
+def test_handle_table():
+    table = Pymacs.Handle_Table()
+    first = table.allocate(max)
+    second = table.allocate(min)
+    assert (first, second) == (0, 256), (first, second)
+    assert table[first] is max and table[second] is min
+    # A freed slot is reused under another generation.
+    table.release([first])
+    third = table.allocate(len)
+    assert third == 1, third
+    assert table[first] is Pymacs.zombie and table[third] is len
+    table.release([first, third, third])
+    assert table.free == [0], table.free
+    # Vacant slots at the end get trimmed away.
+    table.release([second])
+    assert table.values == [] and table.free == [], table.values
+    assert table[second] is Pymacs.zombie
+    # Reserved slots are skipped when allocating.
+    table.reserve([513], Pymacs.zombie)
+    assert table.values == [None, None, Pymacs.zombie], table.values
+    assert table.allocate(max) >> 8 == 1
+    assert table.allocate(max) >> 8 == 0
+    assert table.allocate(max) >> 8 == 3
+    assert table[513] is Pymacs.zombie
+
+def test_handle_table_trim():
+    table = Pymacs.Handle_Table()
+    first = table.allocate(max)
+    live = table.allocate(min)
+    table.release([first])
+    second = table.allocate(len)
+    # Trimming slots away does not forget their generations.
+    table.release([second, live])
+    assert table.values == [] and table.generations == [2, 1]
+    third = table.allocate(abs)
+    fourth = table.allocate(any)
+    assert (third, fourth) == (2, 257), (third, fourth)
+    assert table[second] is Pymacs.zombie and table[third] is abs
+    assert table[live] is Pymacs.zombie and table[fourth] is any
+    # Stale indices past the end of the list are zombies.
+    table.release([third, fourth])
+    assert table[fourth] is Pymacs.zombie and table[1 << 20] is Pymacs.zombie
+    # Churn at the end of the list leaves stale entries on the free stack,
+    # which get skipped, yet the stack does not grow.
+    table.allocate(max)
+    indices = set()
+    for counter in range(100):
+        index = table.allocate(min)
+        indices.add(index)
+        table.release([index])
+    assert len(indices) == 100 and len(table.free) <= 2, table.free
+
+def test_load_profile():
+    import sys, threading
+    profile = Pymacs.Load_Profile('colorsys')
+    sys.modules.pop('colorsys', None)
+    profile.hook()
+    try:
+        # Imports from other threads are not timed.
+        thread = threading.Thread(target=__import__, args=('colorsys',))
+        thread.start()
+        thread.join()
+        assert 'colorsys' in sys.modules and profile.imports == []
+        sys.modules.pop('colorsys')
+        __import__('colorsys')
+    finally:
+        profile.unhook()
+    assert [name for depth, name, seconds in profile.imports] == ['colorsys']
+    assert profile.depth == 0, profile.depth
+
+def test_free_message():
+    import io, sys
+
+    class Output(io.BytesIO):
+        # Stand for the standard output, under any Python version.
+        buffer = property(lambda self: self)
+
+    protocol = Pymacs.Protocol()
+    saved = sys.stdout
+    sys.stdout = output = Output()
+    try:
+        protocol.freed = [3, 5]
+        protocol.send(None, None)
+        protocol.freed = [7]
+        protocol.send('return', 't')
+    finally:
+        sys.stdout = saved
+    value = output.getvalue()
+    assert value == b'<13\t(free (3 5))\n<20\t(free (7) return t)\n', value
+
+def test_batch():
+    batch = Pymacs.Batch()
+    first = batch.call(lisp.insert, ('a', 3, None))
+    second = batch.call(lisp.goto_char, (lisp.point_min, [1, 'b']))
+    assert batch.calls == ['(insert "a" 3 nil)',
+                           '(goto-char \'point-min \'(1 "b"))'], batch.calls
+    assert batch.deferreds == [first, second], batch.deferreds
+    assert not first.done and not second.done
+    # Leaving through an exception discards queued calls, sending nothing.
+    try:
+        with batch:
+            batch.call(lisp.insert, ('c',))
+            raise KeyError
+    except KeyError:
+        pass
+    assert batch.calls == [] and batch.deferreds == [], batch.calls
+    assert lisp._protocol.batch is None and not first.done
+
+def test_thread_pool():
+    pool = Pymacs.Thread_Pool()
+    assert pool.call(max, (3, 8)) == 8
+    try:
+        pool.call(int, ('x',))
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError expected"
+    assert not pool.in_worker()
+    # A worker has the protocol thread compute on its behalf.
+    value = pool.call(pool.marshal, (len, ('abc',)))
+    assert value == 3, value
+    assert pool.call(pool.in_worker, ()) is True
+
+def test_thread_pool_completion():
+    import os, time
+
+    class Protocol:
+        # Stand for the protocol, recording asynchronous replies.
+        pending = ''
+
+        def __init__(self):
+            self.replies = []
+
+        def send_async(self, *outcome):
+            self.replies.append(outcome)
+
+    def wait():
+        while pool.finished.empty():
+            time.sleep(0.01)
+        return True
+
+    # A job completes while a synchronous call is served, consuming its
+    # wake up.  It is still replied to, before waiting on anything.
+    pool = Pymacs.Thread_Pool()
+    pool.submit(max, (3, 8), 12)
+    assert pool.call(wait, ()) is True
+    protocol = Protocol()
+    # Some input from Emacs is waiting, so a lost reply does not block.
+    protocol.input_fd, output_fd = os.pipe()
+    os.write(output_fd, '.'.encode('ASCII'))
+    pool.wait_input(protocol)
+    assert protocol.replies == [(12, 'return', 8)], protocol.replies
+    assert pool.busy == 0, pool.busy
+    os.close(protocol.input_fd)
+    os.close(output_fd)
+
+def test_batch_in_worker():
+
+    def enter():
+        try:
+            Pymacs.Batch().__enter__()
+        except Pymacs.BatchError:
+            return True
+
+    assert Pymacs.thread_pool.call(enter, ()) is True
+
+def test_process_pool():
+    pool = Pymacs.Process_Pool()
+    pool.size = 2
+    assert pool.apply(max, (3, 8)) == 8
+    try:
+        pool.apply(int, ('x',))
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError expected"
+    assert Pymacs.run_process_job(max, (3, 8)) == ('return', 8)
+    action, value = Pymacs.run_process_job(int, ('x',))
+    assert action == 'raise', action
+    assert value[0].startswith('ValueError'), value
+    assert 'Traceback' in value[1], value
+    # Diagnostics are left for the protocol thread to choose.
+    pool.submit(int, ('x',), 13)
+    identifier, action, value = Pymacs.thread_pool.finished.get(timeout=60)
+    Pymacs.thread_pool.busy -= 1
+    assert (identifier, action) == (13, 'raise'), (identifier, action)
+    assert value[0].startswith('ValueError'), value
+    pool.pool.terminate()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+# Checking if the Pymacs helper works.
+
+import re
+import setup
+from Pymacs import lisp
+
+def setup_module(module):
+    setup.start_python()
+
+def teardown_module(module):
+    setup.stop_python()
+
+def test_1():
+
+    def validate(input, expected):
+        output = re.sub(r'\(pymacs-(defun|python) [0-9]*',
+                        r'(pymacs-\1 0',
+                        setup.ask_python('eval ' + input))
+        assert output == expected, (output, expected)
+
+    if isinstance(bool, type):
+        false_string = 'nil'
+        true_string = 't'
+    else:
+        false_string = '0'
+        true_string = '1'
+    tests = []
+    tests += [(False, None, 'nil'),
+              (False, False, false_string),
+              (False, True, true_string),
+              (False, 3, '3'),
+              (False, 0, '0'),
+              (False, -3, '-3'),
+              (False, 3., '3.0'),
+              (False, 0., '0.0'),
+              (False, -3., '-3.0'),
+              (False, '', '""'),
+              (False, 'a', '"a"'),
+              (False, 'byz', '"byz"'),
+              (False, 'c\'bz', '"c\'bz"'),
+              (False, 'd"z', r'"d\"z"'),
+              (False, 'e\\bz', r'"e\\bz"'),
+              (False, 'f\bz', r'"f\bz"'),
+              (False, 'g\fz', r'"g\fz"'),
+              (False, 'h\nz', r'"h\nz"'),
+              (False, 'i\rz', r'"i\rz"'),
+              (False, 'j\r\nz', r'"j\r\nz"'),
+              (False, 'k\tz', r'"k\tz"'),
+              (False, 'l\x1bz', r'"l\033z"')]
+
+    tests += [(False, 'p', '"p"'),
+              (False, 'qyz', '"qyz"'),
+              (False, 'rêvé',
+                  (r'(decode-coding-string "r\303\252v\303\251"'
+                      ' \'utf-8)')),
+              (False, 's—z!',
+                  (r'(decode-coding-string "s\342\200\224z!"'
+                      ' \'utf-8)'))]
+
+
+
+
+
+
+
+
+
+    tests += [(False, (), '[]'),
+              (False, (0,), '[0]'),
+              (False, (0.0,), '[0.0]'),
+              (False, ('a',), '["a"]'),
+              (False, (0, 0.0, "a"), '[0 0.0 "a"]'),
+              (True, [], 'nil'),
+              (True, [0], '(0)'),
+              (True, [0.0], '(0.0)'),
+              (True, ['a'], '("a")'),
+              (True, [0, 0.0, "a"], '(0 0.0 "a")'),
+              (False, lisp['nil'], 'nil'),
+              (True, lisp['t'], 't'),
+              (True, lisp['ab_cd'], 'ab_cd'),
+              (True, lisp['ab-cd'], 'ab-cd'),
+              (True, lisp['lambda'], 'lambda'),
+              (False, lisp.nil, 'nil'),
+              (True, lisp.t, 't'),
+              (True, lisp.ab_cd, 'ab-cd')]
+    # TODO: Lisp and derivatives
+    for quotable, input, output in tests:
+        if quotable:
+            yield validate, repr(input), '(return \'%s)\n' % output
+        else:
+            yield validate, repr(input), '(return %s)\n' % output
+    tests = [('ord', '(pymacs-defun 0 nil)'),
+             ('object()', '(pymacs-python 0)')]
+    for input, output in tests:
+        yield validate, input, '(return %s)\n' % output
+
+def test_2():
+    value = setup.ask_python('eval 3 + 5\n')
+    assert value == '(return 8)\n', repr(value)
+
+def test_3():
+    value = setup.ask_python('call l3:s3:maxi3;i8;\n')
+    assert value == '(return 8)\n', repr(value)
+    value = setup.ask_python('call l2:s3:ords1:a\n')
+    assert value == '(return 97)\n', repr(value)
+    value = setup.ask_python('call l2:s3:lenl3:ni1;s0:\n')
+    assert value == '(return 3)\n', repr(value)
+    value = setup.ask_python('async l4:i7;s3:maxi3;i8;\n')
+    assert value == '(async (7 return 8))\n', repr(value)
+    value = setup.ask_python('call l3:s20:Thread_Function(max)i3;i8;\n')
+    assert value == '(return 8)\n', repr(value)
+    value = setup.ask_python('async l4:i9;s20:Thread_Function(max)i3;i8;\n')
+    assert value == '(async (9 return 8))\n', repr(value)
+    value = setup.ask_python('call l3:s21:Process_Function(max)i3;i8;\n')
+    assert value == '(return 8)\n', repr(value)
+    value = setup.ask_python(
+        'async l4:i10;s21:Process_Function(max)i3;i8;\n')
+    assert value == '(async (10 return 8))\n', repr(value)
+
+def exchange(connection, text=None):
+    # Send TEXT, unless None, to a helper reached through socket CONNECTION,
+    # then return the next message received.
+    if text is not None:
+        data = text.encode('ASCII')
+        connection.sendall(('>%d\t' % len(data)).encode('ASCII') + data)
+    data = b''
+    while b'\t' not in data:
+        data += connection.recv(1000)
+    prefix, data = data.split(b'\t', 1)
+    while len(data) < int(prefix[1:]):
+        data += connection.recv(1000)
+    return data.decode('ASCII')
+
+def start_server(name, *options, **keywords):
+    # Start a Pymacs helper server listening on Unix socket NAME.
+    import os, subprocess
+    arguments = ('-u', name) + options + ('..',)
+    return subprocess.Popen(
+            [os.environ.get('PYTHON') or 'python', '-c',
+                'from Pymacs import main; main(*%r)' % (arguments,)],
+            env=dict(os.environ, PYTHONPATH='..'), **keywords)
+
+def test_4():
+    # A helper server forks a separate Pymacs helper for each connection.
+    import os, shutil, socket, tempfile, time
+    directory = tempfile.mkdtemp()
+    name = os.path.join(directory, 'socket')
+    # Children report a protocol error when their connection gets closed.
+    errors = open(os.devnull, 'w')
+    server = start_server(name, '-i', 'colorsys', stderr=errors)
+    try:
+        identifiers = []
+        for counter in range(2):
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            for delay in range(100):
+                try:
+                    connection.connect(name)
+                    break
+                except socket.error:
+                    time.sleep(0.05)
+            else:
+                connection.connect(name)
+            value = exchange(connection)
+            assert value.startswith('(version "0.25" '), repr(value)
+            identifier = int(value.split()[-1][:-1])
+            value = exchange(connection, 'eval os.getpid()\n')
+            assert value == '(return %d)\n' % identifier, repr(value)
+            value = exchange(connection, 'eval sorted(preloaded)\n')
+            assert value == '(return \'("colorsys"))\n', repr(value)
+            identifiers.append(identifier)
+            connection.close()
+        assert identifiers[0] != identifiers[1], identifiers
+        # Only the user may connect.
+        mode = os.stat(name).st_mode & 0o777
+        assert mode == 0o600, oct(mode)
+    finally:
+        server.kill()
+        server.wait()
+        errors.close()
+        shutil.rmtree(directory)
+
+def test_5():
+    # A zygote imports the modules named on its input, until it closes.
+    import os, shutil, socket, subprocess, tempfile
+    directory = tempfile.mkdtemp()
+    name = os.path.join(directory, 'socket')
+    modules = tempfile.mkdtemp()
+    noisy = os.path.join(modules, 'noisy')
+    # Printing while being imported does not disturb the zygote.
+    handle = open(noisy + '.py', 'w')
+    handle.write('import sys\nsys.stdout.write("noise\\n")\n')
+    handle.close()
+    errors = open(os.devnull, 'w')
+    zygote = start_server(name, '-z', stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE, stderr=errors)
+    try:
+        line = zygote.stdout.readline()
+        assert line == 'ready\n'.encode('ASCII'), repr(line)
+        zygote.stdin.write(('%s\ncolorsys\nno_such_module\n'
+                            % noisy).encode('ASCII'))
+        zygote.stdin.flush()
+        for status, module in (('imported', noisy), ('imported', 'colorsys'),
+                               ('failed', 'no_such_module')):
+            line = zygote.stdout.readline()
+            expected = '%s %s\n' % (status, module)
+            assert line == expected.encode('ASCII'), repr(line)
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(name)
+        exchange(connection)
+        value = exchange(connection, 'eval sorted(preloaded)\n')
+        assert value == '(return \'("colorsys" "noisy"))\n', repr(value)
+        connection.close()
+        zygote.stdin.close()
+        assert zygote.wait() == 0, zygote.returncode
+        assert not os.path.exists(directory)
+    finally:
+        if zygote.returncode is None:
+            zygote.kill()
+            zygote.wait()
+        errors.close()
+        shutil.rmtree(directory, True)
+        shutil.rmtree(modules)
+
+def test_6():
+    # A lazy load only installs stubs, for the names in "__all__".
+    value = re.sub(r'\(pymacs-python [0-9]*', '(pymacs-python 0',
+                   setup.ask_python('eval pymacs_load_helper('
+                                    '"colorsys", "c-", None, True)\n'))
+    assert value == ('(return \'(progn (pymacs-stubs "colorsys" \''
+                     '(c-rgb-to-yiq "rgb_to_yiq" nil'
+                     ' c-yiq-to-rgb "yiq_to_rgb" nil'
+                     ' c-rgb-to-hls "rgb_to_hls" nil'
+                     ' c-hls-to-rgb "hls_to_rgb" nil'
+                     ' c-rgb-to-hsv "rgb_to_hsv" nil'
+                     ' c-hsv-to-rgb "hsv_to_rgb" nil))'
+                     ' (pymacs-python 0)))\n'), repr(value)
+    value = setup.ask_python('eval python[pymacs_stub_helper('
+                             '"colorsys", "rgb_to_hsv")]'
+                             ' is sys.modules["colorsys"].rgb_to_hsv\n')
+    assert value == '(return t)\n', repr(value)
+
+def test_7():
+    # Reloading a module reuses handles, and undefines vanished names.
+    import os, shutil, tempfile, time
+    directory = tempfile.mkdtemp()
+    name = os.path.join(directory, 'reloaded')
+    command = 'eval pymacs_load_helper(%r, "r-")\n' % name
+    try:
+        handle = open(name + '.py', 'w')
+        handle.write('def f():\n    return 1\n\n'
+                     'def g():\n    return 2\n\n'
+                     '__all__ = ["f", "g"]\n')
+        handle.close()
+        value = setup.ask_python(command)
+        match = re.search(r"\(pymacs-defuns '\(([0-9]+) r-f nil"
+                          r" ([0-9]+) r-g nil\)\)", value)
+        assert match, repr(value)
+        f_index, g_index = match.groups()
+        handle = open(name + '.py', 'w')
+        handle.write('def f():\n    return 10\n\n'
+                     'def h():\n    return 3\n\n'
+                     '__all__ = ["f", "h"]\n')
+        handle.close()
+        # Make sure a compiled file from the first load looks outdated.
+        future = time.time() + 10
+        os.utime(name + '.py', (future, future))
+        value = setup.ask_python(command)
+        match = re.match(r"\(return '\(progn \(pymacs-unexport '\(r-g\)\)"
+                         r" \(pymacs-defuns '\(([0-9]+) r-h nil\)\)", value)
+        assert match, repr(value)
+        assert match.group(1) not in (f_index, g_index), repr(value)
+        value = setup.ask_python('eval python[%s]()\n' % f_index)
+        assert value == '(return 10)\n', repr(value)
+        # Lisp may still hold the former "g", which is not freed yet.
+        value = setup.ask_python('eval python[%s]()\n' % g_index)
+        assert value == '(return 2)\n', repr(value)
+    finally:
+        shutil.rmtree(directory)
+
+def test_8():
+    # A profiled load reports the time taken by each of its phases.
+    value = setup.ask_python('eval pymacs_load_helper('
+                             '"colorsys", "c-", None, None, True) and None\n')
+    assert value == '(return nil)\n', repr(value)
+    value = setup.ask_python('eval pymacs_load_profiled(0.5)\n')
+    assert value == '(return nil)\n', repr(value)
+    value = setup.ask_python('eval pymacs_load_report(True)\n')
+    assert re.match(r'\(return "Module colorsys, [0-9.]+ ms in total\\n'
+                    r' +[0-9.]+ ms  import\\n(.*\\n)*'
+                    r' +[0-9.]+ ms  trampolines\\n'
+                    r' +500\.0 ms  definitions in Emacs\\n"\)\n$',
+                    value), repr(value)
+    value = setup.ask_python('eval pymacs_load_report()\n')
+    assert value == '(return "")\n', repr(value)
+
+def test_9():
+    # Emacs frees Python handles without waiting for a reply.
+    value = setup.ask_python('eval allocate_python(max)\n')
+    index = int(re.match(r'\(return ([0-9]+)\)\n$', value).group(1))
+    setup.Python.services.send('free %d\n' % index)
+    value = setup.ask_python('eval python[%d] is zombie\n' % index)
+    assert value == '(return t)\n', repr(value)
+
+def test_10():
+    # A synchronous request arriving while an asynchronous one waits on Emacs
+    # is only served once the asynchronous request completes.
+    function = 'lambda: lisp.fill_column.value() + 1'
+    value = setup.ask_python('async l2:i11;s%d:%s\n' % (len(function),
+                                                       function))
+    assert value == '(eval fill-column)\n', repr(value)
+    setup.Python.services.send('sync eval 3 + 5\n')
+    value = setup.ask_python('return 70\n')
+    assert value == '(async (11 return 71))\n', repr(value)
+    value = setup.Python.services.receive()
+    assert value == '(return 8)\n', repr(value)
+
+def test_11():
+    # A value which may not be printed for Lisp raises an error in Emacs,
+    # and the helper survives it.
+    value = setup.ask_python('exec a = [1]; a.append(a)\n')
+    assert value == '(return nil)\n', repr(value)
+    value = setup.ask_python('eval a\n')
+    assert value == '(eval debug-on-error)\n', repr(value)
+    value = setup.ask_python('return None\n')
+    assert value == ('(raise "ValueError: Circular structure'
+                     ' may not go to Lisp.")\n'), repr(value)
+    value = setup.ask_python('eval len(a)\n')
+    assert value == '(return 2)\n', repr(value)
+
+def test_12():
+    # This test should remain last, as the protocol is not switched back.
+    value = setup.ask_python('protocol binary\n')
+    assert value == '(return t)\n', repr(value)
+    value = setup.ask_python('eval 3 + 5\n')
+    assert value == 'l2:y6:returni8;\n', repr(value)
+    value = setup.ask_python('eval [1, "ab"]\n')
+    assert value == 'l2:y6:return\'l2:i1;s2:ab\n', repr(value)
+    value = setup.ask_python('call l3:s3:maxi3;i8;\n')
+    assert value == 'l2:y6:returni8;\n', repr(value)
+    value = setup.ask_python('async l4:i7;s3:maxi3;i8;\n')
+    assert value == 'l2:y5:asyncl3:i7;y6:returni8;\n', repr(value)
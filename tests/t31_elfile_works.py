@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+# Checking if pymacs.el works (the Pymacs helper is not used).
+
+import re
+import setup
+import Pymacs
+lisp = Pymacs.lisp
+
+def setup_module(module):
+    setup.start_emacs()
+
+def teardown_module(module):
+    setup.stop_emacs()
+
+def test_1():
+
+    def validate(input, expected):
+        output = setup.ask_emacs(input, 'prin1')
+        output = re.sub(r'\(pymacs-(defun|python) [0-9]*',
+                        r'(pymacs-\1 0',
+                        output)
+        assert output == expected, (output, expected)
+
+    if isinstance(bool, type):
+        false_string = 'nil'
+        true_string = 't'
+    else:
+        false_string = '0'
+        true_string = '1'
+    tests = []
+    tests += [(False, None, 'nil'),
+              (False, False, false_string),
+              (False, True, true_string),
+              (False, 3, '3'),
+              (False, 0, '0'),
+              (False, -3, '-3'),
+              (False, 3., '3.0'),
+              (False, 0., '0.0'),
+              (False, -3., '-3.0'),
+              (False, '', '""'),
+              (False, 'a', '"a"'),
+              (False, 'byz', '"byz"'),
+              (False, 'c\'bz', '"c\'bz"'),
+              (False, 'd"z', r'"d\"z"'),
+              (False, 'e\\bz', r'"e\\bz"'),
+              (False, 'f\bz', '"f\bz"'),
+              (False, 'g\fz', '"g\fz"'),
+              (False, 'h\nz', '"h\nz"'),
+              (False, 'i\rz', '"i\rz"'),
+              (False, 'j\r\nz', '"j\r\nz"'),
+              (False, 'k\tz', '"k\tz"'),
+              (False, 'l\x1bz', '"l\x1bz"')]
+
+    tests += [(False, 'p', '"p"'),
+              (False, 'qyz', '"qyz"'),
+              (False, 'rêvé', '"rêvé"'),
+              (False, 's—z!', '"s—z!"')]
+
+
+
+
+
+    tests += [(False, (), '[]'),
+              (False, (0,), '[0]'),
+              (False, (0.0,), '[0.0]'),
+              (False, ('a',), '["a"]'),
+              (False, (0, 0.0, "a"), '[0 0.0 "a"]'),
+              (True, [], 'nil'),
+              (True, [0], '(0)'),
+              (True, [0.0], '(0.0)'),
+              (True, ['a'], '("a")'),
+              (True, [0, 0.0, "a"], '(0 0.0 "a")'),
+              (False, lisp['nil'], 'nil'),
+              (True, lisp['t'], 't'),
+              (True, lisp['ab_cd'], 'ab_cd'),
+              (True, lisp['ab-cd'], 'ab-cd'),
+              (True, lisp['lambda'], 'lambda'),
+              (False, lisp.nil, 'nil'),
+              (True, lisp.t, 't'),
+              (True, lisp.ab_cd, 'ab-cd')]
+    # TODO: Lisp and derivatives
+    for quotable, input, output in tests:
+        fragments = []
+        Pymacs.print_lisp(input, fragments.append, quotable)
+        yield validate, ''.join(fragments), output
+    tests = [(ord, '(pymacs-defun 0 nil)'),
+             (object(), '(pymacs-python 0)')]
+    for input, output in tests:
+        fragments = []
+        Pymacs.print_lisp(input, fragments.append, True)
+        yield validate, '\'' + ''.join(fragments), output
+
+def test_2():
+
+    def validate(input, expected):
+        output = setup.ask_emacs(
+            input,
+            '(lambda (expression)\n'
+            '  (let ((pymacs-forget-mutability t))\n'
+            '    (pymacs-print-for-eval expression)))\n')
+        output = re.sub(r'\(pymacs-(defun|python) [0-9]*',
+                        r'(pymacs-\1 0',
+                        output)
+        assert output == expected, (output, expected)
+
+    tests = []
+    tests += [(False, None, 'None'),
+              (False, False, 'None'),
+              (False, True, 'True'),
+              (False, 3, '3'),
+              (False, 0, '0'),
+              (False, -3, '-3'),
+              (False, 3., '3.0'),
+              (False, 0., '0.0'),
+              (False, -3., '-3.0'),
+              (False, '', '""'),
+              (False, 'a', '"a"'),
+              (False, 'byz', '"byz"'),
+              (False, 'c\'bz', '"c\'bz"'),
+              (False, 'd"z', r'"d\"z"'),
+              (False, 'e\\bz', r'"e\\bz"'),
+              (False, 'f\bz', '"f\x08z"'),
+              (False, 'g\fz', '"g\x0cz"'),
+              (False, 'h\nz', r'"h\nz"'),
+              (False, 'i\rz', '"i\rz"'),
+              (False, 'j\r\nz', '"j\r\\nz"'),
+              (False, 'k\tz', '"k\tz"'),
+              (False, 'l\x1bz', '"l\x1bz"'),
+              (False, (), '()'),
+              (False, (0,), '(0,)'),
+              (False, (0.0,), '(0.0,)'),
+              (False, ('a',), '("a",)'),
+              (False, (0, 0.0, "a"), '(0, 0.0, "a")'),
+              (True, [], 'None'),
+              (True, [0], '[0]'),
+              (True, [0.0], '[0.0]'),
+              (True, ['a'], '["a"]'),
+              (True, [0, 0.0, "a"], '[0, 0.0, "a"]'),
+              (True, [(), 1, [2, (3,)]], '[(), 1, [2, (3,)]]'),
+              (False, lisp['nil'], 'None'),
+              (True, lisp['t'], 'True'),
+              (True, lisp['ab_cd'], 'lisp["ab_cd"]'),
+              (True, lisp['ab-cd'], 'lisp["ab-cd"]'),
+              (True, lisp['lambda'], 'lisp["lambda"]'),
+              (False, lisp.nil, 'None'),
+              (True, lisp.t, 'True'),
+              (True, lisp.ab_cd, 'lisp["ab-cd"]')]
+
+    tests += [(False, 'rêvé',
+                  r'b"r\303\252v\303\251".decode(\'UTF-8\')'),
+              (False, 'ê"\n', r'b"\303\252\"\n".decode(\'UTF-8\')')]
+
+
+
+
+    # TODO: Lisp and derivatives
+    for quotable, input, output in tests:
+        fragments = []
+        Pymacs.print_lisp(input, fragments.append, quotable)
+        yield validate, ''.join(fragments), output
+    #for input, output in (
+    #        (ord, '(pymacs-defun 0 nil)'),
+    #        (object(), '(pymacs-python 0)'),
+    #        ):
+    #    fragments = []
+    #    Pymacs.print_lisp(input, fragments.append, True)
+    #    yield validate, '\'' + ''.join(fragments), output
+
+def test_3():
+    # Deep structures do not exceed `max-lisp-eval-depth'.
+    output = setup.ask_emacs(
+        '(let ((pymacs-forget-mutability t)\n'
+        '      (deep nil)\n'
+        '      (counter 0))\n'
+        '  (while (< counter 5000)\n'
+        '    (setq deep (list counter deep)\n'
+        '          counter (1+ counter)))\n'
+        '  (pymacs-print-for-eval deep))\n')
+    expected = 'None'
+    for counter in range(5000):
+        expected = '[%d, %s]' % (counter, expected)
+    assert output == expected, (output[:40], expected[:40])
+
+def test_4():
+    # The vector of Lisp handles grows for a burst, then shrinks back.
+    output = setup.ask_emacs(
+        '(let ((before (pymacs-lisp-statistics))\n'
+        '      (counter 0)\n'
+        '      indices during)\n'
+        '  (while (< counter 1000)\n'
+        '    (setq indices (cons (pymacs-allocate-lisp (list counter))\n'
+        '                        indices)\n'
+        '          counter (1+ counter)))\n'
+        '  (setq during (pymacs-lisp-statistics))\n'
+        '  (pymacs-free-lisp indices)\n'
+        '  (list before during (pymacs-lisp-statistics)))\n', 'prin1')
+    numbers = [int(number) for number in re.findall('[0-9]+', output)]
+    assert len(numbers) == 9, output
+    before, during, after = numbers[0:3], numbers[3:6], numbers[6:9]
+    assert during[1] == before[1] + 1000, output
+    assert during[2] >= during[1] and during[0] >= during[1], output
+    assert after[1] == before[1] and after[2] == during[2], output
+    assert after[0] < during[0], output
+
+def test_5():
+    # Stray text from the helper is skipped, messages around it still count.
+    output = setup.ask_emacs(
+        '(let ((pymacs-transit-messages nil)\n'
+        '      (pymacs-transit-chunks nil)\n'
+        '      (pymacs-transit-missing nil)\n'
+        '      (pymacs-transit-input "")\n'
+        '      (pymacs-transit-ring nil))\n'
+        '  (pymacs-transit-gather "<3\\tabcWarning: <")\n'
+        '  (pymacs-transit-gather "oops\\n<2")\n'
+        '  (pymacs-transit-gather "\\tde")\n'
+        '  pymacs-transit-messages)\n', 'prin1')
+    assert output == '("abc" "de")', repr(output)
+
+def test_6():
+    # Binary encoding and decoding do not exceed `max-lisp-eval-depth'.
+    output = setup.ask_emacs(
+        '(let ((pymacs-forget-mutability t)\n'
+        '      (deep nil)\n'
+        '      (counter 0))\n'
+        '  (while (< counter 5000)\n'
+        '    (setq deep (list counter (vector deep))\n'
+        '          counter (1+ counter)))\n'
+        '  (let ((text (with-output-to-string (pymacs-binary-print deep))))\n'
+        '    (with-temp-buffer\n'
+        '      (insert text)\n'
+        '      (string-equal (with-output-to-string\n'
+        '                      (pymacs-binary-print\n'
+        '                       (pymacs-binary-read (point-min))))\n'
+        '                    text))))\n', 'prin1')
+    assert output == 't', repr(output)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# Checking if the whole Pymacs works together.
+
+import re
+import setup
+import Pymacs
+lisp = Pymacs.lisp
+
+def setup_module(module):
+    setup.start_emacs()
+
+def teardown_module(module):
+    setup.stop_emacs()
+
+def test_1():
+
+    def validate(input, expected):
+        output = re.sub(r'\(pymacs-(defun|python) \. [0-9]*\)',
+                        r'(pymacs-\1 . 0)',
+                        setup.ask_emacs('(pymacs-eval %s)' % input, 'prin1'))
+        assert output == expected, (output, expected)
+
+    tests = []
+    tests += [(False, None, 'nil'),
+              (False, False, 'nil'),
+              (False, True, 't'),
+              (False, 3, '3'),
+              (False, 0, '0'),
+              (False, -3, '-3'),
+              (False, 3., '3.0'),
+              (False, 0., '0.0'),
+              (False, -3., '-3.0'),
+              (False, '', '""'),
+              (False, 'a', '"a"'),
+              (False, 'byz', '"byz"'),
+              (False, 'c\'bz', '"c\'bz"'),
+              (False, 'd"z', r'"d\"z"'),
+              (False, 'e\\bz', r'"e\\bz"'),
+              (False, 'f\bz', '"f\bz"'),
+              (False, 'g\fz', '"g\fz"'),
+              (False, 'h\nz', '"h\nz"'),
+              (False, 'i\rz', '"i\rz"'),
+              (False, 'j\r\nz', '"j\r\nz"'),
+              (False, 'k\tz', '"k\tz"'),
+              (False, 'l\x1bz', '"l\x1bz"')]
+
+    tests += [(False, 'p', '"p"'),
+              (False, 'qyz', '"qyz"'),
+              (False, 'rêvé', '"rêvé"'),
+              (False, 's—z!', '"s—z!"')]
+
+
+
+
+
+    tests += [(False, (), '[]'),
+              (False, (0,), '[0]'),
+              (False, (0.0,), '[0.0]'),
+              (False, ('a',), '["a"]'),
+              (False, (0, 0.0, "a"), '[0 0.0 "a"]'),
+              (True, [], 'nil'),
+              (True, [0], '(0)'),
+              (True, [0.0], '(0.0)'),
+              (True, ['a'], '("a")'),
+              (True, [0, 0.0, "a"], '(0 0.0 "a")'),
+              (False, lisp['nil'], 'nil'),
+              (True, lisp['t'], 't'),
+              (True, lisp['ab_cd'], 'ab_cd'),
+              (True, lisp['ab-cd'], 'ab-cd'),
+              (True, lisp['lambda'], 'lambda'),
+              (False, lisp.nil, 'nil'),
+              (True, lisp.t, 't'),
+              (True, lisp.ab_cd, 'ab-cd')]
+    # TODO: Lisp and derivatives
+    for quotable, input, output in tests:
+        fragments = []
+
+        Pymacs.print_lisp(ascii(input), fragments.append, quotable)
+
+
+        yield validate, ''.join(fragments), output
+    tests = [('ord', ('(lambda (&rest arguments)'
+                      ' (pymacs-apply (quote (pymacs-python . 0))'
+                      ' arguments))')),
+             ('object()', '(pymacs-python . 0)')]
+    for input, output in tests:
+        fragments = []
+        Pymacs.print_lisp(input, fragments.append, True)
+        yield validate, '\'' + ''.join(fragments), output
+
+def test_2():
+
+    def validate(input, expected):
+        output = setup.ask_emacs(input, 'prin1')
+        assert output == expected, (output, expected)
+
+    yield validate, '(pymacs-eval "3 + 5")', '8'
+
+    yield (validate,
+           ('(progn (pymacs-exec "def f(): pass")\n'
+            '       (pymacs-eval "lisp.apply(f, None)"))\n'),
+           'nil')
+
+
+    yield (validate,
+           '(pymacs-eval "lisp(\'(pymacs-eval \\"repr(2**111)\\")\')")',
+           '"2596148429267413814265248164610048"')
+
+
+
+
+
+def test_3():
+
+    setup.ask_emacs('(pymacs-exec "import os\nimport sys")')
+
+def test_4():
+    # Try ``list.buffer_string()`` in a multi-byte buffer.
+    pass
+
+def test_5():
+    # Calls queued within a batch get their values once the batch is flushed.
+    output = setup.ask_emacs(
+            '(progn (pymacs-exec "from Pymacs import Batch\\n'
+            'def f():\\n'
+            '    with Batch():\\n'
+            '        first = lisp.max(3, 8)\\n'
+            '        second = lisp[\'+\'](first, 2)\\n'
+            '    return first.value(), second.value()")\n'
+            '       (pymacs-eval "f()"))\n',
+            'prin1')
+    assert output == '[8 10]', repr(output)
+
+def test_6():
+    # Big text goes through a temporary file, small text does not.
+    output = setup.ask_emacs(
+            '(with-temp-buffer\n'
+            '  (pymacs-exec "import Pymacs\\n'
+            'Pymacs.insert_text(\'ab\' * 50000)\\n'
+            'Pymacs.insert_text(\'cd\')\\n'
+            'def mapped(start):\\n'
+            '    region = Pymacs.map_region(start)\\n'
+            '    try:\\n'
+            '        return region[:].decode()\\n'
+            '    finally:\\n'
+            '        region.close()")\n'
+            '  (list (buffer-size) (point)\n'
+            '        (pymacs-eval "len(Pymacs.get_region())")\n'
+            '        (pymacs-eval "Pymacs.get_region(3, 7)")\n'
+            '        (pymacs-eval "mapped(99999)")))\n',
+            'prin1')
+    assert output == '(100002 100003 100002 "abab" "bcd")', repr(output)
+
+
+def test_7():
+    # A cached handle sees its own writes, but not others until refreshed.
+    output = setup.ask_emacs(
+            '(progn (setq pymacs-test-list (list 1 2 3))\n'
+            '       (pymacs-exec "def f():\\n'
+            '    items = lisp.pymacs_test_list.value().cache()\\n'
+            '    items[0] = 7\\n'
+            '    lisp(\'(setcar (cdr pymacs-test-list) 8)\')\\n'
+            '    before = list(items)\\n'
+            '    return before, items.refresh()[:], len(items)")\n'
+            '       (pymacs-eval "f()"))\n',
+            'prin1')
+    assert output == '[(7 2 3) (7 8 3) 3]', repr(output)
+
+
+def test_8():
+    # Uncached iteration yields handles, some tables are never cached.
+    output = setup.ask_emacs(
+            '(progn (setq pymacs-test-list (list (list 1) (list 2)))\n'
+            '       (setq pymacs-test-table (make-hash-table :test \'eq))\n'
+            '       (puthash \'a 1 pymacs-test-table)\n'
+            '       (pymacs-exec "def f():\\n'
+            '    for item in lisp.pymacs_test_list.value():\\n'
+            '        item[0] = 5\\n'
+            '    table = lisp.pymacs_test_table.value().cache()\\n'
+            '    return table.snapshot")\n'
+            '       (list (pymacs-eval "f()") pymacs-test-list))\n',
+            'prin1')
+    assert output == '(nil ((5) (5)))', repr(output)
+
+
+def test_9():
+    # Cached handles serve reads from copies of Lisp lists, vectors and
+    # tables, unless table keys would get confused in Python.
+    output = setup.ask_emacs(
+            '(progn (setq pymacs-test-list (list 7 (list 8)))\n'
+            '       (setq pymacs-test-vector (vector 1 "a" [2]))\n'
+            '       (setq pymacs-test-table (make-hash-table :test \'equal))\n'
+            '       (puthash "k" 3 pymacs-test-table)\n'
+            '       (puthash \'m 4 pymacs-test-table)\n'
+            '       (setq pymacs-test-numbers\n'
+            '             (make-hash-table :test \'equal))\n'
+            '       (puthash 1 5 pymacs-test-numbers)\n'
+            '       (puthash 1.0 6 pymacs-test-numbers)\n'
+            '       (pymacs-exec "def f():\\n'
+            '    items = lisp.pymacs_test_list.value().cache()\\n'
+            '    vector = lisp.pymacs_test_vector.value().cache()\\n'
+            '    table = lisp.pymacs_test_table.value().cache()\\n'
+            '    numbers = lisp.pymacs_test_numbers.value().cache()\\n'
+            '    lisp(\'(clrhash pymacs-test-table)\')\\n'
+            '    return (list(items), items[1], list(vector), len(vector),\\n'
+            '            table[\'k\'], table[lisp.m], len(table),\\n'
+            '            numbers.snapshot, numbers[1], numbers[1.0])")\n'
+            '       (pymacs-eval "f()"))\n',
+            'prin1')
+    assert output == '[(7 (8)) (8) (1 "a" [2]) 3 3 4 2 nil 5 6]', repr(output)